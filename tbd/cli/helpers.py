@@ -8,12 +8,16 @@
 from __future__ import unicode_literals
 
 import argparse
+import contextlib
+import errno
 import os
 import subprocess
 import sys
 import shlex
 import shutil
 
+import pygit2
+
 from tbd import core
 
 from . import pprint
@@ -51,6 +55,17 @@ def _get_ref(ref_type, ref_name, repo):
   return r
 
 
+def get_commit(rev, repo):
+  """Return the commit rev points to.
+
+  rev can be the name of a (local or remote) branch or any other revision.
+  """
+  try:
+    return get_branch(rev, repo).head
+  except ValueError:
+    return repo.revparse_single(rev).peel(pygit2.GIT_OBJ_COMMIT)
+
+
 def get_branch_or_use_upstream(branch_name, arg, repo):
   if not branch_name: # use upstream branch
     current_b = repo.current_branch
@@ -68,24 +83,13 @@ def get_branch_or_use_upstream(branch_name, arg, repo):
 
 def page(fp, repo):
   if not sys.stdout.isatty():  # we are being piped or redirected
-    if sys.platform != 'win32':
-      # Prevent Python from throwing exceptions on SIGPIPE
-      from signal import signal, SIGPIPE, SIG_DFL
-      signal(SIGPIPE, SIG_DFL)
+    _default_sigpipe()
     # memory-friendly way to output contents of file to stdout
     with open(fp, 'r') as f:
       shutil.copyfileobj(f, sys.stdout)
     return
 
-  # On Windows, we need to call 'more' through cmd.exe (with 'cmd'). The /C is
-  # so that the command window gets closed after 'more' finishes
-  default_pager = 'less' if sys.platform != 'win32' else 'cmd /C more'
-  try:
-    pager = repo.config['core.pager']
-  except KeyError:
-    pager = '' # empty string will evaluate to False below
-  pager = pager or os.environ.get('PAGER', None) or default_pager
-  cmd = shlex.split(pager) # split into constituents
+  pager, cmd = _pager_cmd(repo)
   if os.path.basename(cmd[0]) == 'less':
     cmd.extend(['-r', '-f']) # append arguments
 
@@ -99,6 +103,65 @@ def page(fp, repo):
     pprint.err_exp('change the value of git\'s core.pager setting')
 
 
+@contextlib.contextmanager
+def pager(repo):
+  """Context manager that gives a function to write output to the pager.
+
+  Unlike page, output is streamed to the pager as it's written, so that it can
+  start showing it right away. If the user quits the pager before all output
+  is written, the with block is exited early.
+  """
+  if not sys.stdout.isatty():  # we are being piped or redirected
+    _default_sigpipe()
+    yield sys.stdout.write
+    return
+
+  pager, cmd = _pager_cmd(repo)
+  if os.path.basename(cmd[0]) == 'less':
+    cmd.append('-r')
+  try:
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=sys.stdout)
+  except OSError:
+    pprint.err('Couldn\'t launch pager {0}'.format(pager))
+    pprint.err_exp('change the value of git\'s core.pager setting')
+    yield sys.stdout.write
+    return
+
+  def write(s):
+    p.stdin.write(s if pprint.IS_PY2 else s.encode(pprint.ENCODING))
+
+  try:
+    yield write
+  except IOError as e:
+    if e.errno != errno.EPIPE:  # EPIPE means the user quit the pager
+      raise
+  finally:
+    try:
+      p.stdin.close()
+    except IOError:  # the user quit the pager
+      pass
+    p.wait()
+
+
+def _pager_cmd(repo):
+  # On Windows, we need to call 'more' through cmd.exe (with 'cmd'). The /C is
+  # so that the command window gets closed after 'more' finishes
+  default_pager = 'less' if sys.platform != 'win32' else 'cmd /C more'
+  try:
+    pager = repo.config['core.pager']
+  except KeyError:
+    pager = '' # empty string will evaluate to False below
+  pager = pager or os.environ.get('PAGER', None) or default_pager
+  return pager, shlex.split(pager) # split into constituents
+
+
+def _default_sigpipe():
+  if sys.platform != 'win32':
+    # Prevent Python from throwing exceptions on SIGPIPE
+    from signal import signal, SIGPIPE, SIG_DFL
+    signal(SIGPIPE, SIG_DFL)
+
+
 class PathProcessor(argparse.Action):
 
   def __init__(
@@ -150,11 +213,11 @@ class CommitIdProcessor(argparse.Action):
     setattr(namespace, self.dest, cids)
 
 
-def oei_flags(subparsers, repo):
+def oei_flags(subparsers, repo, only_action=PathProcessor):
   subparsers.add_argument(
       'only', nargs='*',
       help='use only files given (tracked modified or untracked)',
-      action=PathProcessor, repo=repo, metavar='file')
+      action=only_action, repo=repo, metavar='file')
   subparsers.add_argument(
       '-e', '--exclude', nargs='+',
       help='exclude files given (files must be tracked modified)',
@@ -165,6 +228,27 @@ def oei_flags(subparsers, repo):
       action=PathProcessor, repo=repo, metavar='file')
 
 
+def diff_flags(subparsers):
+  subparsers.add_argument(
+      '--algorithm', choices=list(core.DIFF_ALGORITHMS),
+      help='the diff algorithm to use (defaults to the diff.algorithm config '
+      'value, or myers)')
+  subparsers.add_argument(
+      '--context', type=int, metavar='N', dest='context_lines',
+      help='number of lines of context to show around changes (defaults to 3)')
+  subparsers.add_argument(
+      '--max-file-cost', type=int, metavar='BYTES',
+      help='files bigger than this are always diffed with the fast default '
+      'algorithm (defaults to {0})'.format(core.DIFF_MAX_FILE_COST))
+
+
+def diff_opts(args, repo):
+  """Compute the DiffOptions per diff flags."""
+  return repo.diff_options(
+      algorithm=args.algorithm, context_lines=args.context_lines,
+      max_file_cost=args.max_file_cost)
+
+
 def oei_fs(args, repo):
   """Compute the final fileset per oei flags."""
   only = frozenset(args.only if args.only else [])
@@ -13,6 +13,7 @@ except ImportError:
   from io import StringIO
 
 from datetime import datetime, tzinfo, timedelta
+import json
 from locale import getpreferredencoding
 import re
 import sys
@@ -96,6 +97,32 @@ def err_item(i, opt_text=''):
   item(i, opt_text, stream=sys.stderr.write)
 
 
+class TransferProgress(object):
+  """Shows the progress of fetches.
+
+  Instances are called with pygit2's TransferProgress as objects are fetched.
+  """
+
+  def __init__(self, stream=sys.stderr.write):
+    self.stream = stream
+    self._last = None
+
+  def __call__(self, stats):
+    if not stats.total_objects:
+      return
+    line = 'Fetching objects: {0}% ({1}/{2}), {3} KiB'.format(
+        100 * stats.received_objects // stats.total_objects,
+        stats.received_objects, stats.total_objects,
+        stats.received_bytes // 1024)
+    done = stats.indexed_objects == stats.total_objects
+    if (line, done) == self._last:
+      return
+    self._last = line, done
+    puts('\r' + line, newline=False, stream=self.stream)
+    if done:
+      puts(stream=self.stream)
+
+
 # Misc
 
 def conf_dialog(text):
@@ -135,6 +162,12 @@ def commit_str(ci):
   return ci_str.getvalue().strip()
 
 
+def divergence_str(d):
+  if not d.ahead and not d.behind:
+    return 'up to date with {0}'.format(d.other)
+  return '{0} ahead, {1} behind {2}'.format(d.ahead, d.behind, d.other)
+
+
 def commit(ci, compact=False, stream=sys.stdout.write):
   merge_commit = len(ci.parent_ids) > 1
   color = colored.magenta if merge_commit else colored.yellow
@@ -156,6 +189,99 @@ def commit(ci, compact=False, stream=sys.stdout.write):
   with indent(4):
     puts(ci.message, stream=stream)
 
+def commit_json(ci, stream=sys.stdout.write, **kwargs):
+  """Output ci as a JSON object in one line, kwargs are added to it."""
+  sig = lambda s: {
+      'name': s.name, 'email': s.email, 'time': s.time, 'offset': s.offset}
+  obj = {
+      'id': str(ci.id), 'parents': [str(oid) for oid in ci.parent_ids],
+      'author': sig(ci.author), 'committer': sig(ci.committer),
+      'message': ci.message}
+  obj.update(kwargs)
+  puts('{0}'.format(json.dumps(obj, sort_keys=True)), stream=stream)
+
+class HistoryGraph(object):
+  """Draws the commit graph to the left of commits, one commit at a time.
+
+  Each lane (column of the graph) holds the id of the commit that's next in
+  it, so memory is proportional to the number of lanes and not to the length
+  of the history. Commits must be given children first.
+  """
+
+  def __init__(self):
+    self.lanes = []
+
+  def commit(self, ci, text, parent_ids=None, stream=sys.stdout.write):
+    """Output text (ci's rendering, unicode) with the graph to its left.
+
+    If parent_ids is given, only these parents of ci are drawn.
+    """
+    if parent_ids is None:
+      parent_ids = ci.parent_ids
+    lanes = self.lanes
+    try:
+      col = lanes.index(ci.id)
+    except ValueError:  # first commit in its lane
+      col = len(lanes)
+      lanes.append(ci.id)
+
+    lines = text.splitlines() or ['']
+    puts(self._prefix(col, '*') + lines[0], stream=stream)
+    cont = self._prefix(col, '|' if parent_ids else ' ')
+    for line in lines[1:]:
+      puts((cont + line).rstrip(), stream=stream)
+
+    # Replace ci with its parents. Lanes that end up holding the same commit
+    # are merged right away
+    new_lanes = []
+    edges = []
+    def place(from_col, oid):
+      if oid in new_lanes:
+        to_col = new_lanes.index(oid)
+      else:
+        to_col = len(new_lanes)
+        new_lanes.append(oid)
+      edges.append((from_col, to_col))
+    for i, oid in enumerate(lanes):
+      if i == col:
+        for p in parent_ids:
+          place(i, p)
+      else:
+        place(i, oid)
+    self.lanes = new_lanes
+    self._connect(edges, stream)
+
+  def _prefix(self, col, mark):
+    return ''.join(
+        (mark if i == col else '|') + ' ' for i in range(len(self.lanes)))
+
+  def _connect(self, edges, stream):
+    """Draw edges going from one lane to another, one column per line.
+
+    An edge going left that would cross one going right in the same cell
+    waits for it to move on, so that crossing edges are drawn on separate
+    lines.
+    """
+    pos = [from_col for from_col, _ in edges]
+    while any(p != to_col for p, (_, to_col) in zip(pos, edges)):
+      line = [' '] * (2 * (max(pos + [t for _, t in edges]) + 1))
+      # Edges going right go first
+      moves = sorted(
+          enumerate(edges), key=lambda e: not pos[e[0]] < e[1][1])
+      for i, (_, to_col) in moves:
+        p = pos[i]
+        if p == to_col:
+          line[2 * p] = '|'
+        elif p < to_col:
+          line[2 * p + 1] = '\\'
+          pos[i] = p + 1
+        elif line[2 * p - 1] == '\\':
+          line[2 * p] = '|'
+        else:
+          line[2 * p - 1] = '/'
+          pos[i] = p - 1
+      puts(''.join(line).rstrip(), stream=stream)
+
 # Op Callbacks
 
 def apply_ok(ci):
@@ -193,6 +319,10 @@ class FixedOffset(tzinfo):
 
 
 def diff(patch, stream=sys.stdout.write):
+  if isinstance(patch, core.DiffSummary):
+    diff_summary(patch, stream=stream)
+    return
+
   # Diff header
 
   old_fp = patch.delta.old_file.path
@@ -227,6 +357,69 @@ def diff(patch, stream=sys.stdout.write):
   puts(stream=stream)
 
 
+def diff_summary(summary, stream=sys.stdout.write):
+  """Output the summary of a file that was too big (or binary) to diff."""
+  puts('Diff of file "{0}"'.format(summary.old_fp), stream=stream)
+  if summary.old_fp != summary.new_fp:
+    puts(colored.cyan(' (renamed to {0})'.format(summary.new_fp)), stream=stream)
+    puts(stream=stream)
+
+  if summary.is_binary:
+    puts('Not showing diffs for binary file', stream=stream)
+  else:
+    puts('Not showing diffs for file, it exceeds the diff limits', stream=stream)
+  size_change = summary.new_size - summary.old_size
+  puts('Size: {0} -> {1} bytes ({2:+d})'.format(
+      summary.old_size, summary.new_size, size_change), stream=stream)
+  id_str = lambda oid: str(oid)[:7] if oid else '(none)'
+  puts('Id:   {0} -> {1}'.format(
+      id_str(summary.old_id), id_str(summary.new_id)), stream=stream)
+  puts(stream=stream)
+  puts(stream=stream)
+
+
+def diff_stat(patches, stream=sys.stdout.write):
+  """Output a table with the number of lines added/removed per file."""
+  rows = []
+  for patch in patches:
+    if isinstance(patch, core.DiffSummary):
+      old_fp, new_fp = patch.old_fp, patch.new_fp
+      additions = deletions = 0
+      note = 'binary' if patch.is_binary else 'exceeds diff limits'
+    else:
+      old_fp = patch.delta.old_file.path
+      new_fp = patch.delta.new_file.path
+      _, additions, deletions = patch.line_stats
+      note = 'binary' if patch.delta.is_binary else ''
+    fp = old_fp if old_fp == new_fp else '{0} -> {1}'.format(old_fp, new_fp)
+    rows.append((fp, additions, deletions, note))
+
+  if not rows:
+    return
+
+  fp_width = max(len(fp) for fp, _, _, _ in rows)
+  add_width = max(len(str(a)) for _, a, _, _ in rows) + 1
+  del_width = max(len(str(d)) for _, _, d, _ in rows) + 1
+  for fp, additions, deletions, note in rows:
+    if note:
+      stats = note
+    else:
+      stats = '{0} {1}'.format(
+          colored.green('+{0}'.format(additions).rjust(add_width)),
+          colored.red('-{0}'.format(deletions).rjust(del_width)))
+    puts('{0} | {1}'.format(fp.ljust(fp_width), stats), stream=stream)
+  diff_stat_totals(
+      len(rows), sum(a for _, a, _, _ in rows), sum(d for _, _, d, _ in rows),
+      stream=stream)
+
+
+def diff_stat_totals(files, insertions, deletions, stream=sys.stdout.write):
+  put_s = lambda num: '' if num == 1 else 's'
+  puts('{0} file{1} changed, {2} insertion{3}(+), {4} deletion{5}(-)'.format(
+      files, put_s(files), insertions, put_s(insertions), deletions,
+      put_s(deletions)), stream=stream)
+
+
 def _hunk(hunk, stream=sys.stdout.write):
   puts(colored.cyan('@@ -{0},{1} +{2},{3} @@'.format(
       hunk.old_start, hunk.old_lines, hunk.new_start, hunk.new_lines)),
@@ -24,7 +24,7 @@ from tbd import core
 from . import (
     tbd_track, tbd_untrack, tbd_status, tbd_diff, tbd_commit, tbd_branch, tbd_tag,
     tbd_checkout, tbd_merge, tbd_resolve, tbd_fuse, tbd_remote, tbd_publish,
-    tbd_switch, tbd_init, tbd_history)
+    tbd_switch, tbd_init, tbd_history, tbd_maintenance)
 from . import pprint
 
 
@@ -83,7 +83,7 @@ def main():
   sub_cmds = [
       tbd_track, tbd_untrack, tbd_status, tbd_diff, tbd_commit, tbd_branch, tbd_tag,
       tbd_checkout, tbd_merge, tbd_resolve, tbd_fuse, tbd_remote, tbd_publish,
-      tbd_switch, tbd_init, tbd_history]
+      tbd_switch, tbd_init, tbd_history, tbd_maintenance]
   for sub_cmd in sub_cmds:
     sub_cmd.parser(subparsers, repo)
 
@@ -95,6 +95,8 @@ def main():
   try:
     if args.subcmd_name != 'init' and not repo:
       raise core.NotInRepoError('You are not in a Gitless\'s repository')
+    if repo and sys.stderr.isatty():
+      repo.fetch_session.progress = pprint.TransferProgress()
 
     return SUCCESS if args.func(args, repo) else ERRORS_FOUND
   except KeyboardInterrupt:
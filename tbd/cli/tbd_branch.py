@@ -28,6 +28,10 @@ def parser(subparsers, _):
   list_group.add_argument(
       '-v', '--verbose', help='be verbose, will output the head of each branch',
       action='store_true')
+  list_group.add_argument(
+      '--offline',
+      help='list remote branches as of the last time they were listed or '
+      'fetched instead of asking the remotes', action='store_true')
 
   create_group = branch_parser.add_argument_group('create branches')
   create_group.add_argument(
@@ -60,7 +64,7 @@ def parser(subparsers, _):
 
 
 def main(args, repo):
-  is_list = bool(args.verbose or args.remote)
+  is_list = bool(args.verbose or args.remote or args.offline)
   is_create = bool(args.create_b or args.dp)
   is_delete = bool(args.delete_b)
   is_edit = bool(args.new_head or args.upstream_b or args.unset_upstream)
@@ -83,7 +87,9 @@ def main(args, repo):
   elif args.new_head:
     ret = _do_set_head(args.new_head, repo)
   else:
-    _do_list(repo, args.remote, v=args.verbose)
+    if args.offline:
+      repo.fetch_session.offline = True
+    ret = _do_list(repo, args.remote, v=args.verbose)
 
   return ret
 
@@ -97,21 +103,45 @@ def _do_list(repo, list_remote, v=False):
   pprint.blank()
 
 
-  for b in (repo.lookup_branch(n) for n in sorted(repo.listall_branches())):
-    current_str = '*' if b.is_current else ' '
-    upstream_str = '(upstream is {0})'.format(b.upstream) if b.upstream else ''
-    color = colored.green if b.is_current else colored.yellow
-    pprint.item(
-        '{0} {1} {2}'.format(current_str, color(b.branch_name), upstream_str))
+  refs = repo.ref_snapshot()
+  divergence = refs.divergence() if v else {}
+  for n in refs.listall_branches():
+    is_current = refs.is_current(n)
+    upstream = refs.upstream(n)
+    current_str = '*' if is_current else ' '
+    upstream_str = '(upstream is {0})'.format(upstream) if upstream else ''
+    color = colored.green if is_current else colored.yellow
+    pprint.item('{0} {1} {2}'.format(current_str, color(n), upstream_str))
+    if v:
+      pprint.item('    ➜ head is {0}'.format(pprint.commit_str(refs.head(n))))
+      for d in divergence[n]:
+        pprint.item('    ➜ {0}'.format(pprint.divergence_str(d)))
+
+  if not list_remote:
+    return True
+
+  def list_remote_branches(r):  # runs in a worker thread
+    names = sorted(r.listall_branches())
     if v:
+      r.fetch_branches(names)
+    return names
+
+  errors_found = False
+  for r, names, err in repo.map_remotes(list_remote_branches):
+    if err:
+      pprint.err('Couldn\'t list the branches of remote {0}: {1}'.format(
+          r.name, err))
+      errors_found = True
+      continue
+    if not v:  # no need to fetch anything
+      for n in names:
+        pprint.item('  {0}'.format(colored.yellow(r.name + '/' + n)))
+      continue
+    for b in r.lookup_branches(names):
+      pprint.item('  {0}'.format(colored.yellow(str(b))))
       pprint.item('    ➜ head is {0}'.format(pprint.commit_str(b.head)))
 
-  if list_remote:
-    for r in sorted(repo.remotes, key=lambda r: r.name):
-      for b in (r.lookup_branch(n) for n in sorted(r.listall_branches())):
-        pprint.item('  {0}'.format(colored.yellow(str(b))))
-        if v:
-          pprint.item('    ➜ head is {0}'.format(pprint.commit_str(b.head)))
+  return not errors_found
 
 
 def _do_create(create_b, dp, repo):
@@ -122,6 +152,9 @@ def _do_create(create_b, dp, repo):
   except KeyError:
     raise ValueError('Invalid divergent point {0}'.format(dp))
 
+  # Local branches are created all at once, in the order they were given
+  tx = repo.ref_transaction()
+  local = []
   for b_name in create_b:
     r = repo
     remote_str = ''
@@ -138,6 +171,11 @@ def _do_create(create_b, dp, repo):
                   b_name, maybe_remote))
           continue
         remote_str = ' in remote repository {0}'.format(maybe_remote)
+    if r is repo:
+      if b_name not in local:
+        tx.create_branch(b_name, target)
+        local.append(b_name)
+      continue
     try:
       r.create_branch(b_name, target)
       pprint.ok('Created new branch {0}{1}'.format(b_name, remote_str))
@@ -145,12 +183,24 @@ def _do_create(create_b, dp, repo):
       pprint.err(e)
       errors_found = True
 
+  errors = tx.commit()
+  for b_name in local:
+    e = errors.get(('branch', b_name))
+    if e:
+      pprint.err(e)
+      errors_found = True
+    else:
+      pprint.ok('Created new branch {0}'.format(b_name))
+
   return not errors_found
 
 
 def _do_delete(delete_b, repo):
   errors_found = False
 
+  # Local branches are deleted all at once, in the order they were given
+  tx = repo.ref_transaction()
+  local = []
   for b_name in delete_b:
     try:
       b = helpers.get_branch(b_name, repo)
@@ -163,17 +213,30 @@ def _do_delete(delete_b, repo):
         pprint.msg('Aborted: removal of branch {0}'.format(b))
         continue
 
-      b.delete()
-      pprint.ok('Branch {0} removed successfully'.format(b))
+      if isinstance(b, core.RemoteBranch):
+        b.delete()
+        pprint.ok('Branch {0} removed successfully'.format(b))
+      elif b.branch_name not in local:
+        tx.delete_branch(b.branch_name)
+        local.append(b.branch_name)
     except ValueError as e:
       pprint.err(e)
       errors_found = True
-    except core.BranchIsCurrentError as e:
+
+  errors = tx.commit()
+  for b_name in local:
+    e = errors.get(('branch', b_name))
+    if isinstance(e, core.BranchIsCurrentError):
       pprint.err(e)
       pprint.err_exp(
           'do tbd branch b to create or switch to another branch b and then '
-          'tbd branch -d {0} to remove branch {0}'.format(b))
+          'tbd branch -d {0} to remove branch {0}'.format(b_name))
+      errors_found = True
+    elif e:
+      pprint.err(e)
       errors_found = True
+    else:
+      pprint.ok('Branch {0} removed successfully'.format(b_name))
 
   return not errors_found
 
@@ -10,6 +10,8 @@ from __future__ import unicode_literals
 import os
 import tempfile
 
+from tbd import core
+
 from . import helpers, pprint
 
 
@@ -20,41 +22,152 @@ def parser(subparsers, repo):
       'diff', help=desc, description=(
         desc.capitalize() + '. ' +
         'By default all tracked modified files are diffed. To customize the '
-        ' set of files to diff use the only, exclude, and include flags'))
-  helpers.oei_flags(diff_parser, repo)
-  diff_parser.set_defaults(func=main)
+        ' set of files to diff use the only, exclude, and include flags. To '
+        'diff two commits instead of the working version of files give '
+        'rev1..rev2 (optionally followed by the paths to diff)'))
+  helpers.oei_flags(diff_parser, repo, only_action=RangeOrPathProcessor)
+  diff_parser.add_argument(
+      '--stat', help='only output the number of lines added and removed per '
+      'file', action='store_true')
+  helpers.diff_flags(diff_parser)
+  diff_parser.set_defaults(func=main, rev_range=None, range_paths=None)
+
+
+class RangeOrPathProcessor(helpers.PathProcessor):
+  """Like PathProcessor but the first arg can also be a rev1..rev2 range.
+
+  If there's a range, the paths are left as given (relative to the repo root)
+  since they are to be looked up in the commits' trees and not in the working
+  directory.
+  """
+
+  def __call__(self, parser, namespace, paths, option_string=None):
+    if not paths or not _is_range(paths[0], self.repo):
+      super(RangeOrPathProcessor, self).__call__(
+          parser, namespace, paths, option_string=option_string)
+      return
+
+    root = self.repo.root if self.repo else ''
+    namespace.rev_range = paths[0]
+    namespace.range_paths = [
+        os.path.relpath(os.path.abspath(p), root) for p in paths[1:]]
+    setattr(namespace, self.dest, None)
+
+
+def _is_range(arg, repo):
+  """True if arg is a rev1..rev2 range whose revs exist in the repo."""
+  if '..' not in arg or os.path.exists(arg) or not repo:
+    return False
+  rev1, rev2 = arg.split('...' if '...' in arg else '..', 1)
+  for rev in (rev1, rev2):
+    try:
+      repo.revparse_single(rev or 'HEAD')
+    except ValueError:
+      return False
+  return True
 
 
 def main(args, repo):
+  if args.rev_range:
+    return _diff_range(args, repo)
+
   files = helpers.oei_fs(args, repo)
   if not files:
     pprint.warn('No files to diff')
 
   success = True
   curr_b = repo.current_branch
+  opts = helpers.diff_opts(args, repo)
   with tempfile.NamedTemporaryFile(mode='w', delete=False) as tf:
-    for fp in files:
-      try:
-        patch = curr_b.diff_file(fp)
-      except KeyError:
-        pprint.err('Can\'t diff non-existent file {0}'.format(fp))
-        success = False
-        continue
-
-      if patch.delta.is_binary:
-        pprint.warn('Not showing diffs for binary file {0}'.format(fp))
-        continue
-
-      additions = patch.line_stats[1]
-      deletions = patch.line_stats[2]
-      if (not additions) and (not deletions):
-        pprint.warn('No diffs to output for {0}'.format(fp))
-        continue
-
-      pprint.diff(patch, stream=tf.write)
+    if args.stat:
+      success = _diff_stat(files, curr_b, opts, tf.write)
+    else:
+      for fp in files:
+        try:
+          patch = curr_b.diff_file(fp, opts=opts)
+        except KeyError:
+          pprint.err('Can\'t diff non-existent file {0}'.format(fp))
+          success = False
+          continue
+
+        if isinstance(patch, core.DiffSummary):
+          pprint.diff_summary(patch, stream=tf.write)
+          continue
+
+        if patch.delta.is_binary:
+          pprint.warn('Not showing diffs for binary file {0}'.format(fp))
+          continue
+
+        additions = patch.line_stats[1]
+        deletions = patch.line_stats[2]
+        if (not additions) and (not deletions):
+          pprint.warn('No diffs to output for {0}'.format(fp))
+          continue
+
+        pprint.diff(patch, stream=tf.write)
 
   if os.path.getsize(tf.name) > 0:
     helpers.page(tf.name, repo)
   os.remove(tf.name)
 
   return success
+
+
+def _diff_stat(files, curr_b, opts, write):
+  # All files are diffed at once, and only their line stats are looked at
+  success = True
+  patches = []
+  for fp, patch in curr_b.diff_stats(files, opts=opts):
+    if patch is None:
+      pprint.err('Can\'t diff non-existent file {0}'.format(fp))
+      success = False
+    else:
+      patches.append(patch)
+  pprint.diff_stat(patches, stream=write)
+  return success
+
+
+def _diff_range(args, repo):
+  if args.exclude or args.include:
+    pprint.err('Invalid flag combination')
+    pprint.err_exp(
+        'the exclude and include flags can\'t be used when diffing commits')
+    return False
+
+  c1, c2 = _parse_range(args.rev_range, repo)
+  patches = repo.diff_commits(
+      c1, c2, paths=args.range_paths or None, find_renames=True,
+      opts=helpers.diff_opts(args, repo))
+  with tempfile.NamedTemporaryFile(mode='w', delete=False) as tf:
+    if args.stat:
+      pprint.diff_stat(patches, stream=tf.write)
+    else:
+      for patch in patches:
+        pprint.diff(patch, stream=tf.write)
+
+  if os.path.getsize(tf.name) > 0:
+    helpers.page(tf.name, repo)
+  else:
+    pprint.warn('No diffs to output for {0}'.format(args.rev_range))
+  os.remove(tf.name)
+
+  return True
+
+
+def _parse_range(rev_range, repo):
+  """Return the commits to diff given a rev1..rev2 or rev1...rev2 range.
+
+  Omitted revs default to HEAD. Like in Git, rev1...rev2 diffs rev2 against the
+  common ancestor of both revs.
+  """
+  symmetric = '...' in rev_range
+  rev1, rev2 = rev_range.split('...' if symmetric else '..', 1)
+  c1 = helpers.get_commit(rev1 or 'HEAD', repo)
+  c2 = helpers.get_commit(rev2 or 'HEAD', repo)
+  if symmetric:
+    mb = repo.commits_merge_base(c1.id, c2.id)
+    if not mb:
+      raise core.TbdError(
+          'No common commit found between {0} and {1}'.format(rev1, rev2))
+    c1 = repo.git_repo[mb]
+  return c1, c2
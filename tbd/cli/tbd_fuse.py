@@ -68,9 +68,8 @@ def main(args, repo):
     insertion_point = repo.revparse_single(args.insertion_point).id
 
   def valid_input(inp):
-    walker = src_branch.history()
-    walker.hide(insertion_point)
-    divergent_ids = frozenset(ci.id for ci in walker)
+    divergent_ids = repo.reachable_ids(
+        src_branch.target, hide=[insertion_point])
 
     errors_found = False
     for ci in inp - divergent_ids:
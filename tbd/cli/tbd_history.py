@@ -7,20 +7,35 @@
 
 from __future__ import unicode_literals
 
-import os
-import tempfile
+import collections
+import itertools
+import multiprocessing
+import sys
+
+from clint.textui import colored
+
+from tbd import core
 
 from . import helpers, pprint
 
 
-def parser(subparsers, _):
+def parser(subparsers, repo):
   """Adds the history parser to the given subparsers object."""
   desc = 'show commit history'
   history_parser = subparsers.add_parser(
-      'history', help=desc, description=desc.capitalize())
+      'history', help=desc, description=(
+        desc.capitalize() + '. ' +
+        'If files are given, only the commits that changed them are shown'))
+  history_parser.add_argument(
+      'paths', nargs='*', help='only show commits that changed these files',
+      action=helpers.PathProcessor, repo=repo, recursive=False, metavar='file')
   history_parser.add_argument(
       '-v', '--verbose', help='be verbose, will output the diffs of the commit',
       action='store_true')
+  history_parser.add_argument(
+      '--stat', help='output the number of files changed and lines added and '
+      'removed by each commit', action='store_true')
+  helpers.diff_flags(history_parser)
   history_parser.add_argument(
       '-l', '--limit', help='limit number of commits displayed', type=int)
   history_parser.add_argument(
@@ -29,24 +44,200 @@ def parser(subparsers, _):
   history_parser.add_argument(
       '-b', '--branch', nargs='?', metavar='branch_name', dest='b',
       help='the branch to show history of (defaults to the current branch)')
+  history_parser.add_argument(
+      '--since', metavar='date',
+      help='only show commits more recent than the given date (e.g., '
+      '2020-01-31, yesterday, 2 weeks ago)')
+  history_parser.add_argument(
+      '--until', metavar='date',
+      help='only show commits older than the given date')
+  history_parser.add_argument(
+      '--author', metavar='pattern',
+      help='only show commits whose author (name <email>) matches the given '
+      'regular expression')
+  history_parser.add_argument(
+      '--first-parent', help='only follow the first parent of merge commits '
+      '(merge commits are then diffed with their first parent)',
+      action='store_true')
+  history_parser.add_argument(
+      '--after', metavar='commit',
+      help='only show the commits that come after the given one. To page '
+      'through history give the cursor of the last commit output with --json '
+      'instead, the walk is then resumed right where it was left')
+  history_parser.add_argument(
+      '--json', help='output one JSON object per commit and line, with the '
+      'cursor to resume history after the commit', action='store_true')
+  history_parser.add_argument(
+      '--graph', help='draw the commit graph to the left of the history',
+      action='store_true')
   history_parser.set_defaults(func=main)
 
 
 def main(args, repo):
+  paths = list(args.paths or [])
+  if args.json and (args.verbose or args.graph):
+    pprint.err('Invalid flag combination')
+    pprint.err_exp('diffs and graphs can\'t be output in the JSON format')
+    return False
+  if args.graph and (
+      paths or args.author or args.since or args.until or args.after):
+    pprint.err('Invalid flag combination')
+    pprint.err_exp(
+        'the graph can\'t be drawn if commits are filtered by file, author or '
+        'date or if history starts after a commit')
+    return False
+
   b = helpers.get_branch(args.b, repo) if args.b else repo.current_branch
-  with tempfile.NamedTemporaryFile(mode='w', delete=False) as tf:
-    count = 0
-    for ci in b.history():
-      if args.limit and count == args.limit:
-        break
-      pprint.commit(ci, compact=args.compact, stream=tf.write)
+  opts = helpers.diff_opts(args, repo)
+  after = None
+  if args.after:
+    if ':' in args.after:
+      after = core.HistoryCursor.parse(args.after)
+    else:
+      after = core.HistoryCursor(repo.revparse_single(args.after).id, None)
+  since = core.approxidate(args.since) if args.since else None
+  until = core.approxidate(args.until) if args.until else None
+  walk = b.history(
+      stream=True, paths=paths, after=after, since=since,
+      until=until, author=args.author, first_parent=args.first_parent)
+  # With --first-parent, merge commits are seen as bringing in the changes of
+  # the merged branch, so we diff them with their first parent too
+  diffable = lambda ci: (
+      len(ci.parents) == 1 or (args.first_parent and len(ci.parents) > 1))
+  commits = itertools.islice(walk, args.limit) if args.limit else walk
+  if args.verbose:
+    commits = _with_diffs(commits, repo, opts, diffable, limit=args.limit)
+  else:
+    commits = ((ci, None) for ci in commits)
+  graph = pprint.HistoryGraph() if args.graph else None
+  shallow_ids = repo.shallow_ids
+  with helpers.pager(repo) as write:
+    for ci, diff_str in commits:
+      if args.json:
+        extra = {'cursor': str(walk.cursor)}
+        if args.stat and diffable(ci):
+          extra['stats'] = dict(zip(
+              ['files_changed', 'insertions', 'deletions'],
+              b.diff_commits_stats(ci.parents[0], ci)))
+        pprint.commit_json(ci, stream=write, **extra)
+        continue
+      out = []
+      stream = out.append if graph else write
+      pprint.commit(ci, compact=args.compact, stream=stream)
+      if ci.id in shallow_ids:
+        pprint.exp(
+            'older history is not available (this is a shallow repository)',
+            stream=stream)
       if not args.compact:
-        pprint.puts(stream=tf.write)
-      if args.verbose and len(ci.parents) == 1:
-        for patch in b.diff_commits(ci.parents[0], ci):
-          pprint.diff(patch, stream=tf.write)
-
-      count += 1
-  helpers.page(tf.name, repo)
-  os.remove(tf.name)
+        pprint.puts(stream=stream)
+      if args.stat and diffable(ci):
+        pprint.diff_stat_totals(
+            *b.diff_commits_stats(ci.parents[0], ci), stream=stream)
+        if not args.compact:
+          pprint.puts(stream=stream)
+      if diff_str:
+        stream(diff_str)
+      if graph:
+        text = ''.join(out)
+        graph.commit(
+            ci, text.decode(pprint.ENCODING) if pprint.IS_PY2 else text,
+            parent_ids=ci.parent_ids[:1] if args.first_parent else None,
+            stream=write)
   return True
+
+
+def _with_diffs(commits, repo, opts, diffable, limit=None):
+  """Generate each commit with the rendered diff with its (first) parent.
+
+  Only commits for which diffable returns True are diffed.
+
+  Commit diffs never change, so we cache the rendered output keyed by the ids
+  of the trees being diffed and the options that affect rendering. Diffs that
+  are not cached are computed by a pool of tbd.diffWorkers worker processes
+  (one per CPU by default, but no more than the limit of commits to output)
+  while the commits before them are being rendered. To bound memory, diffs are
+  computed at most twice as many commits ahead as there are workers. Commits
+  are generated in order.
+  """
+  diff_cache = repo.cache('patches')
+  color = not colored.DISABLE_COLOR and sys.stdout.isatty()
+  workers = _diff_workers(repo, limit)
+  pool = None
+  pending = collections.deque()
+
+  def resolve(ci, key, diff_str):
+    if key:  # it was computed (not cached), wait for it and cache it
+      diff_str = diff_str.get() if pool else diff_str
+      diff_cache.set(
+          key,
+          diff_str if pprint.IS_PY2 else diff_str.encode(pprint.ENCODING))
+    return ci, diff_str
+
+  try:
+    for ci in commits:
+      key, diff_str = None, None
+      if diffable(ci):
+        parent = ci.parents[0]
+        key = 'diff:{0}:{1}:color={2}:limits={3},{4}:opts={5},{6},{7}'.format(
+            parent.tree_id, ci.tree_id, color, *(repo.diff_limits() + opts))
+        diff_str = diff_cache.get(key)
+        if diff_str is not None:
+          key = None
+          if not pprint.IS_PY2:
+            diff_str = diff_str.decode(pprint.ENCODING)
+        elif workers > 1:
+          if not pool:
+            pool = multiprocessing.Pool(
+                workers, _init_worker, (colored.DISABLE_COLOR,))
+          diff_str = pool.apply_async(
+              _render_diff, (str(parent.id), str(ci.id), opts))
+        else:
+          diff_str = _render_diff(str(parent.id), str(ci.id), opts, repo=repo)
+      pending.append((ci, key, diff_str))
+      if len(pending) > 2 * workers:
+        yield resolve(*pending.popleft())
+    while pending:
+      yield resolve(*pending.popleft())
+  finally:
+    if pool:
+      pool.terminate()
+
+
+# If the output is not interactive and there are fewer commits than this to
+# diff, starting the worker processes costs more than what they save
+_MIN_POOL_COMMITS = 8
+
+
+def _diff_workers(repo, limit=None):
+  """Return the number of worker processes to diff up to limit commits with."""
+  try:
+    workers = repo.config.get_int('tbd.diffWorkers')
+  except KeyError:
+    try:
+      workers = multiprocessing.cpu_count()
+    except NotImplementedError:
+      workers = 1
+  if limit is not None:
+    workers = min(workers, limit)
+    if limit < _MIN_POOL_COMMITS and not sys.stdout.isatty():
+      workers = 1
+  return max(workers, 1)
+
+
+# Worker processes have their own repository
+_worker_repo = None
+
+
+def _init_worker(disable_color):
+  global _worker_repo
+  colored.DISABLE_COLOR = disable_color
+  _worker_repo = core.Repository()
+
+
+def _render_diff(parent_id, ci_id, opts, repo=None):
+  repo = repo or _worker_repo
+  git_repo = repo.git_repo
+  out = []
+  for patch in repo.diff_commits(git_repo[parent_id], git_repo[ci_id], opts=opts):
+    pprint.diff(patch, stream=out.append)
+  return ''.join(out)
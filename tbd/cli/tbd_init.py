@@ -26,6 +26,28 @@ def parser(subparsers, _):
       help=(
           'an optional remote repo address from where to read to create the '
           'local repo'))
+  init_parser.add_argument(
+      '--depth', type=int,
+      help='only get the last DEPTH commits of each branch of the remote repo')
+  init_parser.add_argument(
+      '--since',
+      help='only get the commits of the remote repo more recent than SINCE')
+  init_parser.add_argument(
+      '--max-blob-size', dest='max_blob_size',
+      help=(
+          'don\'t get files bigger than MAX_BLOB_SIZE (in bytes, k, m or g '
+          'suffixes can be used) until they are needed'))
+  init_parser.add_argument(
+      '--reference', metavar='repo',
+      help=(
+          'a local repo with objects in common with the remote repo, these '
+          'are then shared with it instead of copied'))
+  init_parser.add_argument(
+      '--bundle', metavar='file',
+      help=(
+          'a bundle file (made with git bundle) to read the remote repo\'s '
+          'branches and tags from, only what\'s missing in it is then read '
+          'from the remote repo'))
   init_parser.set_defaults(func=main)
 
 
@@ -33,7 +55,22 @@ def main(args, repo):
   if repo:
     pprint.err('You are already in a Gitless repository')
     return False
-  core.init_repository(url=args.repo)
+  partial = (
+      args.depth is not None or args.since or args.max_blob_size is not None)
+  if (partial or args.reference or args.bundle) and not args.repo:
+    pprint.err(
+        '--depth, --since, --max-blob-size, --reference and --bundle can only '
+        'be used when creating a repo from a remote repo')
+    return False
+  if partial and args.bundle:
+    pprint.err('Invalid flag combination')
+    pprint.err_exp(
+        '--depth, --since and --max-blob-size can\'t be used with --bundle')
+    return False
+  core.init_repository(
+      url=args.repo, depth=args.depth, since=args.since,
+      max_blob_size=args.max_blob_size, reference=args.reference,
+      bundle=args.bundle)
   pprint.ok('Local repo created in {0}'.format(os.getcwd()))
   if args.repo:
     pprint.ok('Initialized from remote {0}'.format(args.repo))
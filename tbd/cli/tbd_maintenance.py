@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Gitless - a version control system built on top of Git
+# Licensed under MIT
+
+"""tbd maintenance - Update the indexes that speed up repository operations."""
+
+
+from __future__ import unicode_literals
+
+from . import pprint
+
+
+def parser(subparsers, _):
+  """Adds the maintenance parser to the given subparsers object."""
+  desc = 'update the indexes that speed up history operations'
+  maintenance_parser = subparsers.add_parser(
+      'maintenance', help=desc, description=(
+        desc.capitalize() + '. ' +
+        'Writes the commit-graph, which makes history, fuse and branch '
+        'operations faster on repositories with long histories. Only commits '
+        'that are not in the commit-graph yet are added to it, so it is cheap '
+        'to run often'))
+  maintenance_parser.set_defaults(func=main)
+
+
+def main(args, repo):
+  repo.write_commit_graph()
+  pprint.ok(
+      'Commit-graph updated, it has {0} commits'.format(
+          len(repo.commit_graph or [])))
+  return True
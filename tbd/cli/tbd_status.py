@@ -31,6 +31,10 @@ def main(args, repo):
   curr_b = repo.current_branch
   pprint.msg('On branch {0}, repo-directory {1}'.format(
     colored.green(curr_b.branch_name), colored.green('//' + repo.cwd)))
+  refs = repo.ref_snapshot()
+  if curr_b.branch_name in refs:
+    for d in refs.divergence([curr_b.branch_name])[curr_b.branch_name]:
+      pprint.exp(pprint.divergence_str(d))
 
   if curr_b.merge_in_progress:
     pprint.blank()
@@ -23,6 +23,10 @@ def parser(subparsers, _):
       '-r', '--remote',
       help='list remote tags in addition to local tags',
       action='store_true')
+  list_group.add_argument(
+      '--offline',
+      help='list remote tags as of the last time they were listed instead of '
+      'asking the remotes', action='store_true')
 
   create_group = tag_parser.add_argument_group('create tags')
   create_group.add_argument(
@@ -42,7 +46,7 @@ def parser(subparsers, _):
 
 
 def main(args, repo):
-  is_list = bool(args.remote)
+  is_list = bool(args.remote or args.offline)
   is_create = bool(args.create_t or args.ci)
   is_delete = bool(args.delete_t)
 
@@ -57,7 +61,9 @@ def main(args, repo):
   elif args.delete_t:
     ret = _do_delete(args.delete_t, repo)
   else:
-    _do_list(repo, args.remote)
+    if args.offline:
+      repo.fetch_session.offline = True
+    ret = _do_list(repo, args.remote)
 
   return ret
 
@@ -73,14 +79,24 @@ def _do_list(repo, list_remote):
     pprint.item('{0} ➜ tags {1}'.format(t, pprint.commit_str(t.commit)))
     no_tags = False
 
+  errors_found = False
   if list_remote:
-    for r in sorted(repo.remotes, key=lambda r: r.name):
-      for t in (r.lookup_tag(n) for n in sorted(r.listall_tags())):
+    def list_remote_tags(r):  # runs in a worker thread
+      return sorted(r.listall_tags())
+
+    for r, names, err in repo.map_remotes(list_remote_tags):
+      if err:
+        pprint.err('Couldn\'t list the tags of remote {0}: {1}'.format(
+            r.name, err))
+        errors_found = True
+        continue
+      for t in r.lookup_tags(names):
         pprint.item('{0} ➜ tags {1}'.format(t, pprint.commit_str(t.commit)))
         no_tags = False
 
   if no_tags:
     pprint.item('There are no tags to list')
+  return not errors_found
 
 
 def _do_create(create_t, dp, repo):
@@ -91,6 +107,9 @@ def _do_create(create_t, dp, repo):
   except KeyError:
     raise ValueError('Invalid commit {0}'.format(dp))
 
+  # Local tags are created all at once, in the order they were given
+  tx = repo.ref_transaction()
+  local = []
   for t_name in create_t:
     r = repo
     remote_str = ''
@@ -107,6 +126,11 @@ def _do_create(create_t, dp, repo):
                   t_name, maybe_remote))
           continue
         remote_str = ' in remote repository {0}'.format(maybe_remote)
+    if r is repo:
+      if t_name not in local:
+        tx.create_tag(t_name, target)
+        local.append(t_name)
+      continue
     try:
       r.create_tag(t_name, target)
       pprint.ok('Created new tag {0}{1}'.format(t_name, remote_str))
@@ -114,12 +138,24 @@ def _do_create(create_t, dp, repo):
       pprint.err(e)
       errors_found = True
 
+  errors = tx.commit()
+  for t_name in local:
+    e = errors.get(('tag', t_name))
+    if e:
+      pprint.err(e)
+      errors_found = True
+    else:
+      pprint.ok('Created new tag {0}'.format(t_name))
+
   return not errors_found
 
 
 def _do_delete(delete_t, repo):
   errors_found = False
 
+  # Local tags are deleted all at once, in the order they were given
+  tx = repo.ref_transaction()
+  local = []
   for t_name in delete_t:
     try:
       t = helpers.get_tag(t_name, repo)
@@ -132,10 +168,23 @@ def _do_delete(delete_t, repo):
         pprint.msg('Aborted: removal of tag {0}'.format(t))
         continue
 
-      t.delete()
-      pprint.ok('Tag {0} removed successfully'.format(t))
+      if isinstance(t, core.RemoteTag):
+        t.delete()
+        pprint.ok('Tag {0} removed successfully'.format(t))
+      elif t.tag_name not in local:
+        tx.delete_tag(t.tag_name)
+        local.append(t.tag_name)
     except ValueError as e:
       pprint.err(e)
       errors_found = True
 
+  errors = tx.commit()
+  for t_name in local:
+    e = errors.get(('tag', t_name))
+    if e:
+      pprint.err(e)
+      errors_found = True
+    else:
+      pprint.ok('Tag {0} removed successfully'.format(t_name))
+
   return not errors_found
@@ -9,6 +9,8 @@ from __future__ import unicode_literals
 
 import collections
 import errno
+import hashlib
+import heapq
 import io
 try:
   from itertools import izip as zip
@@ -18,9 +20,14 @@ except ImportError:
 import itertools
 import json
 from locale import getpreferredencoding
+import mmap
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import shutil
+import struct
+import threading
+import time
 
 import pygit2
 
@@ -58,6 +65,88 @@ TBD_STATUS_TRACKED = 2
 TBD_STATUS_IGNORED = 3
 
 
+# Cache
+
+# Data tbd caches lives under .git/tbd-cache/. Each cache is bounded in size by
+# the tbd.cacheMaxBytes config value (or CACHE_MAX_BYTES if it's not set)
+CACHE_DIR = 'tbd-cache'
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+# Diff limits
+
+# Files bigger than this (in bytes or lines) are summarized instead of diffed.
+# Both can be overridden with the tbd.diffMaxBytes and tbd.diffMaxLines config
+# values
+DIFF_MAX_BYTES = 50 * 1024 * 1024
+DIFF_MAX_LINES = 500000
+
+# Like Git, we consider a file binary if there's a NUL byte in its first 8000
+# bytes
+BINARY_PREFIX_LEN = 8000
+
+# Diff algorithms. libgit2 has no histogram algorithm so we use patience, the
+# closest one, instead
+DIFF_ALGORITHMS = collections.OrderedDict([
+    ('myers', pygit2.GIT_DIFF_NORMAL),
+    ('minimal', pygit2.GIT_DIFF_MINIMAL),
+    ('patience', pygit2.GIT_DIFF_PATIENCE),
+    ('histogram', pygit2.GIT_DIFF_PATIENCE),
+    ])
+DIFF_CONTEXT_LINES = 3
+# Files whose old and new versions add up to more than this many bytes are
+# always diffed with the (fast) default algorithm
+DIFF_MAX_FILE_COST = 1024 * 1024
+
+# History
+
+# Number of commits streaming history walks read ahead of the commit they are
+# about to output so that it comes after all of its children even if the
+# commit times are skewed
+HISTORY_LOOKAHEAD = 500
+
+# Like Git, walks in commit time order that only want commits newer than some
+# date stop after finding this many older commits in a row (more recent
+# commits might come after a few older ones if commit times are skewed)
+HISTORY_SLOP = 5
+
+# Branches
+
+# The branch other branches are compared to (see RefSnapshot.divergence) if the
+# tbd.trunk config value is not set
+TRUNK = 'master'
+
+# Remotes
+
+# Max number of remotes to talk to at the same time, can be overridden with the
+# tbd.remoteWorkers config value
+REMOTE_WORKERS = 8
+
+# Max age (in seconds) of the cached refs of remotes that are used instead of
+# asking the remote again, can be overridden with the tbd.remoteRefsTtl config
+# value. By default, remotes are always asked (the cache is then only used in
+# offline mode)
+REMOTE_REFS_TTL = 0
+
+# Commit-graph
+
+# Git's commit-graph file (or chain of files if it's written incrementally),
+# relative to the .git dir
+COMMIT_GRAPH_FP = os.path.join('objects', 'info', 'commit-graph')
+COMMIT_GRAPH_CHAIN_DIR = os.path.join('objects', 'info', 'commit-graphs')
+
+DiffOptions = collections.namedtuple(
+    'DiffOptions', ['algorithm', 'context_lines', 'max_file_cost'])
+
+Divergence = collections.namedtuple(
+    'Divergence', ['other', 'ahead', 'behind'])
+
+DiffSummary = collections.namedtuple(
+    'DiffSummary', [
+        'old_fp', 'new_fp', 'old_id', 'new_id', 'old_size', 'new_size',
+        'is_binary'])
+
+
 def error_on_none(path):
   """Raise a KeyError if the ```path``` argument is None."""
   if path is None:
@@ -65,12 +154,24 @@ def error_on_none(path):
   return path
 
 
-def init_repository(url=None):
+def init_repository(
+    url=None, depth=None, since=None, max_blob_size=None, reference=None,
+    bundle=None):
   """Creates a new tbd's repository in the cwd.
 
   Args:
     url: if given the local repository will be a clone of the remote repository
       given by this url.
+    depth, since: if given the clone is shallow, it only has the last depth
+      commits of each branch or the commits more recent than since (a date).
+    max_blob_size: if given the clone is partial, blobs bigger than this (in
+      bytes, a k, m or g suffix can be used) are not fetched until they are
+      needed (see Repository.fetch_missing_objects).
+    reference: if given, the path to a local repository whose objects are
+      shared with the clone (through git's alternates) instead of fetched.
+    bundle: if given, the path to a bundle file (see git bundle) the clone is
+      seeded with, only what's not in it is then fetched from the remote. It
+      can't be used with depth, since and max_blob_size.
   """
   cwd = os.getcwd()
   try:
@@ -83,22 +184,115 @@ def init_repository(url=None):
       git.commit(allow_empty=True, m='Initialize repository')
       return repo
 
+    # Like git clone, we refuse to clone into a non-empty dir, so that if
+    # anything goes wrong we can remove everything we created
+    if os.listdir(cwd):
+      raise TbdError(
+          'Can\'t create a repo from a remote repo in {0}: the directory is '
+          'not empty'.format(cwd))
+    done = False
     try:
-      git.clone(url, cwd)
-    except ErrorReturnCode as e:
-      raise TbdError(stderr(e))
-
-    # We get all remote branches as well and create local equivalents
-    repo = Repository()
-    remote = repo.remotes['origin']
-    for rb in (remote.lookup_branch(bn) for bn in remote.listall_branches()):
-      if rb.branch_name == 'master':
-        continue
-      new_b = repo.create_branch(rb.branch_name, rb.head)
-      new_b.upstream = rb
+      if bundle:
+        _init_from_bundle(url, bundle, reference=reference)
+      else:
+        _clone(
+            url, cwd, depth=depth, since=since, max_blob_size=max_blob_size,
+            reference=reference)
+
+      # We also create local equivalents of all remote branches. The clone
+      # already fetched them so there's no need to talk to the remote again
+      repo = Repository()
+      existing = frozenset(repo.listall_branches())
+      remote_branches = _read_refs(repo.path, 'refs/remotes/origin/')
+      _create_upstream_branches(repo, 'origin', [
+          (n, target) for n, target in remote_branches
+          if n not in existing and isinstance(target, pygit2.Oid)])
+      if bundle:  # nothing is checked out yet
+        try:
+          git.reset('--hard', _cwd=repo.root)
+        except ErrorReturnCode as e:
+          raise TbdError(stderr(e))
+      done = True
+    finally:
+      if not done:  # also on KeyboardInterrupt
+        _clear_dir(cwd)
     return repo
 
 
+# Helpers for init_repository
+
+
+def _clone(
+    url, cwd, depth=None, since=None, max_blob_size=None, reference=None):
+  """Clone the remote at url in cwd (see init_repository)."""
+  clone_args = []
+  if depth is not None:
+    clone_args.append('--depth={0}'.format(depth))
+  if since:
+    clone_args.append('--shallow-since={0}'.format(since))
+  if depth is not None or since:
+    clone_args.append('--no-single-branch')  # we want all branches
+  if max_blob_size is not None:
+    clone_args.append('--filter=blob:limit={0}'.format(max_blob_size))
+  if clone_args and os.path.isdir(url):
+    # Git ignores these when cloning from a local path
+    url = 'file://' + os.path.abspath(url)
+  if reference:
+    clone_args.append('--reference={0}'.format(os.path.abspath(reference)))
+  try:
+    git.clone(url, cwd, *clone_args)
+  except ErrorReturnCode as e:
+    raise TbdError(stderr(e))
+
+
+def _init_from_bundle(url, bundle, reference=None):
+  """Init a repo in the cwd from the given bundle and the remote at url.
+
+  The remote branches and tags are first read from the bundle, so that only
+  the commits that are not in it are fetched from the remote. HEAD ends up
+  pointing to the remote's default branch, but nothing is checked out.
+  """
+  bundle = os.path.abspath(bundle)
+  try:
+    git.init()
+    if reference:
+      _add_alternate(reference)
+    git.remote.add('origin', url)
+    git.fetch(
+        bundle, '+refs/heads/*:refs/remotes/origin/*',
+        '+refs/tags/*:refs/tags/*')
+    git.fetch('origin', '--prune')
+    git.remote('set-head', 'origin', '--auto')
+    default = stdout(
+        git('symbolic-ref', '--short', 'refs/remotes/origin/HEAD')).strip()
+    git('symbolic-ref', 'HEAD', 'refs/heads/' + default[len('origin/'):])
+  except ErrorReturnCode as e:
+    raise TbdError(stderr(e))
+
+
+def _clear_dir(path):
+  """Remove everything in the dir at path."""
+  for name in os.listdir(path):
+    fp = os.path.join(path, name)
+    if os.path.isdir(fp) and not os.path.islink(fp):
+      shutil.rmtree(fp, ignore_errors=True)
+    else:
+      os.remove(fp)
+
+
+def _add_alternate(reference):
+  """Make the repo in the cwd borrow the objects of the one at reference."""
+  try:
+    objects = os.path.join(pygit2.Repository(reference).path, 'objects')
+  except (pygit2.GitError, KeyError):
+    raise TbdError('{0} is not a repository'.format(reference))
+  info = os.path.join('.git', 'objects', 'info')
+  if not os.path.isdir(info):
+    os.makedirs(info)
+  with io.open(os.path.join(info, 'alternates'), 'w') as f:
+    f.write(os.path.abspath(objects) + '\n')
+
+
 class Repository(object):
   """A tbd's repository.
 
@@ -110,6 +304,8 @@ class Repository(object):
     config: the repository's configuration.
     current_branch: the current branch (a Branch object).
     remotes: the configured remotes (see RemoteCollection).
+    fetch_session: the FetchSession of the remote operations done through
+      this repository.
   """
 
   def __init__(self):
@@ -124,6 +320,10 @@ class Repository(object):
     self.path = self.git_repo.path
     self.root = self.path[:-6]  # strip trailing /.git/
     self.config = self.git_repo.config
+    self.fetch_session = FetchSession(self)
+    self._promisor = False  # not resolved yet, see _promisor_remote
+    self._commit_graph = None
+    self._commit_graph_stamp = None
 
   @property
   def cwd(self):
@@ -143,10 +343,260 @@ class Repository(object):
       raise ValueError('No commit found for {0}'.format(revision))
 
   def merge_base(self, b1, b2):
+    mb = self.commits_merge_base(b1.target, b2.target)
+    if not mb:
+      msg = 'No common commit found between {0} and {1}'.format(b1, b2)
+      if self.git_repo.is_shallow:
+        msg += (
+            ' (this is a shallow repository, the common commit might be older '
+            'than its history)')
+      raise TbdError(msg)
+    return mb
+
+  def commits_merge_base(self, id1, id2):
+    """Return the id of the best common ancestor of the given commits.
+
+    None is returned if the commits have no common ancestor.
+    """
+    graph = self.commit_graph
+    if graph:
+      return _graph_merge_base(_CommitNodes(self.git_repo, graph), id1, id2)
     try:
-      return self.git_repo.merge_base(b1.target, b2.target)
+      return self.git_repo.merge_base(id1, id2)
     except KeyError:
-      raise TbdError('No common commit found between {0} and {1}'.format(b1, b2))
+      return None
+
+  def reachable_ids(self, target, hide=()):
+    """Return the ids of the commits reachable from target.
+
+    Commits reachable from any of the commits in hide are left out.
+    """
+    graph = self.commit_graph
+    if graph:
+      return _graph_reachable_ids(
+          _CommitNodes(self.git_repo, graph), target, hide)
+    walk = self.git_repo.walk(target, pygit2.GIT_SORT_NONE)
+    for h in hide:
+      walk.hide(h)
+    return frozenset(ci.id for ci in walk)
+
+  def ahead_behind(self, id1, id2):
+    """Return the number of commits id1 is ahead and behind of id2."""
+    graph = self.commit_graph
+    if graph:
+      return _graph_ahead_behind(_CommitNodes(self.git_repo, graph), id1, id2)
+    return self.git_repo.ahead_behind(id1, id2)
+
+  def ahead_behind_many(self, pairs):
+    """Return the ahead and behind counts of each (id1, id2) pair in pairs.
+
+    Instead of walking the history once per pair, all counts are computed in a
+    single walk that marks each commit with the set of given commits it's
+    reachable from, and that stops once all the commits left to walk are
+    reachable from all of them. With a commit-graph, commits are walked in
+    generation order. Without one, they are walked in commit time order (like
+    Git does, see _date_ahead_behind_many).
+    """
+    bits = {}
+    for oid in itertools.chain.from_iterable(pairs):
+      if oid not in bits:
+        bits[oid] = 1 << len(bits)
+    if not bits:
+      return []
+    graph = self.commit_graph
+    if not graph:
+      return _date_ahead_behind_many(self.git_repo, bits, pairs)
+    return _graph_ahead_behind_many(
+        _CommitNodes(self.git_repo, graph), bits, pairs)
+
+  @property
+  def commit_graph(self):
+    """The repository's CommitGraph (None if it doesn't have one).
+
+    The commit-graph is written with write_commit_graph. It is reloaded
+    whenever it changes.
+    """
+    stamp = _commit_graph_stamp(self.path)
+    if stamp != self._commit_graph_stamp:
+      self._commit_graph = load_commit_graph(self.path)
+      self._commit_graph_stamp = stamp
+    return self._commit_graph
+
+  def write_commit_graph(self):
+    """Write (or update) the commit-graph with all reachable commits.
+
+    The commit-graph is written incrementally: commits that are not in it yet
+    are added in a new layer of the commit-graph chain (that Git merges with the
+    existing ones when it gets too big), along with their changed-paths Bloom
+    filters.
+    """
+    try:
+      git('commit-graph', 'write', '--reachable', '--split', '--changed-paths')
+    except ErrorReturnCode as e:
+      raise TbdError(stderr(e))
+
+  def diff_commits(
+      self, c1, c2, paths=None, find_renames=False, max_bytes=None,
+      max_lines=None, opts=None):
+    """Return a generator of the patches between commits c1 and c2.
+
+    The diff is computed directly from the commits' trees, so the working
+    directory is never touched.
+
+    Args:
+      c1, c2: the commits to diff.
+      paths: if given, only files under these paths (relative to the repo root)
+        are diffed.
+      find_renames: if True, renamed files are detected.
+      max_bytes, max_lines: files that are binary or exceed these limits (see
+        diff_file) are not diffed, a DiffSummary is generated for them instead.
+      opts: the DiffOptions to use (defaults to diff_options()).
+    """
+    git_repo = self.git_repo
+    max_bytes, max_lines = self.diff_limits(max_bytes, max_lines)
+    opts = opts or self.diff_options()
+    flags = DIFF_ALGORITHMS[opts.algorithm]
+    if paths is not None:
+      paths = [_get_git_path(p).rstrip('/') for p in paths]
+      in_paths = lambda fp: any(
+          not p or p == '.' or fp == p or fp.startswith(p + '/')
+          for p in paths)
+
+    diff = c1.tree.diff_to_tree(c2.tree, flags, opts.context_lines)
+    if paths is not None and not find_renames:
+      self._fetch_missing_blobs(
+          diff, lambda d: in_paths(d.old_file.path) or in_paths(d.new_file.path))
+    else:  # detecting renames needs all blobs
+      self._fetch_missing_blobs(diff)
+    if find_renames:
+      diff.find_similar(pygit2.GIT_DIFF_FIND_RENAMES)
+    for i, delta in enumerate(diff.deltas):
+      old_fp, new_fp = delta.old_file.path, delta.new_file.path
+      if paths is not None and not (in_paths(old_fp) or in_paths(new_fp)):
+        continue
+      old_blob = _delta_blob(git_repo, delta.old_file)
+      new_blob = _delta_blob(git_repo, delta.new_file)
+      if (_blob_exceeds(old_blob, max_bytes, max_lines) or
+          _blob_exceeds(new_blob, max_bytes, max_lines)):
+        yield _blob_summary(old_fp, old_blob, new_fp, new_blob)
+      elif _diff_flags(opts, old_blob, new_blob) == flags:
+        yield diff[i]
+      else:  # too costly for the chosen algorithm, fall back to the default one
+        yield pygit2.Patch.create_from(
+            old_blob, new_blob, old_fp, new_fp, pygit2.GIT_DIFF_NORMAL,
+            opts.context_lines)
+
+  @property
+  def shallow_ids(self):
+    """The ids of the commits whose parents this repository doesn't have.
+
+    Only shallow repositories (see init_repository) have such commits.
+    """
+    try:
+      with io.open(os.path.join(self.path, 'shallow'), 'rb') as f:
+        return frozenset(
+            pygit2.Oid(hex=l.strip().decode('ascii'))
+            for l in f if l.strip())
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      return frozenset()
+
+  def fetch_missing_objects(self, ids):
+    """Fetch the objects with the given ids that are missing (all at once).
+
+    Objects can only be missing in partial clones (see init_repository), so
+    this is a no-op in other repositories.
+    """
+    promisor = self._promisor_remote()
+    if not promisor:
+      return
+    git_repo = self.git_repo
+    missing = sorted(set(str(i) for i in ids if i not in git_repo))
+    if not missing:
+      return
+    try:
+      git(
+          '-c', 'fetch.negotiationAlgorithm=noop', 'fetch', promisor,
+          '--no-tags', '--no-write-fetch-head', '--recurse-submodules=no',
+          '--filter=blob:none', '--stdin', _cwd=self.root,
+          _in='\n'.join(missing) + '\n')
+    except ErrorReturnCode as e:
+      raise TbdError(
+          'Failed to fetch missing objects from {0}: {1}'.format(
+              promisor, stderr(e)))
+
+  def _fetch_missing_blobs(self, diff, paths=None):
+    """Fetch the missing blobs of the given diff (see fetch_missing_objects).
+
+    Callers should check _promisor_remote before computing diffs only to pass
+    them here. If paths (a function) is given, only the blobs of the deltas for
+    which it returns True are fetched.
+    """
+    if not self._promisor_remote():
+      return
+    self.fetch_missing_objects(
+        f.id for delta in diff.deltas
+        if paths is None or paths(delta)
+        for f in (delta.old_file, delta.new_file)
+        if f.mode and f.mode != pygit2.GIT_FILEMODE_COMMIT)
+
+  def _promisor_remote(self):
+    """The name of the remote missing objects come from (or None).
+
+    It's only resolved once per Repository (i.e., once per operation).
+    """
+    if self._promisor is False:
+      self._promisor = None
+      for r in self.git_repo.remotes:
+        try:
+          if self.config.get_bool('remote.{0}.promisor'.format(r.name)):
+            self._promisor = r.name
+            break
+        except KeyError:
+          pass
+    return self._promisor
+
+  def map_remotes(self, fn, remotes=None):
+    """Call fn with each remote, with up to tbd.remoteWorkers of them at once.
+
+    fn is called from worker threads, so it should only talk to the remote
+    (e.g., through the fetch_session) and leave the objects of the repository
+    alone. Remotes default to all of the repository's remotes.
+
+    Returns:
+      a list of (remote, result, error) tuples sorted by remote name. Errors
+      are isolated: if fn fails for a remote, error is the TbdError and result
+      is None, the other remotes are not affected.
+    """
+    if remotes is None:
+      remotes = self.remotes
+    remotes = sorted(remotes, key=lambda r: r.name)
+
+    def call(r):
+      try:
+        return r, fn(r), None
+      except ErrorReturnCode as e:
+        return r, None, TbdError(stderr(e).strip())
+      except TbdError as e:
+        return r, None, e
+
+    workers = min(self._config_int('tbd.remoteWorkers', REMOTE_WORKERS),
+                  len(remotes))
+    if workers <= 1:
+      return [call(r) for r in remotes]
+    pool = ThreadPool(workers)
+    try:
+      return pool.map(call, remotes)
+    finally:
+      pool.close()
+      pool.join()
+
+  def cache(self, name):
+    """Return the Cache with the given name."""
+    return Cache(
+        os.path.join(self.path, CACHE_DIR, name),
+        self._config_int('tbd.cacheMaxBytes', CACHE_MAX_BYTES))
 
   def _fuse_commits_fp(self, b):
     return os.path.join(
@@ -174,6 +624,58 @@ class Repository(object):
   def _ref_target(self, ref):
     return self.git_repo.lookup_reference(ref).target
 
+  def _config_int(self, name, default):
+    try:
+      return self.config.get_int(name)
+    except KeyError:
+      return default
+
+  def diff_limits(self, max_bytes=None, max_lines=None):
+    """Return the byte and line limits past which files are not diffed.
+
+    Limits not given default to the tbd.diffMaxBytes and tbd.diffMaxLines config
+    values (or DIFF_MAX_BYTES and DIFF_MAX_LINES if these are not set).
+    """
+    if max_bytes is None:
+      max_bytes = self._config_int('tbd.diffMaxBytes', DIFF_MAX_BYTES)
+    if max_lines is None:
+      max_lines = self._config_int('tbd.diffMaxLines', DIFF_MAX_LINES)
+    return max_bytes, max_lines
+
+  def diff_options(self, algorithm=None, context_lines=None, max_file_cost=None):
+    """Return the DiffOptions to use for diffing files.
+
+    Args:
+      algorithm: one of DIFF_ALGORITHMS (defaults to the tbd.diffAlgorithm or
+        diff.algorithm config values, or myers).
+      context_lines: the number of lines of context to show around changes
+        (defaults to the diff.context config value, or DIFF_CONTEXT_LINES).
+      max_file_cost: files whose two versions add up to more than this many
+        bytes are diffed with the default (myers) algorithm, whichever the
+        algorithm given is (defaults to the tbd.diffMaxFileCost config value,
+        or DIFF_MAX_FILE_COST).
+    """
+    if algorithm is None:
+      for name in ('tbd.diffAlgorithm', 'diff.algorithm'):
+        if name in self.config:
+          algorithm = self.config[name]
+          break
+      else:
+        algorithm = 'myers'
+    if algorithm == 'default':  # that's how Git calls myers
+      algorithm = 'myers'
+    if algorithm not in DIFF_ALGORITHMS:
+      raise ValueError('Invalid diff algorithm {0}'.format(algorithm))
+    if context_lines is None:
+      context_lines = self._config_int('diff.context', DIFF_CONTEXT_LINES)
+    if context_lines < 0:
+      raise ValueError('Invalid number of context lines {0}'.format(
+          context_lines))
+    if max_file_cost is None:
+      max_file_cost = self._config_int(
+          'tbd.diffMaxFileCost', DIFF_MAX_FILE_COST)
+    return DiffOptions(algorithm, context_lines, max_file_cost)
+
 
   # Tag-related methods
 
@@ -245,6 +747,20 @@ class Repository(object):
     """
     return self.git_repo.listall_branches(pygit2.GIT_BRANCH_LOCAL)
 
+  def ref_snapshot(self):
+    """Return a RefSnapshot of the branches in this repository.
+
+    Use it instead of lookup_branch when going through many branches.
+    """
+    return RefSnapshot(self)
+
+  def ref_transaction(self, atomic=False):
+    """Return a RefTransaction to create and delete many branches and tags.
+
+    If atomic is True, either all of its changes are applied or none is.
+    """
+    return RefTransaction(self, atomic=atomic)
+
   def switch_current_branch(self, dst_b, move_over=False):
     """Switches to the given branch.
 
@@ -400,10 +916,157 @@ class Repository(object):
         restore_au_info()
 
     save(self.current_branch)
+    if self._promisor_remote():
+      self._fetch_missing_blobs(
+          git_repo.head.peel().tree.diff_to_tree(dst_b.head.tree))
     git_repo.checkout(dst_b.git_branch)
     restore(dst_b)
 
 
+class FetchSession(object):
+  """Network state of the remote operations done by a single tbd command.
+
+  Each remote is asked for its refs at most once, and each remote ref is
+  fetched at most once. Operations that change a remote (e.g., pushes) must
+  call refresh so that later lookups see the changes.
+
+  The refs remotes advertise are also kept in the remote-refs cache. Cached
+  advertisements younger than tbd.remoteRefsTtl seconds are used instead of
+  asking the remote again. In offline mode (tbd.offline) remotes are never
+  talked to: advertisements come from the cache, or from the remote-tracking
+  branches if there's none, and nothing is fetched.
+
+  Remotes are talked to in-process, through libgit2.
+
+  Attributes:
+    offline: True if the session is in offline mode.
+    ttl: max age (in seconds) of the cached advertisements to use.
+    progress: function that is called with pygit2's TransferProgress as
+      objects are fetched (or None).
+  """
+
+  def __init__(self, tbd_repo):
+    self.tbd_repo = tbd_repo
+    self.ttl = tbd_repo._config_int('tbd.remoteRefsTtl', REMOTE_REFS_TTL)
+    try:
+      self.offline = tbd_repo.config.get_bool('tbd.offline')
+    except KeyError:
+      self.offline = False
+    self.progress = None
+    self._cache = tbd_repo.cache('remote-refs')
+    self._advertised = {}
+    self._fetched = set()
+    # Remotes might be talked to from different threads (see
+    # Repository.map_remotes)
+    self._lock = threading.Lock()
+
+  def advertised_refs(self, remote):
+    """Return a dict of ref name -> id (hex) of the refs the remote has."""
+    if remote.name not in self._advertised:
+      refs = self._cached_refs(remote)
+      if refs is None and self.offline:
+        refs = dict(
+            ('refs/heads/' + n, str(oid)) for n, oid in _read_refs(
+                self.tbd_repo.path, 'refs/remotes/{0}/'.format(remote.name))
+            if isinstance(oid, pygit2.Oid))
+      elif refs is None:
+        refs = self._call(remote.name, _ls_remote)
+        self._cache.set(remote.name, json.dumps(
+            {'url': remote.url, 'time': time.time(), 'refs': refs}).encode(
+                'utf-8'))
+      with self._lock:
+        self._advertised[remote.name] = refs
+    return self._advertised[remote.name]
+
+  def fetch(self, remote_name, *refs):
+    """Fetch the given refs from the remote unless they were already fetched.
+
+    Refs are branch names, whose remote-tracking branches are updated ('*'
+    for all branches), or full ref names (e.g., refs/tags/v1), of which only
+    the objects are fetched.
+    Nothing is fetched in offline mode.
+    """
+    if self.offline:
+      return
+    missing = [r for r in refs if (remote_name, r) not in self._fetched]
+    if not missing:
+      return
+    refspecs = [
+        r if r.startswith('refs/') else
+        '+refs/heads/{0}:refs/remotes/{1}/{0}'.format(r, remote_name)
+        for r in missing]
+
+    def fetch(git_remote, callbacks):
+      if _uses_ssh(git_remote.url):
+        git(
+            'fetch', '--no-tags', '--no-write-fetch-head',
+            '--recurse-submodules=no', remote_name, *refspecs,
+            _cwd=self.tbd_repo.root)
+        return
+      git_remote.fetch(refspecs, callbacks=callbacks, proxy=True)
+      # Unlike git fetch, libgit2 creates local tags for the remote tags that
+      # point to what was fetched. We don't want that
+      if callbacks.created_tags:
+        references = pygit2.Repository(self.tbd_repo.path).references
+        for t in callbacks.created_tags:
+          references.delete(t)
+
+    self._call(remote_name, fetch)
+    self.mark_fetched(remote_name, missing)
+
+  def is_fetched(self, remote_name, ref):
+    """True if the given ref (see fetch) is up to date in this session."""
+    return (remote_name, ref) in self._fetched
+
+  def mark_fetched(self, remote_name, refs):
+    """Record that the given refs (see fetch) are up to date."""
+    with self._lock:
+      self._fetched.update((remote_name, r) for r in refs)
+
+  def refresh(self, remote_name=None):
+    """Forget what was learned from the given remote (or from all remotes).
+
+    Cached advertisements are dropped as well.
+    """
+    with self._lock:
+      if remote_name is None:
+        self._advertised.clear()
+        self._fetched.clear()
+        self._cache.clear()
+        return
+      self._advertised.pop(remote_name, None)
+      self._fetched = set(
+          (rn, r) for rn, r in self._fetched if rn != remote_name)
+      self._cache.delete(remote_name)
+
+  def _call(self, remote_name, op):
+    # Each call gets its own pygit2 repository so that remotes can be talked
+    # to from different threads
+    git_remote = pygit2.Repository(self.tbd_repo.path).remotes[remote_name]
+    try:
+      return op(git_remote, _RemoteCallbacks(progress=self.progress))
+    except pygit2.GitError as e:
+      raise TbdError(
+          'Remote {0} failed: {1}'.format(remote_name, e))
+    except ErrorReturnCode as e:
+      raise TbdError(
+          'Remote {0} failed: {1}'.format(remote_name, stderr(e)))
+
+  def _cached_refs(self, remote):
+    data = self._cache.get(remote.name)
+    if data is None:
+      return None
+    try:
+      entry = json.loads(data.decode('utf-8'))
+    except ValueError:  # corrupted entry
+      return None
+    if entry.get('url') != remote.url:  # the remote was changed
+      return None
+    if not self.offline and not 0 <= time.time() - entry['time'] < self.ttl:
+      return None
+    return entry['refs']
+
+
 class RemoteCollection(object):
 
   def __init__(self, git_remote_collection, tbd_repo):
@@ -435,7 +1098,10 @@ class RemoteCollection(object):
 
     # Check that the given url corresponds to a git repo
     try:
-      git('ls-remote', '--heads', url)
+      _ls_remote(
+          self.git_remote_collection.create_anonymous(url), _RemoteCallbacks())
+    except pygit2.GitError as e:
+      raise ValueError(str(e))
     except ErrorReturnCode as e:
       raise ValueError(stderr(e))
 
@@ -467,17 +1133,9 @@ class Remote(object):
       raise TbdError(
           'Branch {0} already exists in remote repository {1}'.format(
               name, self.name))
-    # Push won't let us push the creation of a new branch from a SHA. So we
-    # create a temporary local ref, make it point to the commit, and do the
-    # push
-    tmp_b = self.tbd_repo.create_branch('tbd_tmp_ref', head)
-    try:
-      git.push(self.name, '{0}:{1}'.format(tmp_b, name))
-      return self.lookup_branch(name)
-    except ErrorReturnCode as e:
-      raise TbdError(stderr(e))
-    finally:
-      tmp_b.delete()
+    _push(self.tbd_repo, self.name, [
+        '{0}:refs/heads/{1}'.format(head.id, name)])
+    return self.lookup_branch(name)
 
   def listall_branches(self):
     """Return a list with the names of all the branches in this repository.
@@ -485,18 +1143,62 @@ class Remote(object):
     Use lookup_branch if you want to get the RemoteBranch object corresponding
     to each name.
     """
-    regex = re.compile(r'.*\trefs/heads/(.*)')
-    for head in stdout(git('ls-remote', '--heads', self.name)).splitlines():
-      yield regex.match(head).group(1)
+    for ref_name in self._advertised_refs():
+      if ref_name.startswith('refs/heads/'):
+        yield ref_name[len('refs/heads/'):]
 
   def lookup_branch(self, branch_name):
-    if not stdout(git('ls-remote', '--heads', self.name, branch_name)):
-      return None
-    # The branch exists in the remote
-    git.fetch(self.git_remote.name, branch_name)
-    git_branch = self.tbd_repo.git_repo.lookup_branch(
-        self.git_remote.name + '/' + branch_name, pygit2.GIT_BRANCH_REMOTE)
-    return RemoteBranch(git_branch, self.tbd_repo)
+    ret = self.lookup_branches([branch_name])
+    return ret[0] if ret else None
+
+  def lookup_branches(self, branch_names):
+    """Return the RemoteBranches with the given names.
+
+    All branches are fetched at once (see fetch_branches). Names of branches
+    that don't exist in the remote are skipped.
+    """
+    refs = self._advertised_refs()
+    branch_names = [n for n in branch_names if 'refs/heads/' + n in refs]
+    self.fetch_branches(branch_names)
+    git_repo = self.tbd_repo.git_repo
+    ret = []
+    for n in branch_names:
+      git_branch = git_repo.lookup_branch(
+          self.git_remote.name + '/' + n, pygit2.GIT_BRANCH_REMOTE)
+      if git_branch:  # might have never been fetched if we are offline
+        ret.append(RemoteBranch(git_branch, self.tbd_repo))
+    return ret
+
+  def fetch_branches(self, branch_names):
+    """Fetch the given branches (all at once).
+
+    Branches already fetched in this session or whose remote-tracking branch
+    is already at the commit the remote advertises are not fetched again (so
+    RemoteBranches looked up through lookup_branches are up to date already).
+    This only talks to the remote and reads ref files, so it's safe to use from
+    Repository.map_remotes.
+    """
+    session = self.tbd_repo.fetch_session
+    refs = self._advertised_refs()
+    branch_names = [
+        n for n in branch_names
+        if 'refs/heads/' + n in refs and not session.is_fetched(self.name, n)]
+    if not branch_names:
+      return
+    tracking = dict(
+        (n, str(target)) for n, target in _read_refs(
+            self.tbd_repo.path, 'refs/remotes/{0}/'.format(self.name)))
+    stale = [
+        n for n in branch_names if tracking.get(n) != refs['refs/heads/' + n]]
+    heads = sum(1 for r in refs if r.startswith('refs/heads/'))
+    if stale and 2 * len(stale) > heads:
+      # libgit2 matches each refspec against each advertised ref, so it's
+      # cheaper to fetch all branches with a single refspec
+      session.fetch(self.name, '*')
+    else:
+      session.fetch(self.name, *stale)
+    # The others were already up to date
+    session.mark_fetched(self.name, branch_names)
 
 
   # Tag-related methods
@@ -506,17 +1208,9 @@ class Remote(object):
       raise TbdError(
           'Tag {0} already exists in remote repository {1}'.format(
               name, self.name))
-    # We can't create a tag in a remote without creating a local one first. So
-    # we create a temporary local ref, make it point to the commit, and do the
-    # push
-    tmp_t = self.tbd_repo.create_tag('tbd_tmp_ref', commit)
-    try:
-      git.push(self.name, 'refs/tags/{0}:refs/tags/{1}'.format(tmp_t, name))
-      return self.lookup_tag(name)
-    except ErrorReturnCode as e:
-      raise TbdError(stderr(e))
-    finally:
-      tmp_t.delete()
+    _push(self.tbd_repo, self.name, [
+        '{0}:refs/tags/{1}'.format(commit.id, name)])
+    return self.lookup_tag(name)
 
   def listall_tags(self):
     """Return a list with the names of all tags in this repository.
@@ -524,25 +1218,41 @@ class Remote(object):
     Use lookup_tag if you want to get the RemoteTag object corresponding
     to each name.
     """
-    regex = re.compile(r'.*\trefs/tags/(.*)')
-    for head in stdout(git('ls-remote', '--tags', self.name)).splitlines():
-      tag_name = regex.match(head).group(1)
-      if tag_name.endswith('^{}'):
-        continue
-      yield tag_name
+    for ref_name in self._advertised_refs():
+      if ref_name.startswith('refs/tags/') and not ref_name.endswith('^{}'):
+        yield ref_name[len('refs/tags/'):]
 
   def lookup_tag(self, tag_name):
-    tag_info = stdout(git('ls-remote', '--tags', self.name, tag_name))
-    if not tag_info:
-      return None
-    # The tag exists in the remote
-    git.fetch(self.git_remote.name, tag_name)
+    ret = self.lookup_tags([tag_name])
+    return ret[0] if ret else None
 
-    regex = re.compile(r'(.*)\trefs/tags/.*')
-    commit_id = regex.match(tag_info).group(1)
-    commit = self.tbd_repo.git_repo.get(commit_id).peel(pygit2.GIT_OBJ_COMMIT)
+  def lookup_tags(self, tag_names):
+    """Return the RemoteTags with the given names.
 
-    return RemoteTag(self.git_remote.name, tag_name, commit)
+    The commits tags point to are read from the remote's advertisement (for
+    annotated tags, it includes the peeled refs/tags/name^{} ref), so only the
+    tags whose commit we don't have are fetched, all at once. Names of tags
+    that don't exist in the remote are skipped.
+    """
+    refs = self._advertised_refs()
+    commit_ids = collections.OrderedDict(
+        (n, refs.get('refs/tags/{0}^{{}}'.format(n), refs['refs/tags/' + n]))
+        for n in tag_names if 'refs/tags/' + n in refs)
+    git_repo = self.tbd_repo.git_repo
+    self.tbd_repo.fetch_session.fetch(self.name, *(
+        'refs/tags/' + n for n, ci_id in commit_ids.items()
+        if ci_id not in git_repo))
+    ret = []
+    for n, ci_id in commit_ids.items():
+      obj = git_repo.get(ci_id)
+      if obj:  # might have never been fetched if we are offline
+        ret.append(RemoteTag(
+            self.git_remote.name, n, obj.peel(pygit2.GIT_OBJ_COMMIT),
+            self.tbd_repo))
+    return ret
+
+  def _advertised_refs(self):
+    return self.tbd_repo.fetch_session.advertised_refs(self)
 
 
 class RemoteTag(object):
@@ -555,16 +1265,15 @@ class RemoteTag(object):
     commit: the commit this tag labels.
   """
 
-  def __init__(self, remote_name, tag_name, commit):
+  def __init__(self, remote_name, tag_name, commit, tbd_repo):
     self.remote_name = remote_name
     self.tag_name = tag_name
     self.commit = commit
+    self.tbd_repo = tbd_repo
 
   def delete(self):
-    try:
-      git.push(self.remote_name, ':{0}'.format(self.tag_name))
-    except ErrorReturnCode as e:
-      raise TbdError(stderr(e))
+    _push(self.tbd_repo, self.remote_name, [
+        ':refs/tags/{0}'.format(self.tag_name)])
 
   def __str__(self):
     return self.remote_name + '/' + self.tag_name
@@ -587,10 +1296,8 @@ class RemoteBranch(object):
     self.branch_name = self.git_branch.branch_name[len(self.remote_name) + 1:]
 
   def delete(self):
-    try:
-      git.push(self.remote_name, ':{0}'.format(self.branch_name))
-    except ErrorReturnCode as e:
-      raise TbdError(stderr(e))
+    _push(self.tbd_repo, self.remote_name, [
+        ':refs/heads/{0}'.format(self.branch_name)])
 
   @property
   def target(self):
@@ -603,11 +1310,42 @@ class RemoteBranch(object):
     self._update()
     return self.git_branch.peel()
 
-  def history(self, reverse=False):
-    return walker(self.tbd_repo.git_repo, self.target, reverse=reverse)
+  def history(
+      self, reverse=False, stream=False, paths=None, after=None, since=None,
+      until=None, author=None, first_parent=False):
+    """Return the commits of this branch, newest first.
+
+    If stream is True, commits are generated as the history is walked instead
+    of after having sorted all of it (see stream_walker). If paths (relative to
+    the repo root) are given, only the commits that changed any of them are
+    generated. If a HistoryCursor is given in after, the (streamed) history is
+    resumed from it. See commit_filter for since, until and author. If
+    first_parent is True, only the first parent of merge commits is followed.
+    """
+    git_repo = self.tbd_repo.git_repo
+    graph = self.tbd_repo.commit_graph
+    if paths and any(p in ('', '.') for p in paths):
+      paths = None
+    if (stream or after) and not reverse:
+      return stream_walker(
+          git_repo, self.target, graph=graph, after=after, paths=paths,
+          since=since, until=until, author=author, first_parent=first_parent)
+    ret = walker(
+        git_repo, self.target, reverse=reverse, first_parent=first_parent)
+    if since is not None or until is not None or author:
+      # The walk might be reversed so we can't stop early
+      ret = commit_filter(
+          ret, since=since, until=until, author=author,
+          is_past_since=lambda ci: False)
+    if paths:
+      ret = _path_filter(git_repo, ret, paths, graph)
+    return ret
 
   def _update(self):
-    git.fetch(self.remote_name, self.branch_name)
+    if self.tbd_repo.fetch_session.is_fetched(
+        self.remote_name, self.branch_name):
+      return  # it's already as up to date as it can be in this session
+    self.tbd_repo.remotes[self.remote_name].fetch_branches([self.branch_name])
     self.git_branch = self.tbd_repo.git_repo.lookup_branch(
         self.remote_name + '/' + self.branch_name, pygit2.GIT_BRANCH_REMOTE)
 
@@ -683,11 +1421,51 @@ class Branch(object):
     self.git_branch = self.tbd_repo.git_repo.lookup_branch(
         self.branch_name, pygit2.GIT_BRANCH_LOCAL)
 
-  def history(self, reverse=False):
-    return walker(self.tbd_repo.git_repo, self.target, reverse=reverse)
-
-  def diff_commits(self, c1, c2):
-    return c1.tree.diff_to_tree(c2.tree)
+  def history(
+      self, reverse=False, stream=False, paths=None, after=None, since=None,
+      until=None, author=None, first_parent=False):
+    """Return the commits of this branch, newest first.
+
+    If stream is True, commits are generated as the history is walked instead
+    of after having sorted all of it (see stream_walker). If paths (relative to
+    the repo root) are given, only the commits that changed any of them are
+    generated. If a HistoryCursor is given in after, the (streamed) history is
+    resumed from it. See commit_filter for since, until and author. If
+    first_parent is True, only the first parent of merge commits is followed.
+    """
+    git_repo = self.tbd_repo.git_repo
+    graph = self.tbd_repo.commit_graph
+    if paths and any(p in ('', '.') for p in paths):
+      paths = None
+    if (stream or after) and not reverse:
+      return stream_walker(
+          git_repo, self.target, graph=graph, after=after, paths=paths,
+          since=since, until=until, author=author, first_parent=first_parent)
+    ret = walker(
+        git_repo, self.target, reverse=reverse, first_parent=first_parent)
+    if since is not None or until is not None or author:
+      # The walk might be reversed so we can't stop early
+      ret = commit_filter(
+          ret, since=since, until=until, author=author,
+          is_past_since=lambda ci: False)
+    if paths:
+      ret = _path_filter(git_repo, ret, paths, graph)
+    return ret
+
+  def diff_commits(self, c1, c2, **kwargs):
+    """See Repository.diff_commits."""
+    return self.tbd_repo.diff_commits(c1, c2, **kwargs)
+
+  def diff_commits_stats(self, c1, c2):
+    """Return the number of files changed, insertions and deletions.
+
+    The line statistics are computed by libgit2 without building the patches'
+    hunks, so this is much cheaper than going through diff_commits.
+    """
+    diff = c1.tree.diff_to_tree(c2.tree)
+    self.tbd_repo._fetch_missing_blobs(diff)
+    stats = diff.stats
+    return stats.files_changed, stats.insertions, stats.deletions
 
   def __str__(self):
     return self.branch_name
@@ -895,8 +1673,12 @@ class Branch(object):
         except OSError as exc: # guard against race condition
           if exc.errno != errno.EEXIST:
             raise
+      # We write the blob in chunks out of its buffer to avoid copying the
+      # entire contents of (potentially huge) files into memory
+      buf = memoryview(o)
       with io.open(full_path, mode='wb') as dst:
-        dst.write(o.data)
+        for start in range(0, len(buf), _CHUNK_LEN):
+          dst.write(buf[start:start + _CHUNK_LEN])
 
       # So as to not get confused with the status of the file we also add it.
       # This prevents getting into a situation in which the staged version is
@@ -930,26 +1712,109 @@ class Branch(object):
       else:
         yield tree_entry_path
 
-  def diff_file(self, path):
-    """Diff the working version of path with its committed version."""
+  def diff_file(self, path, max_bytes=None, max_lines=None, opts=None):
+    """Diff the working version of path with its committed version.
+
+    If any of the two versions is binary or exceeds max_bytes or max_lines
+    (which default to the tbd.diffMaxBytes and tbd.diffMaxLines config values)
+    the file is not diffed and a DiffSummary is returned instead of a patch.
+    The diff algorithm and context can be customized by giving the DiffOptions
+    to use in opts (see Repository.diff_options).
+    """
     _check_path_is_repo_relative(path)
 
     git_repo = self.tbd_repo.git_repo
     git_path = _get_git_path(path)
+    max_bytes, max_lines = self.tbd_repo.diff_limits(max_bytes, max_lines)
+    opts = opts or self.tbd_repo.diff_options()
     try:
-      blob_at_head = git_repo[git_repo.head.peel().tree[git_path].id]
+      blob_id = git_repo.head.peel().tree[git_path].id
+      self.tbd_repo.fetch_missing_objects([blob_id])
+      blob_at_head = git_repo[blob_id]
     except KeyError:  # no blob at head
-      wt_blob = git_repo[git_repo.create_blob_fromworkdir(git_path)]
-      nil_blob = git_repo[git_repo.create_blob('')]
-      return nil_blob.diff(wt_blob, 0, git_path, git_path)
+      blob_at_head = None
+
+    full_path = os.path.join(self.tbd_repo.root, path)
+    wt_exists = os.path.isfile(full_path)
+    if not blob_at_head and not wt_exists:
+      raise KeyError(path)
+
+    if (_blob_exceeds(blob_at_head, max_bytes, max_lines) or
+        (wt_exists and _wd_file_exceeds(full_path, max_bytes, max_lines))):
+      return _wd_summary(git_path, blob_at_head, full_path, wt_exists)
+
+    nil_blob = git_repo[git_repo.create_blob('')]
+    old_blob = blob_at_head or nil_blob
+    if wt_exists:
+      new_blob = git_repo[git_repo.create_blob_fromworkdir(git_path)]
+    else:  # the file was deleted
+      new_blob = nil_blob
+    return pygit2.Patch.create_from(
+        old_blob, new_blob, git_path, git_path,
+        _diff_flags(opts, old_blob, new_blob), opts.context_lines)
+
+  def diff_stats(self, paths, max_bytes=None, max_lines=None, opts=None):
+    """Return a generator of (path, patch) for the given paths that changed.
+
+    Like with diff_file, the working version of each path is diffed with its
+    committed version (and a DiffSummary is generated for files that exceed
+    the limits), but all paths are diffed at once, in a single diff of the
+    working directory with the head tree. Changes with no lines added or
+    removed (e.g., mode changes or empty files) are included. The patches are
+    meant for their line_stats only, their hunks are never built. The patch is
+    None for paths that exist neither at head nor in the working directory.
+    """
+    for path in paths:
+      _check_path_is_repo_relative(path)
 
-    try:
-      wt_blob = git_repo[git_repo.create_blob_fromworkdir(git_path)]
-    except KeyError:  # no blob at wd (the file was deleted)
-      nil_blob = git_repo[git_repo.create_blob('')]
-      return blob_at_head.diff(nil_blob, 0, git_path, git_path)
+    git_repo = self.tbd_repo.git_repo
+    max_bytes, max_lines = self.tbd_repo.diff_limits(max_bytes, max_lines)
+    opts = opts or self.tbd_repo.diff_options()
+    flags = DIFF_ALGORITHMS[opts.algorithm]
+    git_paths = dict((_get_git_path(p), p) for p in paths)
+    head_tree = git_repo.head.peel().tree
+    diff = head_tree.diff_to_workdir(
+        flags | pygit2.GIT_DIFF_INCLUDE_UNTRACKED |
+        pygit2.GIT_DIFF_RECURSE_UNTRACKED_DIRS |
+        pygit2.GIT_DIFF_SHOW_UNTRACKED_CONTENT, opts.context_lines)
+    deltas = [
+        (i, delta) for i, delta in enumerate(diff.deltas)
+        if delta.new_file.path in git_paths]
+    self.tbd_repo.fetch_missing_objects(
+        delta.old_file.id for _, delta in deltas
+        if _delta_blob_exists(delta.old_file))
+
+    for i, delta in deltas:
+      git_path = delta.new_file.path
+      full_path = os.path.join(self.tbd_repo.root, git_paths[git_path])
+      wt_exists = bool(delta.new_file.mode)
+      old_blob = _delta_blob(git_repo, delta.old_file)
+      if (_blob_exceeds(old_blob, max_bytes, max_lines) or
+          (wt_exists and _wd_file_exceeds(full_path, max_bytes, max_lines))):
+        patch = _wd_summary(git_path, old_blob, full_path, wt_exists)
+      elif (flags != pygit2.GIT_DIFF_NORMAL and
+            (old_blob.size if old_blob else 0) + delta.new_file.size >
+            opts.max_file_cost):
+        # Too costly for the chosen algorithm, fall back to the default one
+        # (like diff_file, with blobs since patches don't keep buffers alive)
+        new_blob = None
+        if wt_exists:
+          new_blob = git_repo[git_repo.create_blob_fromworkdir(git_path)]
+        patch = pygit2.Patch.create_from(
+            old_blob, new_blob, git_path, git_path, pygit2.GIT_DIFF_NORMAL,
+            opts.context_lines)
+      else:
+        patch = diff[i]
+      yield git_paths.pop(git_path), patch
 
-    return blob_at_head.diff(wt_blob, 0, git_path, git_path)
+    # What's left is unchanged, ignored or non-existent
+    for git_path, path in sorted(git_paths.items()):
+      if git_path in head_tree:
+        continue
+      if os.path.isfile(os.path.join(self.tbd_repo.root, path)):
+        yield path, self.diff_file(path, max_bytes, max_lines, opts)
+      else:
+        yield path, None
 
 
   # Merge-related methods
@@ -1152,6 +2017,9 @@ class Branch(object):
   def _safe_reset(self, cid, msg_fn, save_fn=None):
     git_repo = self.tbd_repo.git_repo
     tree = git_repo[cid].tree
+    if self.tbd_repo._promisor_remote():
+      self.tbd_repo._fetch_missing_blobs(
+          git_repo.head.peel().tree.diff_to_tree(tree))
     try:
       git_repo.checkout_tree(tree)
     except pygit2.GitError:  # conflicts prevent checkout
@@ -1260,21 +2128,22 @@ class Branch(object):
           'Can\'t publish to a local branch (yet---this will be implemented in '
           'the future)')
 
+    assert self.branch_name.strip()
+    # We want to compare with what the remote has right now
+    self.tbd_repo.fetch_session.refresh(branch.remote_name)
+    remote = self.tbd_repo.remotes[branch.remote_name]
+    remote_id = self.tbd_repo.fetch_session.advertised_refs(remote).get(
+        'refs/heads/' + branch.branch_name)
+    assert remote_id
+    if remote_id == str(self.target):
+      raise TbdError('No commits to publish')
+
     try:
-      assert self.branch_name.strip()
-      assert branch.branch_name in self.tbd_repo.remotes[
-          branch.remote_name].listall_branches()
-
-      cmd = git.push(
-          branch.remote_name,
-          '{0}:{1}'.format(self.branch_name, branch.branch_name))
-      if 'Everything up-to-date' in stderr(cmd):
-        raise TbdError('No commits to publish')
-    except ErrorReturnCode as e:
-      err_msg = stderr(e)
-      if 'Updates were rejected' in err_msg:
-        raise TbdError('There are changes you need to fuse/merge')
-      raise TbdError(err_msg)
+      _push(self.tbd_repo, branch.remote_name, [
+          'refs/heads/{0}:refs/heads/{1}'.format(
+              self.branch_name, branch.branch_name)])
+    except _NonFastForwardError:
+      raise TbdError('There are changes you need to fuse/merge')
 
 
   # Branch helpers
@@ -1310,6 +2179,595 @@ class Tag(object):
     return self.tag_name
 
 
+class RefTransaction(object):
+  """A batch of branch and tag creations and deletions, applied at once.
+
+  Changes are queued until commit, which applies them all with a single git
+  update-ref (so the locks of all refs are taken together and packed-refs is
+  rewritten at most once, instead of once per deleted ref).
+
+  Attributes:
+    atomic: if True, either all changes are applied or none is.
+  """
+
+  def __init__(self, tbd_repo, atomic=False):
+    self.tbd_repo = tbd_repo
+    self.atomic = atomic
+    self._changes = []  # (kind, name, target), target is None for deletions
+
+  def create_branch(self, name, head):
+    """Queue the creation of branch name with head (a commit or its id)."""
+    self._changes.append(('branch', name, _commit_id(head)))
+
+  def delete_branch(self, name):
+    self._changes.append(('branch', name, None))
+
+  def create_tag(self, name, commit):
+    """Queue the creation of tag name for commit (a commit or its id)."""
+    self._changes.append(('tag', name, _commit_id(commit)))
+
+  def delete_tag(self, name):
+    self._changes.append(('tag', name, None))
+
+  def commit(self):
+    """Apply the queued changes.
+
+    Returns:
+      an OrderedDict with the (kind, name) of the changes that can't be
+      applied (e.g., because the branch to create already exists or the branch
+      to delete is the current one), kind being 'branch' or 'tag', and the
+      error (a ValueError or BranchIsCurrentError) why. These changes are
+      skipped, or if the transaction is atomic, nothing is applied.
+    """
+    git_repo = self.tbd_repo.git_repo
+    current = None
+    if any(k == 'branch' and t is None for k, _, t in self._changes):
+      current = self.tbd_repo.current_branch.branch_name
+    errors = collections.OrderedDict()
+    changes = collections.Counter((k, n) for k, n, _ in self._changes)
+    valid_changes = []  # (kind, ref, new target or None, old target)
+    deleted_branches = []
+    for kind, name, target in self._changes:
+      ref = '{0}/{1}'.format(
+          'refs/heads' if kind == 'branch' else 'refs/tags', name)
+      if changes[kind, name] > 1:
+        errors[kind, name] = ValueError(
+            '{0} {1} can only be changed once'.format(kind, name))
+        continue
+      valid = pygit2.reference_is_valid_name(ref)
+      exists = valid and ref in git_repo.references
+      if target is not None:
+        if not valid:
+          errors[kind, name] = ValueError(
+              'the given {0} name \'{1}\' is not valid'.format(kind, name))
+        elif exists:
+          errors[kind, name] = ValueError(
+              'a {0} with name {1} already exists'.format(kind, name))
+        else:
+          valid_changes.append((kind, ref, target, None))
+      elif not exists:
+        errors[kind, name] = ValueError(
+            '{0} {1} doesn\'t exist'.format(kind, name))
+      elif kind == 'branch' and name == current:
+        errors[kind, name] = BranchIsCurrentError(
+            'Can\'t delete the current branch')
+      else:
+        old = git_repo.references[ref].target
+        valid_changes.append(
+            (kind, ref, None, old if isinstance(old, pygit2.Oid) else ''))
+        if kind == 'branch':
+          deleted_branches.append(name)
+    self._changes = []
+    if not valid_changes or (errors and self.atomic):
+      return errors
+
+    # Only now that we know the changes are applied we write the tag objects
+    lines = []
+    for kind, ref, target, old in valid_changes:
+      if target is None:
+        lines.append('delete {0} {1}\n'.format(ref, old))
+        continue
+      if kind == 'tag':
+        target = _write_tag_object(git_repo, ref[len('refs/tags/'):], target)
+      lines.append('create {0} {1}\n'.format(ref, target))
+    try:
+      git('update-ref', '--stdin', _cwd=self.tbd_repo.root, _in=''.join(lines))
+    except ErrorReturnCode as e:
+      raise TbdError(stderr(e))
+    if deleted_branches:
+      _cleanup_deleted_branches(self.tbd_repo, deleted_branches)
+    return errors
+
+
+class RefSnapshot(object):
+  """Point-in-time view of a repository's (local) branches.
+
+  The loose and packed refs, HEAD and the branches' upstream config are read
+  once, when the snapshot is created, so that listing many branches doesn't
+  need to go to disk (and to libgit2) again for each one of them. The snapshot
+  doesn't see changes made after it was taken.
+
+  Attributes:
+    current: the name of the current branch (None if there's no current
+      branch).
+    trunk: the name of the trunk branch (None if there's no such branch).
+  """
+
+  def __init__(self, tbd_repo):
+    self.tbd_repo = tbd_repo
+    git_dir = tbd_repo.path
+    common_dir = _common_dir(git_dir)
+    packed = _read_packed_refs(common_dir)
+    self._targets = _strip_ref_prefix(packed, 'refs/heads/')
+    self._targets.update(_read_loose_refs(common_dir, 'refs/heads/'))
+    # Remote branches are only read to check and get the targets of upstreams
+    self._remote_targets = _strip_ref_prefix(packed, 'refs/remotes/')
+    self._remote_targets.update(_read_loose_refs(common_dir, 'refs/remotes/'))
+
+    self.current = None
+    head = _read_ref_file(os.path.join(git_dir, 'HEAD'))
+    fuse_orig_head_fp = os.path.join(git_dir, 'TBD_FUSE_ORIG_HEAD')
+    if not head.startswith('ref: ') and os.path.exists(fuse_orig_head_fp):
+      # Detached because of a fuse, see Repository.current_branch
+      head = _read_ref_file(fuse_orig_head_fp)
+    if head.startswith('ref: refs/heads/'):
+      self.current = head[len('ref: refs/heads/'):]
+
+    self._upstreams = _read_upstreams(tbd_repo.config)
+    try:
+      trunk = tbd_repo.config['tbd.trunk']
+    except KeyError:
+      trunk = TRUNK
+    self.trunk = trunk if trunk in self._targets else None
+
+  def __len__(self):
+    return len(self._targets)
+
+  def __contains__(self, branch_name):
+    return branch_name in self._targets
+
+  def listall_branches(self):
+    """Return a sorted list with the names of all the branches."""
+    return sorted(self._targets)
+
+  def is_current(self, branch_name):
+    return branch_name == self.current
+
+  def target(self, branch_name):
+    """Object Id of the commit the given branch points to."""
+    target = self._targets[branch_name]
+    if isinstance(target, pygit2.Oid):
+      return target
+    # A symbolic ref
+    ret = self.tbd_repo.git_repo.lookup_reference(target).resolve().target
+    self._targets[branch_name] = ret
+    return ret
+
+  def head(self, branch_name):
+    """The commit that is the head of the given branch."""
+    return self.tbd_repo.git_repo[self.target(branch_name)]
+
+  def upstream(self, branch_name):
+    """The name of the upstream of the given branch (None if there's none).
+
+    The name is remote/branch if the upstream is a remote branch. Like in
+    libgit2, an upstream whose branch (or remote-tracking ref) no longer exists
+    is reported as None.
+    """
+    remote, merge = self._upstreams.get(branch_name, (None, None))
+    if not remote or not merge or not merge.startswith('refs/heads/'):
+      return None
+    upstream = merge[len('refs/heads/'):]
+    if remote == '.':
+      return upstream if upstream in self._targets else None
+    upstream = remote + '/' + upstream
+    return upstream if upstream in self._remote_targets else None
+
+  def divergence(self, branch_names=None):
+    """Return how the given branches diverge from their upstream and trunk.
+
+    The result maps each branch name to a list of Divergences, the one with
+    the branch's upstream first. Upstreams that are remote branches are
+    compared as of the last time they were fetched. If no branch names are
+    given, all branches are included. All counts are computed in a single walk
+    of the history (see Repository.ahead_behind_many).
+    """
+    if branch_names is None:
+      branch_names = self.listall_branches()
+    others = {}
+    pairs = []
+    for n in branch_names:
+      others[n] = []
+      for other in (self.upstream(n), self.trunk):
+        if not other or other == n or other in (o for o, _ in others[n]):
+          continue
+        other_target = self._other_target(other)
+        if other_target is None:
+          continue
+        others[n].append((other, other_target))
+        pairs.append((self.target(n), other_target))
+
+    counts = iter(self.tbd_repo.ahead_behind_many(pairs))
+    ret = collections.OrderedDict()
+    for n in branch_names:
+      ret[n] = [
+          Divergence(other, *next(counts)) for other, _ in others[n]]
+    return ret
+
+  def _other_target(self, name):
+    if name in self._targets:
+      return self.target(name)
+    target = self._remote_targets.get(name)
+    if target is None or isinstance(target, pygit2.Oid):
+      return target
+    return self.tbd_repo.git_repo.lookup_reference(target).resolve().target
+
+
+# Atomically replaces a file with another one (os.rename doesn't overwrite the
+# destination on Windows, but Python 2 has no os.replace)
+_replace = getattr(os, 'replace', os.rename)
+
+
+class Cache(object):
+  """Size-bounded on-disk LRU cache of byte strings.
+
+  Each entry is stored in its own file. Reading an entry bumps its mtime, so
+  that when the cache grows over max_bytes the least recently used entries are
+  the first to be evicted.
+
+  Attributes:
+    path: absolute path to the dir where entries are stored.
+    max_bytes: the maximum size of the cache.
+  """
+
+  def __init__(self, path, max_bytes):
+    self.path = path
+    self.max_bytes = max_bytes
+    self._size = None  # computed lazily on the first write
+    self._lock = threading.Lock()  # entries can be set from many threads
+
+  def get(self, key):
+    """Return the data stored under key (or None if there's none)."""
+    fp = self._entry_fp(key)
+    try:
+      with io.open(fp, mode='rb') as f:
+        data = f.read()
+      os.utime(fp, None)
+      return data
+    except (IOError, OSError):
+      return None
+
+  def set(self, key, data):
+    fp = self._entry_fp(key)
+    dirname = os.path.dirname(fp)
+    if not os.path.exists(dirname):
+      try:
+        os.makedirs(dirname)
+      except OSError as exc:  # guard against race condition
+        if exc.errno != errno.EEXIST:
+          raise
+    # We write to a tmp file and then atomically rename it in place so that
+    # concurrent readers never see a partially written entry
+    tmp_fp = '{0}.{1}.{2}.tmp'.format(
+        fp, os.getpid(), threading.current_thread().ident)
+    with io.open(tmp_fp, mode='wb') as f:
+      f.write(data)
+    with self._lock:
+      old_size = self._file_size(fp)
+      _replace(tmp_fp, fp)
+      if self._size is None:
+        self._size = sum(size for _, _, size in self._entries())
+      else:
+        self._size += len(data) - old_size
+      if self._size > self.max_bytes:
+        self._evict()
+
+  def delete(self, key):
+    fp = self._entry_fp(key)
+    with self._lock:
+      size = self._file_size(fp)
+      try:
+        os.remove(fp)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+        return
+      if self._size is not None:
+        self._size -= size
+
+  def clear(self):
+    with self._lock:
+      if os.path.exists(self.path):
+        shutil.rmtree(self.path)
+      self._size = 0
+
+  def _file_size(self, fp):
+    try:
+      return os.path.getsize(fp)
+    except OSError:  # there's no such entry
+      return 0
+
+  def _entry_fp(self, key):
+    h = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(self.path, h[:2], h[2:])
+
+  def _entries(self):
+    """Return a generator of (mtime, fp, size) tuples of all entries."""
+    for curr_dir, _, fps in os.walk(self.path):
+      for fp in fps:
+        fp = os.path.join(curr_dir, fp)
+        try:
+          st = os.stat(fp)
+        except OSError:  # removed by someone else
+          continue
+        yield st.st_mtime, fp, st.st_size
+
+  def _evict(self):
+    # We evict down to 3/4 of the max size so that we don't have to go through
+    # all entries again on the very next write
+    target = self.max_bytes * 3 // 4
+    entries = sorted(self._entries())
+    self._size = sum(size for _, _, size in entries)
+    for _, fp, size in entries:
+      if self._size <= target:
+        break
+      try:
+        os.remove(fp)
+      except OSError:
+        pass
+      self._size -= size
+
+
+class CommitGraph(object):
+  """Read-only access to Git's commit-graph.
+
+  The commit-graph stores, in compact arrays, the parents, commit time and
+  generation number of each commit so that the history can be walked without
+  loading (and inflating) commit objects. Commits are identified by their
+  position in the graph. If the commit-graph is a chain of incremental files,
+  positions go from the base file to the tip one.
+
+  Generation numbers are corrected commit dates if all files have them (Git
+  writes them by default), topological levels otherwise. Either way, a commit's
+  generation number is always greater than its parents'.
+  """
+
+  def __init__(self, fps):
+    self._layers = []
+    for fp in fps:
+      self._layers.append(_CommitGraphFile(fp, len(self)))
+    self.corrected_dates = all(l.corrected_dates for l in self._layers)
+    settings = set(l.bloom_settings for l in self._layers)
+    # We only use the changed-paths Bloom filters if all files agree on how
+    # they are computed
+    self.bloom_settings = settings.pop() if len(settings) == 1 else None
+
+  def __len__(self):
+    return sum(l.n for l in self._layers)
+
+  def __contains__(self, oid):
+    return self.position(oid) is not None
+
+  def position(self, oid):
+    """Return the position of the commit with the given id (or None)."""
+    raw = oid.raw
+    for layer in self._layers:
+      pos = layer.lookup(raw)
+      if pos is not None:
+        return pos
+    return None
+
+  def oid(self, pos):
+    layer = self._layer(pos)
+    return pygit2.Oid(raw=layer.oid_raw(pos - layer.base))
+
+  def parents(self, pos):
+    """Return the positions of the parents of the commit at pos."""
+    layer = self._layer(pos)
+    return layer.parents(pos - layer.base)
+
+  def commit_time(self, pos):
+    layer = self._layer(pos)
+    return layer.commit_time(pos - layer.base)
+
+  def generation(self, pos):
+    layer = self._layer(pos)
+    return layer.generation(pos - layer.base, self.corrected_dates)
+
+  def bloom_keys(self, path):
+    """Return the keys to look up path in the changed-paths Bloom filters.
+
+    None is returned if the graph has no (usable) Bloom filters.
+    """
+    if not self.bloom_settings:
+      return None
+    hash_version, num_hashes, _ = self.bloom_settings
+    ret = []
+    # Filters have the changed paths and all of their leading dirs
+    parts = path.encode('utf-8').split(b'/')
+    for i in range(len(parts), 0, -1):
+      data = bytearray(b'/'.join(parts[:i]))
+      h0 = _murmur3(0x293ae76f, data, hash_version)
+      h1 = _murmur3(0x7e646e2c, data, hash_version)
+      ret.append([(h0 + j * h1) & 0xffffffff for j in range(num_hashes)])
+    return ret
+
+  def maybe_changed(self, pos, keys):
+    """Return False if the commit at pos definitely didn't change the path.
+
+    This is, if the path (given by its bloom_keys) is not in the commit's
+    changed-paths Bloom filter. Paths are changed with respect to the commit's
+    first parent. False positives are possible, False negatives aren't.
+    """
+    layer = self._layer(pos)
+    data = layer.bloom_filter(pos - layer.base)
+    if not data:  # no filter for this commit
+      return True
+    data = bytearray(data)
+    bits = len(data) * 8
+    for hashes in keys:
+      for h in hashes:
+        bit = h % bits
+        if not data[bit >> 3] & (1 << (bit & 7)):
+          return False
+    return True
+
+  def next_generation(self, commit_time, parent_generations):
+    """Return the generation number of a commit that's not in the graph."""
+    gen = max(parent_generations) + 1 if parent_generations else 1
+    return max(gen, commit_time) if self.corrected_dates else gen
+
+  def _layer(self, pos):
+    for layer in self._layers:
+      if pos < layer.base + layer.n:
+        return layer
+    raise IndexError(pos)
+
+
+class _CommitGraphFile(object):
+  """One commit-graph file (see Git's commit-graph format documentation)."""
+
+  _NO_PARENT = 0x70000000
+  _EXTRA_EDGES = 0x80000000
+  _LAST_EDGE = 0x80000000
+  _DATA_LEN = 36  # tree id, parents, generation and commit time
+
+  def __init__(self, fp, base):
+    self.base = base
+    with io.open(fp, 'rb') as f:
+      self._buf = buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    signature, version, hash_version, num_chunks = struct.unpack_from(
+        '>4sBBB', buf, 0)
+    if signature != b'CGPH' or version != 1 or hash_version != 1:
+      raise ValueError('Unsupported commit-graph file {0}'.format(fp))
+    chunks = {}
+    for i in range(num_chunks):
+      chunk_id, offset = struct.unpack_from('>4sQ', buf, 8 + 12 * i)
+      chunks[chunk_id] = offset
+    try:
+      self._fanout = chunks[b'OIDF']
+      self._oids = chunks[b'OIDL']
+      self._data = chunks[b'CDAT']
+    except KeyError:
+      raise ValueError('Invalid commit-graph file {0}'.format(fp))
+    self._edges = chunks.get(b'EDGE')
+    self._date_offsets = chunks.get(b'GDA2')
+    self._date_overflows = chunks.get(b'GDO2')
+    self.corrected_dates = self._date_offsets is not None
+    self._bloom_index = chunks.get(b'BIDX')
+    self._bloom_data = chunks.get(b'BDAT')
+    self.bloom_settings = None
+    if self._bloom_index is not None and self._bloom_data is not None:
+      # Hash version, number of hashes and bits per entry
+      self.bloom_settings = struct.unpack_from('>III', buf, self._bloom_data)
+    self.n = struct.unpack_from('>I', buf, self._fanout + 255 * 4)[0]
+
+  def lookup(self, raw):
+    first = bytearray(raw[:1])[0]
+    lo = struct.unpack_from(
+        '>I', self._buf, self._fanout + (first - 1) * 4)[0] if first else 0
+    hi = struct.unpack_from('>I', self._buf, self._fanout + first * 4)[0]
+    while lo < hi:
+      mid = (lo + hi) // 2
+      curr = self.oid_raw(mid)
+      if curr == raw:
+        return self.base + mid
+      elif curr < raw:
+        lo = mid + 1
+      else:
+        hi = mid
+    return None
+
+  def oid_raw(self, i):
+    start = self._oids + 20 * i
+    return self._buf[start:start + 20]
+
+  def parents(self, i):
+    p1, p2 = struct.unpack_from(
+        '>II', self._buf, self._data + self._DATA_LEN * i + 20)
+    if p1 == self._NO_PARENT:
+      return []
+    if p2 == self._NO_PARENT:
+      return [p1]
+    if not p2 & self._EXTRA_EDGES:
+      return [p1, p2]
+    ret = [p1]
+    edge = p2 & ~self._EXTRA_EDGES
+    while True:
+      p = struct.unpack_from('>I', self._buf, self._edges + 4 * edge)[0]
+      ret.append(p & ~self._LAST_EDGE)
+      if p & self._LAST_EDGE:
+        return ret
+      edge += 1
+
+  def bloom_filter(self, i):
+    """Return the changed-paths Bloom filter of the i-th commit (or None)."""
+    if self.bloom_settings is None:
+      return None
+    start = struct.unpack_from(
+        '>I', self._buf, self._bloom_index + 4 * (i - 1))[0] if i else 0
+    end = struct.unpack_from('>I', self._buf, self._bloom_index + 4 * i)[0]
+    data = self._bloom_data + 12  # skip the settings
+    return self._buf[data + start:data + end] or None
+
+  def _gen_and_time(self, i):
+    hi, lo = struct.unpack_from(
+        '>II', self._buf, self._data + self._DATA_LEN * i + 28)
+    return hi >> 2, ((hi & 3) << 32) | lo
+
+  def commit_time(self, i):
+    return self._gen_and_time(i)[1]
+
+  def generation(self, i, corrected_dates):
+    level, commit_time = self._gen_and_time(i)
+    if not corrected_dates:
+      return level
+    offset = struct.unpack_from('>I', self._buf, self._date_offsets + 4 * i)[0]
+    if offset & 0x80000000:
+      offset = struct.unpack_from(
+          '>Q', self._buf,
+          self._date_overflows + 8 * (offset & 0x7fffffff))[0]
+    return commit_time + offset
+
+
+def load_commit_graph(path):
+  """Return the CommitGraph of the repo whose .git dir is path (or None).
+
+  Like Git, if both a single commit-graph file and a chain of files exist, the
+  single file is used. Commit-graphs we can't read are ignored.
+  """
+  fps = []
+  single_fp = os.path.join(path, COMMIT_GRAPH_FP)
+  chain_fp = os.path.join(path, COMMIT_GRAPH_CHAIN_DIR, 'commit-graph-chain')
+  if os.path.exists(single_fp):
+    fps = [single_fp]
+  elif os.path.exists(chain_fp):
+    with io.open(chain_fp, 'r', encoding='ascii') as f:
+      fps = [
+          os.path.join(
+              path, COMMIT_GRAPH_CHAIN_DIR, 'graph-{0}.graph'.format(h.strip()))
+          for h in f if h.strip()]
+  if not fps:
+    return None
+  try:
+    return CommitGraph(fps)
+  except (IOError, OSError, ValueError, struct.error):
+    return None
+
+
+def _commit_graph_stamp(path):
+  ret = []
+  for fp in (
+      os.path.join(path, COMMIT_GRAPH_FP),
+      os.path.join(path, COMMIT_GRAPH_CHAIN_DIR, 'commit-graph-chain')):
+    try:
+      st = os.stat(fp)
+      ret.append((st.st_mtime, st.st_size))
+    except OSError:
+      ret.append(None)
+  return tuple(ret)
+
+
 # Helpers for stashing
 
 def _stash(pattern):
@@ -1334,11 +2792,317 @@ def _stash_msg_merge(name):
   return _stash_msg('merge-{0}'.format(name))
 
 
+# Helpers for reading refs (see RefSnapshot)
+
+def _common_dir(git_dir):
+  """Return the dir with the refs shared by all worktrees."""
+  commondir_fp = os.path.join(git_dir, 'commondir')
+  if os.path.exists(commondir_fp):  # a linked worktree
+    return os.path.normpath(
+        os.path.join(git_dir, _read_ref_file(commondir_fp)))
+  return git_dir
+
+
+def _read_refs(git_dir, prefix):
+  """Return a list of (name without prefix, target) of the refs under prefix.
+
+  Targets are Oids or, for symbolic refs, the name of the ref they point to.
+  """
+  common_dir = _common_dir(git_dir)
+  ret = _strip_ref_prefix(_read_packed_refs(common_dir), prefix)
+  ret.update(_read_loose_refs(common_dir, prefix))
+  return sorted(ret.items())
+
+
+def _read_ref_file(fp):
+  with io.open(fp, 'rb') as f:
+    return f.read().decode('utf-8').strip()
+
+
+def _parse_ref_target(contents):
+  """Return the Oid in contents, or the name of the ref if it's symbolic."""
+  if contents.startswith('ref: '):
+    return contents[len('ref: '):]
+  return pygit2.Oid(hex=contents[:40])
+
+
+def _read_packed_refs(git_dir):
+  """Return a dict of ref name -> Oid of the packed refs."""
+  ret = {}
+  try:
+    with io.open(os.path.join(git_dir, 'packed-refs'), 'rb') as f:
+      lines = f.read().decode('utf-8').splitlines()
+  except IOError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    return ret
+  for l in lines:
+    if not l or l[0] in '#^':  # header or peeled tag
+      continue
+    oid, name = l.split(' ', 1)
+    ret[name] = pygit2.Oid(hex=oid)
+  return ret
+
+
+def _strip_ref_prefix(refs, prefix):
+  return dict(
+      (name[len(prefix):], target) for name, target in refs.items()
+      if name.startswith(prefix))
+
+
+def _read_loose_refs(git_dir, prefix):
+  """Return a dict of name (without prefix) -> Oid or symbolic ref name."""
+  ret = {}
+  refs_dir = os.path.join(git_dir, *prefix.split('/'))
+  for dirpath, _, filenames in os.walk(refs_dir):
+    rel_dir = os.path.relpath(dirpath, refs_dir)
+    for fn in filenames:
+      if fn.endswith('.lock'):
+        continue
+      name = fn if rel_dir == '.' else '/'.join(rel_dir.split(os.sep) + [fn])
+      try:
+        contents = _read_ref_file(os.path.join(dirpath, fn))
+      except IOError as e:
+        if e.errno != errno.ENOENT:  # deleted while we were listing
+          raise
+        continue
+      if contents:
+        ret[name] = _parse_ref_target(contents)
+  return ret
+
+
+def _read_upstreams(config):
+  """Return a dict of branch name -> (remote, merge) from the given config."""
+  ret = {}
+  for entry in config:
+    # Older versions of pygit2 yield the names instead of the entries
+    name = getattr(entry, 'name', entry)
+    if not name.startswith('branch.'):
+      continue
+    branch_name, var = name[len('branch.'):].rsplit('.', 1)
+    if var not in ('remote', 'merge'):
+      continue
+    value = entry.value if hasattr(entry, 'value') else config[name]
+    remote, merge = ret.get(branch_name, (None, None))
+    if var == 'remote':
+      remote = value
+    else:
+      merge = value
+    ret[branch_name] = (remote, merge)
+  return ret
+
+
+# Helpers for creating and deleting refs in bulk (see RefTransaction)
+
+def _commit_id(commit):
+  """Return the id of commit (or of the commit an annotated tag points to)."""
+  if isinstance(commit, pygit2.Object):
+    return commit.peel(pygit2.Commit).id
+  return commit
+
+
+def _write_tag_object(git_repo, name, target):
+  """Write the object of tag name for the commit target, return its id.
+
+  The object is the same that Repository.create_tag would create, but no ref
+  is created for it.
+  """
+  tagger = git_repo.default_signature
+  offset = abs(tagger.offset)
+  data = (
+      'object {0}\ntype commit\ntag {1}\n'
+      'tagger {2} <{3}> {4} {5}{6:02d}{7:02d}\n\n').format(
+          target, name, tagger.name, tagger.email, tagger.time,
+          '-' if tagger.offset < 0 else '+', offset // 60, offset % 60)
+  return git_repo.odb.write(pygit2.GIT_OBJ_TAG, data.encode('utf-8'))
+
+
+def _cleanup_deleted_branches(tbd_repo, names):
+  """Remove the config and stashes left by the given deleted branches."""
+  config = tbd_repo.config
+  names = frozenset(names)
+  keys = set()
+  for entry in config:
+    if not entry.name.startswith('branch.'):
+      continue
+    b_name, _ = entry.name[len('branch.'):].rsplit('.', 1)
+    if b_name in names:
+      keys.add(entry.name)
+  for key in keys:
+    config.delete_multivar(key, '.*')
+
+  if 'refs/stash' in tbd_repo.git_repo.references:
+    for name in names:
+      s_id, _ = _stash(_stash_msg(name))
+      if s_id:
+        git.stash.drop(s_id)
+
+
+def _create_upstream_branches(repo, remote_name, branches):
+  """Create the given (name, target) branches, with upstream remote/name.
+
+  All branches are created in a single ref transaction, and their upstream
+  config is written at once (setting it through libgit2 would rewrite the
+  config file once per branch).
+  """
+  if not branches:
+    return
+  tx = repo.ref_transaction(atomic=True)
+  for n, target in branches:
+    tx.create_branch(n, target)
+  errors = tx.commit()
+  if errors:
+    raise TbdError(next(iter(errors.values())))
+
+  quote = lambda n: n.replace('\\', '\\\\').replace('"', '\\"')
+  lines = []
+  for n, _ in branches:
+    lines.extend([
+        '[branch "{0}"]'.format(quote(n)),
+        '\tremote = "{0}"'.format(quote(remote_name)),
+        '\tmerge = "refs/heads/{0}"'.format(quote(n))])
+  with io.open(os.path.join(repo.path, 'config'), 'a', encoding='utf-8') as f:
+    f.write('\n'.join(lines) + '\n')
+
+
+# Helpers for talking to remotes
+
+class _NonFastForwardError(TbdError): pass
+
+
+class _RemoteCallbacks(pygit2.RemoteCallbacks):
+  """Callbacks of the remote operations done through libgit2.
+
+  Attributes:
+    created_tags: the names of the tags created by the last fetch.
+    rejected: dict of ref name -> message of the refs the remote refused to
+      update in the last push.
+  """
+
+  def __init__(self, progress=None):
+    super(_RemoteCallbacks, self).__init__()
+    self.progress = progress
+    self.created_tags = []
+    self.rejected = {}
+    self._tried = set()
+
+  def credentials(self, url, username_from_url, allowed_types):
+    # Like git, we use the credential helpers (ssh remotes are talked to
+    # through git, see _uses_ssh). We give up after having tried once,
+    # otherwise libgit2 would keep asking
+    if (allowed_types & pygit2.GIT_CREDENTIAL_USERPASS_PLAINTEXT and
+        'userpass' not in self._tried):
+      self._tried.add('userpass')
+      return pygit2.UserPass(*_git_credential(url, username_from_url))
+    raise TbdError('Authentication failed for {0}'.format(url))
+
+  def transfer_progress(self, stats):
+    if self.progress:
+      self.progress(stats)
+
+  def update_tips(self, refname, old, new):
+    if refname.startswith('refs/tags/') and old.raw == b'\0' * len(old.raw):
+      self.created_tags.append(refname)
+
+  def push_update_reference(self, refname, message):
+    if message:
+      self.rejected[refname] = message
+
+
+def _uses_ssh(url):
+  """True if url is an ssh url (including scp-like ones, e.g., host:path).
+
+  libgit2 ignores ssh's config (host aliases, identity files, known hosts,
+  etc.) so ssh remotes are talked to through git instead.
+  """
+  if re.match(r'(ssh|git\+ssh|ssh\+git)://', url):
+    return True
+  if '://' in url:
+    return False
+  host, sep, _ = url.partition(':')
+  # A local path might also have a ':', but not before a '/'. One letter hosts
+  # are Windows drives
+  return bool(sep) and '/' not in host and len(host) > 1
+
+
+def _ls_remote(git_remote, callbacks):
+  """Return a dict of ref name -> id (hex) of the refs git_remote has."""
+  if _uses_ssh(git_remote.url):
+    out = stdout(git('ls-remote', git_remote.url))
+    return dict(
+        reversed(l.split('\t', 1)) for l in out.splitlines() if '\t' in l)
+  heads = git_remote.ls_remotes(callbacks=callbacks, proxy=True)
+  return dict((h['name'], str(h['oid'])) for h in heads)
+
+
+def _git_push(remote_name, refspecs):
+  try:
+    git.push(remote_name, *refspecs)
+  except ErrorReturnCode as e:
+    if 'Updates were rejected' in stderr(e):
+      raise _NonFastForwardError(stderr(e))
+    raise TbdError(stderr(e))
+
+
+def _git_credential(url, username):
+  """Return the username and password git's credential helpers have for url."""
+  lines = ['url={0}'.format(url)]
+  if username:
+    lines.append('username={0}'.format(username))
+  try:
+    out = stdout(git.credential('fill', _in='\n'.join(lines) + '\n\n'))
+  except ErrorReturnCode as e:
+    raise TbdError(stderr(e))
+  creds = dict(l.split('=', 1) for l in out.splitlines() if '=' in l)
+  return creds.get('username', ''), creds.get('password', '')
+
+
+def _push(tbd_repo, remote_name, refspecs):
+  """Push the given refspecs to the remote.
+
+  Raises _NonFastForwardError if the push is not a fast-forward, and TbdError
+  if it failed for any other reason.
+  """
+  callbacks = _RemoteCallbacks()
+  git_remote = tbd_repo.git_repo.remotes[remote_name]
+  try:
+    if _uses_ssh(git_remote.url):
+      _git_push(remote_name, refspecs)
+    else:
+      try:
+        git_remote.push(refspecs, callbacks=callbacks, proxy=True)
+      except pygit2.GitError as e:
+        if 'non-fastforward' in str(e):
+          raise _NonFastForwardError(str(e))
+        if 'non-bare' not in str(e):
+          raise TbdError(str(e))
+        # libgit2 can't push to local repositories that are not bare, git can
+        _git_push(remote_name, refspecs)
+  finally:
+    tbd_repo.fetch_session.refresh(remote_name)
+  if callbacks.rejected:
+    raise TbdError('\n'.join(
+        '{0} was rejected: {1}'.format(ref, msg)
+        for ref, msg in sorted(callbacks.rejected.items())))
+
+
 # Misc
 
 OpCb = collections.namedtuple(
     'OpCb', ['apply_ok', 'apply_err', 'save', 'restore_ok'])
 
+def approxidate(date):
+  """Return the Unix timestamp of the given date, as understood by Git.
+
+  Git understands many date formats, including relative ones ('yesterday',
+  '2 weeks ago').
+  """
+  try:
+    out = stdout(git('rev-parse', '--since={0}'.format(date)))
+  except ErrorReturnCode as e:
+    raise TbdError(stderr(e))
+  return int(out.strip().split('=', 1)[1])
+
 def stdout(p):
   try:
       pstdout = p.stdout.decode(ENCODING)
@@ -1353,11 +3117,663 @@ def stderr(p):
       pstderr = p.stderr
   return pstderr
 
-def walker(git_repo, target, reverse):
+def walker(git_repo, target, reverse, first_parent=False):
   flags = pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME
   if reverse:
     flags = flags | pygit2.GIT_SORT_REVERSE
-  return git_repo.walk(target, flags)
+  walk = git_repo.walk(target, flags)
+  if first_parent:
+    walk.simplify_first_parent()
+  return walk
+
+def stream_walker(
+    git_repo, target, lookahead=HISTORY_LOOKAHEAD, graph=None, after=None,
+    paths=None, since=None, until=None, author=None, first_parent=False):
+  """Return an iterator over the commits reachable from target.
+
+  Commits are generated in topological order but, unlike walker, the whole
+  history doesn't need to be walked before the first commit is generated, so
+  generating the first n commits costs (roughly) n whatever the size of the
+  history.
+
+  If a CommitGraph is given, commits are generated in the order of their
+  generation numbers, which children always have greater than their parents.
+  Otherwise, commits are read in commit time order (see _date_walker) and
+  each one is held back until all of its children that
+  have been read have been output. Commits are read up to lookahead commits
+  ahead of the one to output so that children with skewed commit times are
+  still output before their parents.
+
+  The iterator's cursor attribute is the HistoryCursor to resume the walk
+  after the last commit generated, which can be given in after to get the
+  commits that come next. Walks that use the commit-graph (or only follow
+  first parents) resume right where they were left if target is still the
+  tip they started from. Others have to walk again up to the cursor's commit,
+  and fail with a ValueError if they don't find it.
+
+  If first_parent is True, only the first parent of each commit is followed.
+  Such walks don't need any sorting.
+
+  If paths are given, only the commits that changed any of them are generated.
+  See commit_filter for since, until and author. The walk stops as soon as it
+  can tell all the remaining commits are older than since.
+  """
+  nodes = _CommitNodes(git_repo, graph) if graph else None
+  queue = None
+  # The frontier is only valid for the history of the tip it was taken from
+  # (that also makes sure the cursor's commit is in target's history without
+  # having to walk it)
+  resume = (
+      after is not None and after.frontier is not None and
+      after.tip == target and (graph or first_parent))
+  starts = after.frontier if resume else [target]
+  if first_parent:
+    queue = []
+    commits = _first_parent_walker(git_repo, queue, starts)
+  elif graph:
+    queue = _GenerationQueue(nodes)
+    commits = _generation_walker(git_repo, queue, starts)
+  else:
+    commits = _lookahead_walker(git_repo, target, lookahead)
+  if after and not resume:
+    commits = _skip_through(commits, after.last_id)
+  if since is not None or until is not None or author:
+    if graph and graph.corrected_dates:
+      # Generation numbers are corrected commit dates, which are never lower
+      # than the commit times of the commit and all of its ancestors
+      is_past_since = lambda ci: nodes[ci.id].generation < since
+    elif graph and not first_parent:
+      # Generation number order is not commit time order, any number of older
+      # commits might come before a newer one, so we can't stop early
+      is_past_since = lambda ci: False
+    else:
+      # Commit time order, or a single line of descent (first parents), whose
+      # commit times only go up if they are skewed: we stop after some older
+      # commits in a row (see commit_filter)
+      is_past_since = None
+    commits = commit_filter(
+        commits, since=since, until=until, author=author,
+        is_past_since=is_past_since)
+  if paths:
+    commits = _path_filter(git_repo, commits, paths, graph)
+  return _StreamWalk(commits, queue, target)
+
+
+def commit_filter(
+    commits, since=None, until=None, author=None, is_past_since=None):
+  """Generate the commits that match the given criteria.
+
+  Args:
+    commits: the commits to filter, newest first.
+    since, until: only commits whose commit time (a Unix timestamp) is in this
+      range are generated.
+    author: only commits whose author (as 'name <email>') matches this regular
+      expression are generated.
+    is_past_since: a function that tells whether all the commits after the
+      given one are older than since (and we can thus stop). If it's not given,
+      we stop after finding HISTORY_SLOP commits older than since in a row.
+  """
+  try:
+    author_re = re.compile(author) if author else None
+  except re.error as e:
+    raise ValueError('Invalid author pattern {0}: {1}'.format(author, e))
+  return _commit_filter(commits, since, until, author_re, is_past_since)
+
+def _commit_filter(commits, since, until, author_re, is_past_since):
+  older = 0
+  for ci in commits:
+    if since is not None:
+      if is_past_since and is_past_since(ci):
+        return
+      if ci.commit_time < since:
+        older += 1
+        if not is_past_since and older >= HISTORY_SLOP:
+          return
+        continue
+      older = 0
+    if until is not None and ci.commit_time > until:
+      continue
+    if author_re and not author_re.search(
+        '{0} <{1}>'.format(ci.author.name, ci.author.email)):
+      continue
+    yield ci
+
+
+class HistoryCursor(
+    collections.namedtuple('HistoryCursor', ['last_id', 'frontier', 'tip'])):
+  """Where to resume a history walk (see stream_walker).
+
+  Attributes:
+    last_id: the id of the last commit generated.
+    frontier: the ids of the commits the walk was to look at next (None if
+      unknown, in which case the walk is resumed by walking up to last_id).
+    tip: the id of the commit the walk started from (None if unknown). The
+      frontier is only used to resume walks from this same commit.
+  """
+  __slots__ = ()
+
+  def __new__(cls, last_id, frontier, tip=None):
+    return super(HistoryCursor, cls).__new__(cls, last_id, frontier, tip)
+
+  def __str__(self):
+    if self.frontier is None:
+      return str(self.last_id)
+    ret = '{0}:{1}'.format(
+        self.last_id, ','.join(str(oid) for oid in self.frontier))
+    return ret if self.tip is None else '{0}:{1}'.format(ret, self.tip)
+
+  @classmethod
+  def parse(cls, cursor):
+    """Return the HistoryCursor represented by the given string."""
+    parts = cursor.split(':')
+    if len(parts) > 3:
+      raise ValueError('Invalid history cursor {0}'.format(cursor))
+    try:
+      return cls(
+          pygit2.Oid(hex=parts[0]),
+          [pygit2.Oid(hex=oid) for oid in parts[1].split(',') if oid]
+          if len(parts) > 1 else None,
+          pygit2.Oid(hex=parts[2]) if len(parts) > 2 else None)
+    except (ValueError, TypeError):
+      raise ValueError('Invalid history cursor {0}'.format(cursor))
+
+
+class _StreamWalk(object):
+
+  def __init__(self, commits, queue, tip):
+    self._commits = commits
+    self._queue = queue
+    self._tip = tip
+    self._last = None
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    self._last = next(self._commits)
+    return self._last
+
+  next = __next__  # Python 2
+
+  @property
+  def cursor(self):
+    if self._last is None:
+      return None
+    frontier = list(self._queue) if self._queue is not None else None
+    return HistoryCursor(self._last.id, frontier, self._tip)
+
+def _skip_through(commits, oid):
+  commits = iter(commits)
+  for ci in commits:
+    if ci.id == oid:
+      break
+  else:  # e.g., it's not in the first-parent history
+    raise ValueError('Commit {0} is not in the history walked'.format(oid))
+  for ci in commits:
+    yield ci
+
+def _date_walker(git_repo, target):
+  """Generate the commits reachable from target, newest commit time first.
+
+  Like Git, we keep our own queue ordered by commit time: libgit2 only walks
+  incrementally when no sorting is asked for (with any sorting it reads the
+  whole history before generating the first commit).
+  """
+  ci = git_repo[target]
+  seen = set([ci.id])
+  queue = [(-ci.commit_time, ci.id.raw, ci)]
+  while queue:
+    ci = heapq.heappop(queue)[-1]
+    for p in ci.parent_ids:
+      if p not in seen:
+        seen.add(p)
+        parent = git_repo[p]
+        heapq.heappush(queue, (-parent.commit_time, p.raw, parent))
+    yield ci
+
+def _lookahead_walker(git_repo, target, lookahead):
+  walk = _date_walker(git_repo, target)
+  # Number of children of each commit that have been read but not output yet
+  pending = collections.defaultdict(int)
+  buf = []
+
+  def pop_ready():
+    for i, ci in enumerate(buf):
+      if not pending[ci.id]:
+        del buf[i]
+        pending.pop(ci.id, None)
+        for p in ci.parent_ids:
+          pending[p] -= 1
+        return ci
+    raise AssertionError('Cycle in history')  # can't happen in a DAG
+
+  for ci in walk:
+    buf.append(ci)
+    for p in ci.parent_ids:
+      pending[p] += 1
+    if len(buf) > lookahead:
+      yield pop_ready()
+  while buf:
+    yield pop_ready()
+
+def _first_parent_walker(git_repo, frontier, starts):
+  frontier.extend(starts)
+  while frontier:
+    ci = git_repo[frontier.pop()]
+    if ci.parent_ids:
+      frontier.append(ci.parent_ids[0])
+    yield ci
+
+def _generation_walker(git_repo, queue, starts):
+  seen = set(starts)
+  for oid in seen:
+    queue.push(oid)
+  while queue:
+    oid = queue.pop()
+    # We queue the parents before generating the commit so that the queue is
+    # the walk's frontier (see _StreamWalk.cursor)
+    for p in queue.nodes[oid].parent_ids:
+      if p not in seen:
+        seen.add(p)
+        queue.push(p)
+    yield git_repo[oid]
+
+# Helpers for walking the commit graph
+
+_CommitNode = collections.namedtuple(
+    '_CommitNode', ['generation', 'commit_time', 'parent_ids'])
+
+class _CommitNodes(object):
+  """Generation numbers, commit times and parents of commits.
+
+  Commits in the commit-graph are looked up there, without loading their
+  objects. For the others (those created after the commit-graph was last
+  written) the generation numbers are computed from their parents'.
+  """
+
+  def __init__(self, git_repo, graph):
+    self.git_repo = git_repo
+    self.graph = graph
+    self._nodes = {}
+
+  def __getitem__(self, oid):
+    nodes = self._nodes
+    if oid in nodes:
+      return nodes[oid]
+
+    graph = self.graph
+    parents = {}
+    stack = [oid]
+    while stack:
+      curr = stack[-1]
+      if curr in nodes:
+        stack.pop()
+        continue
+      pos = graph.position(curr)
+      if pos is not None:
+        nodes[curr] = _CommitNode(
+            graph.generation(pos), graph.commit_time(pos),
+            [graph.oid(p) for p in graph.parents(pos)])
+        stack.pop()
+        continue
+      if curr not in parents:
+        ci = self.git_repo[curr]
+        parents[curr] = ci.commit_time, ci.parent_ids
+      commit_time, parent_ids = parents[curr]
+      missing = [p for p in parent_ids if p not in nodes]
+      if missing:
+        stack.extend(missing)
+        continue
+      nodes[curr] = _CommitNode(
+          graph.next_generation(
+              commit_time, [nodes[p].generation for p in parent_ids]),
+          commit_time, parent_ids)
+      stack.pop()
+    return nodes[oid]
+
+class _GenerationQueue(object):
+  """Priority queue of commit ids that pops the highest generation first.
+
+  Since children have greater generation numbers than their parents, commits
+  are popped in topological order. Ties are broken by commit time and then by
+  id, so the order in which commits are popped doesn't depend on the order in
+  which they were pushed.
+  """
+
+  def __init__(self, nodes):
+    self.nodes = nodes
+    self._heap = []
+
+  def __len__(self):
+    return len(self._heap)
+
+  def __iter__(self):
+    return (oid for _, _, _, oid in self._heap)
+
+  def push(self, oid):
+    node = self.nodes[oid]
+    heapq.heappush(
+        self._heap, (-node.generation, -node.commit_time, oid.raw, oid))
+
+  def pop(self):
+    return heapq.heappop(self._heap)[-1]
+
+def _murmur3(seed, data, hash_version):
+  """Git's 32-bit murmur3 hash of data (a bytearray).
+
+  Version 1 of Git's changed-paths Bloom filters sign-extends bytes >= 0x80
+  before hashing them (a bug fixed in version 2) so we do the same.
+  """
+  if hash_version == 1:
+    data = [(b - 256) & 0xffffffff if b >= 0x80 else b for b in data]
+  c1, c2 = 0xcc9e2d51, 0x1b873593
+  rotl = lambda x, r: ((x << r) | (x >> (32 - r))) & 0xffffffff
+  h = seed
+  len4 = len(data) // 4
+  for i in range(len4):
+    b = data[4 * i:4 * i + 4]
+    k = (b[0] | (b[1] << 8) | (b[2] << 16) | (b[3] << 24)) & 0xffffffff
+    k = (rotl((k * c1) & 0xffffffff, 15) * c2) & 0xffffffff
+    h = (rotl(h ^ k, 13) * 5 + 0xe6546b64) & 0xffffffff
+  tail = data[4 * len4:]
+  if tail:
+    k = 0
+    for i in reversed(range(len(tail))):
+      k ^= (tail[i] << (8 * i)) & 0xffffffff
+    k = (rotl((k * c1) & 0xffffffff, 15) * c2) & 0xffffffff
+    h ^= k
+  h ^= len(data)
+  h ^= h >> 16
+  h = (h * 0x85ebca6b) & 0xffffffff
+  h ^= h >> 13
+  h = (h * 0xc2b2ae35) & 0xffffffff
+  h ^= h >> 16
+  return h
+
+def _path_filter(git_repo, commits, paths, graph):
+  """Generate the commits that changed any of the given paths.
+
+  Paths are changed with respect to the commit's first parent (or, for root
+  commits, if they exist). Commits in the graph whose changed-paths Bloom filter
+  tells they didn't change the paths are skipped without looking at their
+  trees.
+  """
+  paths = [_get_git_path(p).rstrip('/') for p in paths]
+  keys = None
+  if graph and graph.bloom_settings:
+    keys = [graph.bloom_keys(p) for p in paths]
+  for ci in commits:
+    if keys:
+      pos = graph.position(ci.id)
+      if pos is not None and not any(
+          graph.maybe_changed(pos, k) for k in keys):
+        continue
+    parent_tree = ci.parents[0].tree if ci.parent_ids else None
+    if any(
+        _tree_entry_id(ci.tree, p) != _tree_entry_id(parent_tree, p)
+        for p in paths):
+      yield ci
+
+def _tree_entry_id(tree, path):
+  try:
+    return tree[path].id if tree is not None else None
+  except KeyError:
+    return None
+
+# Flags used to paint commits in graph walks
+_PARENT1 = 1
+_PARENT2 = 2
+_STALE = 4
+
+def _paint(nodes, starts, visit, done):
+  """Propagate the flags of the starting commits to their ancestors.
+
+  Commits are visited in generation order, so all of a commit's descendants
+  have been visited (and its flags are final) by the time visit is called on
+  it.
+
+  Args:
+    nodes: the _CommitNodes to use.
+    starts: a dict mapping the commit ids to start from to their flags.
+    visit: a function that is called with each commit id and its flags. It
+      returns the flags to propagate to the commit's parents, or None to stop
+      the walk.
+    done: a function that is called with flags. The walk stops once it returns
+      True for the flags of all queued commits.
+  """
+  flags = dict(starts)
+  queue = _GenerationQueue(nodes)
+  undone = 0  # number of queued commits for which done is False
+  for oid, f in flags.items():
+    queue.push(oid)
+    if not done(f):
+      undone += 1
+  while undone:
+    oid = queue.pop()
+    if not done(flags[oid]):
+      undone -= 1
+    propagate = visit(oid, flags[oid])
+    if propagate is None:
+      return
+    for p in nodes[oid].parent_ids:
+      if p not in flags:
+        flags[p] = propagate
+        queue.push(p)
+        if not done(propagate):
+          undone += 1
+      else:
+        # Parents have lower generations, so p is still queued
+        was_done = done(flags[p])
+        flags[p] |= propagate
+        if not was_done and done(flags[p]):
+          undone -= 1
+
+def _graph_merge_base(nodes, id1, id2):
+  if id1 == id2:
+    return id1
+  bases = []
+
+  def visit(oid, f):
+    if f == _PARENT1 | _PARENT2:
+      # Since we go in generation order, no descendant of this commit is a
+      # common ancestor, so it's a best common ancestor
+      bases.append(oid)
+      return None
+    return f
+
+  _paint(
+      nodes, {id1: _PARENT1, id2: _PARENT2}, visit, done=lambda f: False)
+  return bases[0] if bases else None
+
+def _graph_reachable_ids(nodes, target, hide):
+  starts = dict((h, _STALE) for h in hide)
+  starts[target] = starts.get(target, 0) | _PARENT1
+  ret = []
+
+  def visit(oid, f):
+    if not f & _STALE:
+      ret.append(oid)
+    return f
+
+  _paint(nodes, starts, visit, done=lambda f: f & _STALE)
+  return frozenset(ret)
+
+def _graph_ahead_behind(nodes, id1, id2):
+  if id1 == id2:
+    return 0, 0
+  both = _PARENT1 | _PARENT2
+  counts = {_PARENT1: 0, _PARENT2: 0}
+
+  def visit(oid, f):
+    if f in counts:
+      counts[f] += 1
+    return f
+
+  _paint(
+      nodes, {id1: _PARENT1, id2: _PARENT2}, visit,
+      done=lambda f: f & both == both)
+  return counts[_PARENT1], counts[_PARENT2]
+
+
+def _graph_ahead_behind_many(nodes, bits, pairs):
+  everyone = (1 << len(bits)) - 1
+  # Commits are counted by the set of starting commits they are reachable from
+  counts = collections.Counter()
+  def visit(oid, f):
+    counts[f] += 1
+    return f
+  _paint(nodes, bits, visit, done=lambda f: f == everyone)
+  return _pair_counts(counts, bits, pairs)
+
+def _date_ahead_behind_many(git_repo, bits, pairs):
+  """Like _graph_ahead_behind_many, but walking in commit time order.
+
+  A commit whose commit time is skewed can be walked before one of its
+  children. If it then gets new flags, it's queued again so that they reach
+  its ancestors. Like Git, we keep walking for HISTORY_SLOP commits once all
+  queued commits are reachable from all starting commits, in case a skewed
+  commit still needs to be updated.
+  """
+  everyone = (1 << len(bits)) - 1
+  flags = dict(bits)
+  queue = []
+  queued = set()
+  undone = 0  # number of queued commits not reachable from everyone
+
+  def push(oid):
+    ci = git_repo[oid]
+    heapq.heappush(queue, (-ci.commit_time, oid.raw, ci))
+    queued.add(oid)
+
+  for oid, f in bits.items():
+    push(oid)
+    undone += 1 if f != everyone else 0
+  slop = HISTORY_SLOP
+  while queue:
+    if undone:
+      slop = HISTORY_SLOP
+    else:
+      slop -= 1
+      if not slop:
+        break
+    ci = heapq.heappop(queue)[-1]
+    queued.discard(ci.id)
+    f = flags[ci.id]
+    if f != everyone:
+      undone -= 1
+    for p in ci.parent_ids:
+      old = flags.get(p, 0)
+      if old | f == old:
+        continue
+      flags[p] = old | f
+      if p not in queued:  # new or (if skewed) already walked
+        push(p)
+        undone += 1 if old | f != everyone else 0
+      elif old | f == everyone:
+        undone -= 1
+  # All commits left in the queue are reachable from everyone
+  return _pair_counts(collections.Counter(flags.values()), bits, pairs)
+
+def _pair_counts(counts, bits, pairs):
+  """Return the ahead and behind counts of pairs from the commit counts by
+  flags (the set of starting commits they are reachable from)."""
+  ret = dict(((id1, id2), [0, 0]) for id1, id2 in pairs)
+  # For each bit, the counts it's the first or the second bit of
+  by_bit = collections.defaultdict(list)
+  for (id1, id2), pair_counts in ret.items():
+    if id1 != id2:
+      by_bit[bits[id1]].append((bits[id2], pair_counts, 0))
+      by_bit[bits[id2]].append((bits[id1], pair_counts, 1))
+  for f, n in counts.items():
+    rest = f
+    while rest:
+      bit = rest & -rest
+      rest ^= bit
+      for other, pair_counts, i in by_bit[bit]:
+        if not f & other:
+          pair_counts[i] += n
+  return [tuple(ret[pair]) for pair in pairs]
+
+
+# Helpers for diffing large files
+
+_CHUNK_LEN = 1024 * 1024
+
+def _delta_blob_exists(diff_file):
+  """True if the given side of a diff delta is a file (not a submodule)."""
+  return bool(diff_file.mode) and diff_file.mode != pygit2.GIT_FILEMODE_COMMIT
+
+def _delta_blob(git_repo, diff_file):
+  """Returns the blob of the given side of a diff delta (or None)."""
+  if not _delta_blob_exists(diff_file):
+    return None
+  return git_repo[diff_file.id]
+
+def _count_lines(buf, limit):
+  """Count the lines in buf, stopping as soon as the count exceeds limit."""
+  count = 0
+  for start in range(0, len(buf), _CHUNK_LEN):
+    count += bytes(buf[start:start + _CHUNK_LEN]).count(b'\n')
+    if count > limit:
+      break
+  return count
+
+def _blob_exceeds(blob, max_bytes, max_lines):
+  if not blob:
+    return False
+  if blob.size > max_bytes or blob.is_binary:
+    return True
+  if blob.size <= max_lines:  # it can't have more lines than bytes
+    return False
+  return _count_lines(memoryview(blob), max_lines) > max_lines
+
+def _diff_flags(opts, old_blob, new_blob):
+  """Return the diff flags to use for diffing the given blobs."""
+  cost = (old_blob.size if old_blob else 0) + (new_blob.size if new_blob else 0)
+  if cost > opts.max_file_cost:
+    return pygit2.GIT_DIFF_NORMAL
+  return DIFF_ALGORITHMS[opts.algorithm]
+
+def _blob_summary(old_fp, old_blob, new_fp, new_blob):
+  is_binary = bool(
+      (old_blob and old_blob.is_binary) or (new_blob and new_blob.is_binary))
+  return DiffSummary(
+      old_fp, new_fp,
+      old_blob.id if old_blob else None, new_blob.id if new_blob else None,
+      old_blob.size if old_blob else 0, new_blob.size if new_blob else 0,
+      is_binary)
+
+def _wd_summary(git_path, blob_at_head, full_path, wt_exists):
+  """DiffSummary of the working version of a file with its committed one."""
+  summary = _blob_summary(git_path, blob_at_head, git_path, None)
+  if wt_exists:
+    summary = summary._replace(
+        new_id=pygit2.hashfile(full_path),
+        new_size=os.path.getsize(full_path),
+        is_binary=summary.is_binary or _wd_file_is_binary(full_path))
+  return summary
+
+def _wd_file_is_binary(fp):
+  with io.open(fp, mode='rb') as f:
+    return b'\0' in f.read(BINARY_PREFIX_LEN)
+
+def _wd_file_exceeds(fp, max_bytes, max_lines):
+  """Checks the limits against the file at fp without reading it in full."""
+  size = os.path.getsize(fp)
+  if size > max_bytes:
+    return True
+  if not size:  # can't mmap an empty file
+    return False
+  with io.open(fp, mode='rb') as f:
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      if mm.find(b'\0', 0, BINARY_PREFIX_LEN) != -1:
+        return True
+      if size <= max_lines:  # it can't have more lines than bytes
+        return False
+      return _count_lines(mm, max_lines) > max_lines
+    finally:
+      mm.close()
 
 def _get_git_path(path):
   return path if sys.platform != 'win32' else path.replace('\\', '/')
@@ -8,9 +8,12 @@
 from __future__ import unicode_literals
 
 from functools import wraps
+import io
+import itertools
 import os
 import shutil
 import tempfile
+import time
 
 import sys
 if sys.platform != 'win32':
@@ -19,6 +22,8 @@ else:
   from pbs import Command
   git = Command('git')
 
+import pygit2
+
 from tbd import core
 import tbd.tests.utils as utils_lib
 
@@ -120,6 +125,18 @@ def __assert_decorator(msg, prop, *fps):
   return decorator
 
 
+class CountingRepo(object):
+  """Wraps a pygit2 repo to count the objects read from it."""
+
+  def __init__(self, git_repo):
+    self.git_repo = git_repo
+    self.reads = 0
+
+  def __getitem__(self, oid):
+    self.reads += 1
+    return self.git_repo[oid]
+
+
 # Unit tests for file related operations
 
 class TestFile(TestCore):
@@ -702,6 +719,164 @@ class TestFileDiff(TestFile):
     self.assertEqual('+', hunk.lines[1].origin)
     self.assertEqual('new line', hunk.lines[1].content)
 
+  def test_diff_exceeds_max_bytes(self):
+    utils_lib.write_file(TRACKED_FP, contents='new contents\n')
+    summary = self.curr_b.diff_file(TRACKED_FP, max_bytes=10)
+
+    self.assertTrue(isinstance(summary, core.DiffSummary))
+    self.assertFalse(summary.is_binary)
+    self.assertEqual(len(TRACKED_FP_CONTENTS_2), summary.old_size)
+    self.assertEqual(len('new contents\n'), summary.new_size)
+    self.assertNotEqual(summary.old_id, summary.new_id)
+
+  def test_diff_exceeds_max_lines(self):
+    utils_lib.write_file(TRACKED_FP, contents='1\n2\n3\n')
+    summary = self.curr_b.diff_file(TRACKED_FP, max_lines=2)
+    self.assertTrue(isinstance(summary, core.DiffSummary))
+
+    patch = self.curr_b.diff_file(TRACKED_FP, max_lines=3)
+    self.assertEqual(3, patch.line_stats[1])
+
+  def test_diff_binary(self):
+    utils_lib.write_file(TRACKED_FP, contents='bin\0ary')
+    summary = self.curr_b.diff_file(TRACKED_FP)
+    self.assertTrue(isinstance(summary, core.DiffSummary))
+    self.assertTrue(summary.is_binary)
+
+  def test_diff_context_lines(self):
+    contents = '\n'.join(str(i) for i in range(20)) + '\n'
+    utils_lib.write_file(TRACKED_FP, contents=contents)
+    self.curr_b.create_commit([TRACKED_FP], 'msg')
+    utils_lib.write_file(TRACKED_FP, contents=contents.replace('10', 'ten'))
+    for context_lines in (0, 3, 5):
+      opts = self.repo.diff_options(context_lines=context_lines)
+      hunk = list(self.curr_b.diff_file(TRACKED_FP, opts=opts).hunks)[0]
+      self.assertEqual(2 + 2 * context_lines, len(hunk.lines))
+
+  def _diff_lines(self, algorithm, max_file_cost, stats=False):
+    # Myers keeps line b and patience keeps line c
+    utils_lib.write_file(TRACKED_FP, contents='c\nb\n{\n')
+    self.curr_b.create_commit([TRACKED_FP], 'msg')
+    utils_lib.write_file(TRACKED_FP, contents='b\nb\nc\n')
+    opts = self.repo.diff_options(
+        algorithm=algorithm, max_file_cost=max_file_cost)
+    if stats:
+      [(_, patch)] = self.curr_b.diff_stats([TRACKED_FP], opts=opts)
+    else:
+      patch = self.curr_b.diff_file(TRACKED_FP, opts=opts)
+    return [
+        l.origin + l.content for hunk in patch.hunks for l in hunk.lines
+        if l.origin in '+-']
+
+  def test_diff_algorithms(self):
+    myers = self._diff_lines('myers', 1024)
+    self.assertEqual(['-c\n', '-{\n', '+b\n', '+c\n'], myers)
+    self.assertEqual(myers, self._diff_lines('minimal', 1024))
+    for algorithm in ['patience', 'histogram']:
+      self.assertEqual(
+          ['+b\n', '+b\n', '-b\n', '-{\n'], self._diff_lines(algorithm, 1024))
+
+  def test_diff_max_file_cost(self):
+    # Files that cost more than the cap fall back to myers
+    self.assertEqual(
+        self._diff_lines('myers', 1024), self._diff_lines('patience', 11))
+    self.assertNotEqual(
+        self._diff_lines('myers', 1024), self._diff_lines('patience', 12))
+
+  def test_diff_stats(self):
+    utils_lib.write_file(TRACKED_FP, contents='new contents\n')
+    os.chmod(TRACKED_DIR_FP, 0o755)  # mode change only
+    io.open('empty', mode='w').close()
+    self.curr_b.track_file('empty')
+    utils_lib.write_file(IGNORED_FP, contents='ignored\n')
+    utils_lib.write_file(TRACKED_DIR_DIR_FP, contents='a\n' * 11)
+    fps = [
+        TRACKED_FP, TRACKED_DIR_FP, 'empty', IGNORED_FP, TRACKED_DIR_DIR_FP,
+        TRACKED_FP_WITH_SPACE, NONEXISTENT_FP]
+    stats = dict(self.curr_b.diff_stats(fps, max_lines=10))
+    self.assertEqual(
+        sorted(fps[:5] + [NONEXISTENT_FP]), sorted(stats))
+    self.assertEqual((1, 1), stats[TRACKED_FP].line_stats[1:])
+    self.assertEqual((0, 0), stats[TRACKED_DIR_FP].line_stats[1:])
+    self.assertEqual((0, 0), stats['empty'].line_stats[1:])
+    self.assertEqual((1, 0), stats[IGNORED_FP].line_stats[1:])
+    self.assertTrue(isinstance(stats[TRACKED_DIR_DIR_FP], core.DiffSummary))
+    self.assertEqual(None, stats[NONEXISTENT_FP])
+
+    os.remove(TRACKED_FP)
+    stats = dict(self.curr_b.diff_stats([TRACKED_FP]))
+    self.assertEqual((0, 1), stats[TRACKED_FP].line_stats[1:])
+
+  def test_diff_stats_max_file_cost(self):
+    myers = self._diff_lines('myers', 1024)
+    self.assertEqual(myers, self._diff_lines('myers', 1024, stats=True))
+    self.assertEqual(myers, self._diff_lines('patience', 11, stats=True))
+    self.assertEqual(
+        self._diff_lines('patience', 12),
+        self._diff_lines('patience', 12, stats=True))
+    os.remove(TRACKED_FP)
+    opts = self.repo.diff_options(algorithm='patience', max_file_cost=1)
+    [(_, patch)] = self.curr_b.diff_stats([TRACKED_FP], opts=opts)
+    self.assertEqual((0, 3), patch.line_stats[1:])
+
+  def test_diff_invalid_options(self):
+    self.assertRaises(ValueError, self.repo.diff_options, algorithm='foo')
+    self.assertRaises(ValueError, self.repo.diff_options, context_lines=-1)
+
+
+class TestDiffCommits(TestFile):
+
+  def setUp(self):
+    super(TestDiffCommits, self).setUp()
+    self.c1 = self.repo.revparse_single('HEAD~1')
+    self.c2 = self.repo.revparse_single('HEAD')
+
+  def test_diff_commits(self):
+    patches = list(self.repo.diff_commits(self.c1, self.c2))
+    self.assertEqual(6, len(patches))
+    for patch in patches:
+      self.assertEqual(1, patch.line_stats[1])
+      self.assertEqual(1, patch.line_stats[2])
+
+  def test_diff_commits_counts_lines_only_if_needed(self):
+    counted = []
+    count_lines = core._count_lines
+    def spy(buf, limit):
+      counted.append(limit)
+      return count_lines(buf, limit)
+    core._count_lines = spy
+    try:
+      # The files are smaller in bytes than the max number of lines
+      self.assertEqual(
+          6, len(list(self.repo.diff_commits(self.c1, self.c2, max_lines=100))))
+      self.assertEqual([], counted)
+      list(self.repo.diff_commits(self.c1, self.c2, max_lines=1))
+      self.assertTrue(counted)
+    finally:
+      core._count_lines = count_lines
+
+  def test_diff_commits_paths(self):
+    patches = list(self.repo.diff_commits(
+        self.c1, self.c2, paths=[TRACKED_FP, DIR_DIR]))
+    self.assertItemsEqual(
+        [TRACKED_FP, TRACKED_DIR_DIR_FP, TRACKED_DIR_DIR_FP_WITH_SPACE],
+        [p.delta.new_file.path for p in patches])
+
+  def test_diff_commits_renames(self):
+    git.mv(TRACKED_FP, 'renamed')
+    git.commit(m='rename')
+    c3 = self.repo.revparse_single('HEAD')
+
+    patches = list(self.repo.diff_commits(self.c2, c3, paths=['renamed']))
+    self.assertEqual(1, len(patches))  # only the addition of the new file
+    self.assertEqual('renamed', patches[0].delta.old_file.path)
+
+    patches = list(self.repo.diff_commits(
+        self.c2, c3, paths=['renamed'], find_renames=True))
+    self.assertEqual(1, len(patches))
+    self.assertEqual(TRACKED_FP, patches[0].delta.old_file.path)
+    self.assertEqual('renamed', patches[0].delta.new_file.path)
+
 
 class TestFileResolve(TestFile):
 
@@ -804,6 +979,64 @@ class TestBranchCreate(TestBranch):
     self.assertFalse(os.path.exists('.gitignore'))
 
 
+class TestRefTransaction(TestBranch):
+
+  def test_create_and_delete(self):
+    head = self.repo.current_branch.head
+    tx = self.repo.ref_transaction()
+    for n in ['b3', 'b2', BRANCH, 'a..b']:
+      tx.create_branch(n, head)
+    tx.create_tag('t1', head)
+    errors = tx.commit()
+    self.assertEqual([('branch', BRANCH), ('branch', 'a..b')], list(errors))
+    self.assertTrue(isinstance(errors['branch', 'a..b'], ValueError))
+    self.assertEqual(head.id, self.repo.lookup_branch('b2').target)
+    self.assertEqual(head.id, self.repo.lookup_tag('t1').commit.id)
+    # Same tag object that would have been created one at a time
+    t1 = self.repo.git_repo.lookup_reference('refs/tags/t1').target
+    self.repo.create_tag('t2', head)
+    t2 = self.repo.git_repo.lookup_reference('refs/tags/t2').target
+    self.assertEqual(
+        self.repo.git_repo[t1].read_raw().replace(b'tag t1', b'tag t2'),
+        self.repo.git_repo[t2].read_raw())
+
+    git('pack-refs', '--all')
+    self.repo.lookup_branch('b3').upstream = self.repo.lookup_branch('b2')
+    tx = self.repo.ref_transaction()
+    for n in ['b3', 'master', 'nonexistent']:
+      tx.delete_branch(n)
+    tx.delete_tag('t1')
+    errors = tx.commit()
+    self.assertTrue(
+        isinstance(errors['branch', 'master'], core.BranchIsCurrentError))
+    self.assertTrue(isinstance(errors['branch', 'nonexistent'], ValueError))
+    self.assertEqual(2, len(errors))
+    self.assertEqual(None, self.repo.lookup_branch('b3'))
+    self.assertEqual(None, self.repo.lookup_tag('t1'))
+    for key in ('branch.b3.merge', 'branch.b3.remote'):
+      self.assertRaises(KeyError, lambda: self.repo.config[key])
+
+  def test_atomic(self):
+    head = self.repo.current_branch.head
+    tx = self.repo.ref_transaction(atomic=True)
+    tx.create_branch('b3', head)
+    tx.create_branch(BRANCH, head)
+    tx.delete_branch(BRANCH)
+    self.assertEqual([('branch', BRANCH)], list(tx.commit()))
+    self.assertEqual(None, self.repo.lookup_branch('b3'))
+    self.assertTrue(self.repo.lookup_branch(BRANCH))
+
+  def test_atomic_doesnt_write_tags(self):
+    head = self.repo.current_branch.head
+    objects = utils_lib.stdout(git('count-objects', '-v'))
+    tx = self.repo.ref_transaction(atomic=True)
+    tx.create_tag('t1', head)
+    tx.create_branch(BRANCH, head)
+    self.assertEqual([('branch', BRANCH)], list(tx.commit()))
+    self.assertEqual(None, self.repo.lookup_tag('t1'))
+    self.assertEqual(objects, utils_lib.stdout(git('count-objects', '-v')))
+
+
 class TestBranchDelete(TestBranch):
 
   def test_delete(self):
@@ -869,6 +1102,42 @@ class TestBranchSwitch(TestBranch):
     self.assertEqual('contents', utils_lib.read_file(hf))
 
 
+class TestRefSnapshot(TestBranch):
+
+  def test_ref_snapshot(self):
+    git.branch('packed/v1.2')
+    git('pack-refs', '--all')
+    git.branch('loose')
+    git.branch('--set-upstream-to', BRANCH, 'loose')
+    git.config('branch.packed/v1.2.remote', 'origin')
+    git.config('branch.packed/v1.2.merge', 'refs/heads/master')
+    git('update-ref', 'refs/remotes/origin/master', 'HEAD')
+    git.branch('gone')
+    git.config('branch.gone.remote', 'origin')
+    git.config('branch.gone.merge', 'refs/heads/gone')
+    refs = self.repo.ref_snapshot()
+    self.assertEqual(
+        sorted(self.repo.listall_branches()), refs.listall_branches())
+    self.assertEqual('master', refs.current)
+    for n in refs.listall_branches():
+      b = self.repo.lookup_branch(n)
+      self.assertEqual(b.is_current, refs.is_current(n))
+      self.assertEqual(b.target, refs.target(n))
+      self.assertEqual(b.head.id, refs.head(n).id)
+    self.assertEqual(BRANCH, refs.upstream('loose'))
+    self.assertEqual('origin/master', refs.upstream('packed/v1.2'))
+    self.assertEqual(None, refs.upstream('master'))
+    # The upstream's remote-tracking ref doesn't exist
+    self.assertEqual(None, refs.upstream('gone'))
+    self.assertEqual(None, self.repo.lookup_branch('gone').upstream)
+
+  def test_ref_snapshot_loose_overrides_packed(self):
+    git('pack-refs', '--all')
+    git.branch('-f', BRANCH, 'HEAD^')
+    refs = self.repo.ref_snapshot()
+    self.assertEqual(self.repo.revparse_single('HEAD^').id, refs.target(BRANCH))
+
+
 # Unit tests for remote related operations
 
 class TestRemote(TestCore):
@@ -968,3 +1237,713 @@ class TestRemoteSync(TestRemote):
         remote_branch_head_before.id,
         remote_branch.head.id)
     self.assertEqual(current_b.head.id, remote_branch.head.id)
+
+  def test_fetch_session(self):
+    master = self.remote.lookup_branch('master')
+    head_before = master.head.id
+    # Change the remote behind our back
+    git('-C', self.remote_path, 'commit', '--allow-empty', m='new')
+    git('-C', self.remote_path, 'branch', 'new')
+    # Refs are fetched at most once per session
+    self.assertEqual(head_before, master.head.id)
+    self.assertEqual(head_before, self.remote.lookup_branch('master').head.id)
+    self.assertEqual(None, self.remote.lookup_branch('new'))
+
+    self.repo.fetch_session.refresh('remote')
+    self.assertNotEqual(head_before, master.head.id)
+    self.assertEqual(master.head.id, self.remote.lookup_branch('new').head.id)
+
+
+class TestRemoteInit(TestRemote):
+
+  def setUp(self):
+    super(TestRemoteInit, self).setUp()
+    git('-C', self.remote_path, 'branch', 'feature/x"y')
+    self.clone_path = tempfile.mkdtemp(prefix='tbd-remote-test')
+
+  def tearDown(self):
+    super(TestRemoteInit, self).tearDown()
+    utils_lib.rmtree(self.clone_path)
+
+  def test_init_from_remote(self):
+    os.chdir(self.clone_path)
+    repo = core.init_repository(url=self.remote_path)
+    refs = repo.ref_snapshot()
+    self.assertEqual(
+        ['feature/x"y', 'master', REMOTE_BRANCH], refs.listall_branches())
+    self.assertEqual('master', refs.current)
+    for n in refs.listall_branches():
+      self.assertEqual('origin/' + n, refs.upstream(n))
+      self.assertEqual('origin/' + n, str(repo.lookup_branch(n).upstream))
+      self.assertEqual(refs.target('master'), refs.target(n))
+
+  def test_init_shallow(self):
+    for i in range(3):
+      utils_lib.write_file(os.path.join(self.remote_path, 'f'), contents=str(i))
+      git('-C', self.remote_path, 'add', 'f')
+      git('-C', self.remote_path, 'commit', '-m', 'msg' + str(i))
+    os.chdir(self.clone_path)
+    repo = core.init_repository(url=self.remote_path, depth=2)
+    self.assertTrue(repo.git_repo.is_shallow)
+    master = repo.lookup_branch('master')
+    self.assertEqual(2, len(list(master.history())))
+    self.assertEqual(
+        frozenset([list(master.history())[-1].id]), repo.shallow_ids)
+    self.assertEqual(
+        set(['master', 'feature/x"y', REMOTE_BRANCH]),
+        set(repo.listall_branches()))
+
+  def test_init_reference(self):
+    os.chdir(self.clone_path)
+    repo = core.init_repository(
+        url='file://' + self.remote_path, reference=self.remote_path)
+    alternates = os.path.join(repo.path, 'objects', 'info', 'alternates')
+    self.assertTrue(os.path.exists(alternates))
+    self.assertEqual(
+        ['feature/x"y', 'master', REMOTE_BRANCH], repo.listall_branches())
+
+  def test_init_from_bundle(self):
+    bundle = os.path.join(self.remote_path, '.git', 'repo.bundle')
+    git('-C', self.remote_path, 'bundle', 'create', bundle, '--all')
+    utils_lib.write_file(os.path.join(self.remote_path, 'f'), contents='new')
+    git('-C', self.remote_path, 'add', 'f')
+    git('-C', self.remote_path, 'commit', '-m', 'after the bundle')
+    remote_head = utils_lib.stdout(
+        git('-C', self.remote_path, 'rev-parse', 'HEAD')).strip()
+    os.chdir(self.clone_path)
+    repo = core.init_repository(url=self.remote_path, bundle=bundle)
+    refs = repo.ref_snapshot()
+    self.assertEqual(
+        ['feature/x"y', 'master', REMOTE_BRANCH], refs.listall_branches())
+    self.assertEqual('master', refs.current)
+    self.assertEqual(remote_head, str(refs.target('master')))
+    self.assertEqual('origin/master', refs.upstream('master'))
+    self.assertEqual('new', utils_lib.read_file('f'))
+
+  def test_init_non_empty_dir(self):
+    bundle = os.path.join(self.remote_path, '.git', 'repo.bundle')
+    git('-C', self.remote_path, 'bundle', 'create', bundle, '--all')
+    os.chdir(self.clone_path)
+    utils_lib.write_file('f', contents='mine')
+    self.assertRaises(
+        core.TbdError, core.init_repository, url=self.remote_path,
+        bundle=bundle)
+    self.assertRaises(core.TbdError, core.init_repository, url=self.remote_path)
+    self.assertEqual(['f'], os.listdir(self.clone_path))
+    self.assertEqual('mine', utils_lib.read_file('f'))
+
+  def test_init_from_bundle_failure(self):
+    bundle = os.path.join(self.remote_path, '.git', 'repo.bundle')
+    git('-C', self.remote_path, 'bundle', 'create', bundle, '--all')
+    os.chdir(self.clone_path)
+    self.assertRaises(
+        core.TbdError, core.init_repository,
+        url=os.path.join(self.remote_path, 'nonexistent'), bundle=bundle)
+    self.assertEqual([], os.listdir(self.clone_path))
+    # We can try again
+    core.init_repository(url=self.remote_path, bundle=bundle)
+
+  def test_init_partial(self):
+    contents = 'big file contents\n' * 100
+    utils_lib.write_file(os.path.join(self.remote_path, 'big'), contents)
+    git('-C', self.remote_path, 'add', 'big')
+    git('-C', self.remote_path, 'commit', '-m', 'big')
+    utils_lib.write_file(os.path.join(self.remote_path, 'big'), contents * 2)
+    git('-C', self.remote_path, 'commit', '-a', '-m', 'bigger')
+    git('-C', self.remote_path, 'config', 'uploadpack.allowFilter', 'true')
+    git(
+        '-C', self.remote_path, 'config', 'uploadpack.allowAnySHA1InWant',
+        'true')
+    os.chdir(self.clone_path)
+    repo = core.init_repository(url=self.remote_path, max_blob_size=100)
+    self.assertEqual('origin', repo._promisor_remote())
+    git_repo = repo.git_repo
+    head = git_repo.head.peel()
+    parent = head.parents[0]
+    old_id = parent.tree['big'].id
+    self.assertFalse(old_id in git_repo)
+    patches = list(repo.diff_commits(parent, head))
+    self.assertEqual(1, len(patches))
+    self.assertTrue(old_id in git_repo)
+    self.assertEqual(
+        (1, 100, 0),
+        repo.lookup_branch('master').diff_commits_stats(parent, head))
+
+
+class TestRemoteLookup(TestRemote):
+
+  def setUp(self):
+    super(TestRemoteLookup, self).setUp()
+    git('-C', self.remote_path, 'tag', 'annotated', m='msg')
+    git('-C', self.remote_path, 'tag', 'lightweight')
+    self.remote_head = utils_lib.stdout(
+        git('-C', self.remote_path, 'rev-parse', 'HEAD')).strip()
+
+    # Use a bare copy of it as the remote
+    self.bare_path = tempfile.mkdtemp(prefix='tbd-remote-test')
+    git.clone('--bare', self.remote_path, self.bare_path)
+    self.repo.remotes.create('remote', self.bare_path)
+    self.remote = self.repo.remotes['remote']
+
+  def tearDown(self):
+    super(TestRemoteLookup, self).tearDown()
+    utils_lib.rmtree(self.bare_path)
+
+  def test_lookup_branches(self):
+    branches = self.remote.lookup_branches(
+        [REMOTE_BRANCH, 'nonexistent', 'master'])
+    self.assertEqual(
+        ['remote/' + REMOTE_BRANCH, 'remote/master'],
+        [str(b) for b in branches])
+    for b in branches:
+      self.assertEqual(self.remote_head, str(b.head.id))
+
+  def test_lookup_branches_up_to_date(self):
+    b, = self.remote.lookup_branches(['master'])
+    calls = []
+    read_refs = core._read_refs
+    def spy(*args):
+      calls.append(args)
+      return read_refs(*args)
+    core._read_refs = spy
+    try:
+      self.assertEqual(self.remote_head, str(b.head.id))
+      self.assertEqual(self.remote_head, str(b.target))
+    finally:
+      core._read_refs = read_refs
+    self.assertEqual([], calls)
+
+  def test_ssh_remote(self):
+    # A fake ssh that runs the remote command locally, ssh remotes are talked
+    # to through git so that ssh's config is honored
+    ssh = os.path.join(self.bare_path, 'fake-ssh')
+    utils_lib.write_file(ssh, contents='#!/bin/sh\neval "$(eval echo \\${$#})"\n')
+    os.chmod(ssh, 0o755)
+    old_ssh = os.environ.get('GIT_SSH_COMMAND')
+    os.environ['GIT_SSH_COMMAND'] = ssh
+    try:
+      self.assertTrue(core._uses_ssh('alias:' + self.bare_path))
+      self.repo.remotes.create('ssh', 'alias:' + self.bare_path)
+      remote = self.repo.remotes['ssh']
+      self.assertEqual(
+          self.remote_head, str(remote.lookup_branch('master').head.id))
+      self.assertEqual(
+          [self.remote_head] * 2,
+          [str(t.commit.id) for t in remote.lookup_tags(
+              ['annotated', 'lightweight'])])
+      git.commit(allow_empty=True, m='local')
+      head = self.repo.revparse_single('HEAD')
+      self.assertEqual(head.id, remote.create_branch('new', head).head.id)
+    finally:
+      if old_ssh is None:
+        del os.environ['GIT_SSH_COMMAND']
+      else:
+        os.environ['GIT_SSH_COMMAND'] = old_ssh
+    for url in ['/a/b:c', 'file:///a', 'https://host/a', 'C:\\a', './x:y']:
+      self.assertFalse(core._uses_ssh(url))
+    for url in ['ssh://host/a', 'user@host:a', 'host:/a/b']:
+      self.assertTrue(core._uses_ssh(url))
+
+  def test_lookup_tags(self):
+    tags = self.remote.lookup_tags(['annotated', 'lightweight', 'nonexistent'])
+    self.assertEqual(
+        ['remote/annotated', 'remote/lightweight'], [str(t) for t in tags])
+    for t in tags:
+      self.assertEqual(self.remote_head, str(t.commit.id))
+    self.assertItemsEqual(
+        ['annotated', 'lightweight'], self.remote.listall_tags())
+
+  def test_lookup_tags_peeled(self):
+    # Only get the tagged commit, not the annotated tag's object
+    git.fetch('--no-tags', 'remote', 'master')
+    fetched = []
+    fetch = self.repo.fetch_session.fetch
+    def spy(remote_name, *refs):
+      fetched.extend(refs)
+      return fetch(remote_name, *refs)
+    self.repo.fetch_session.fetch = spy
+    tags = self.remote.lookup_tags(['annotated', 'lightweight'])
+    self.assertEqual([], fetched)
+    self.assertEqual(
+        [self.remote_head] * 2, [str(t.commit.id) for t in tags])
+
+  def test_file_url(self):
+    self.repo.remotes.create('file', 'file://' + self.bare_path)
+    remote = self.repo.remotes['file']
+    progress = []
+    self.repo.fetch_session.progress = progress.append
+    self.assertEqual(
+        self.remote_head, str(remote.lookup_branch('master').head.id))
+    self.assertTrue(progress)
+
+    git.commit(allow_empty=True, m='local')
+    head = self.repo.revparse_single('HEAD')
+    b = remote.create_branch('new', head)
+    self.assertEqual(head.id, b.head.id)
+    self.assertRaises(core.TbdError, remote.create_branch, 'new', head)
+    t = remote.create_tag('new_tag', head)
+    self.assertEqual(head.id, t.commit.id)
+    b.delete()
+    t.delete()
+    self.assertEqual(None, remote.lookup_branch('new'))
+    self.assertEqual(None, remote.lookup_tag('new_tag'))
+    # Fetching doesn't create local tags
+    self.assertEqual([], list(self.repo.listall_tags()))
+
+  def test_remote_refs_cache(self):
+    self.assertItemsEqual(
+        ['master', REMOTE_BRANCH], self.remote.listall_branches())
+    git('-C', self.bare_path, 'branch', 'new', 'master')
+    git.config('tbd.remoteRefsTtl', '3600')
+    self.assertItemsEqual(
+        ['master', REMOTE_BRANCH],
+        core.Repository().remotes['remote'].listall_branches())
+    git.config('tbd.remoteRefsTtl', '0')
+    self.assertItemsEqual(
+        ['master', REMOTE_BRANCH, 'new'],
+        core.Repository().remotes['remote'].listall_branches())
+
+  def test_offline(self):
+    self.remote.lookup_branch(REMOTE_BRANCH)
+    git('-C', self.bare_path, 'branch', 'new', 'master')
+    git.config('tbd.offline', 'true')
+    repo = core.Repository()
+    remote = repo.remotes['remote']
+    # From the cache
+    self.assertItemsEqual(
+        ['master', REMOTE_BRANCH], remote.listall_branches())
+    # Only the branches we fetched are there
+    self.assertEqual(
+        ['remote/' + REMOTE_BRANCH],
+        [str(b) for b in remote.lookup_branches(['master', REMOTE_BRANCH])])
+    # From the remote-tracking branches
+    repo.fetch_session.refresh('remote')
+    self.assertEqual([REMOTE_BRANCH], list(remote.listall_branches()))
+
+  def test_map_remotes(self):
+    self.repo.remotes.create('other', self.remote_path)
+    git.remote('add', 'broken', os.path.join(self.bare_path, 'nonexistent'))
+    ret = self.repo.map_remotes(lambda r: sorted(r.listall_branches()))
+    self.assertEqual(['broken', 'other', 'remote'], [r.name for r, _, _ in ret])
+    _, result, err = ret[0]
+    self.assertEqual(None, result)
+    self.assertTrue(isinstance(err, core.TbdError))
+    for _, result, err in ret[1:]:
+      self.assertEqual(['master', REMOTE_BRANCH], result)
+      self.assertEqual(None, err)
+
+
+# Unit tests for history
+
+class TestHistory(TestCore):
+
+  def setUp(self):
+    super(TestHistory, self).setUp()
+    self.git_repo = self.repo.git_repo
+    self.tree = self.git_repo.TreeBuilder().write()
+
+  def _commit(self, msg, parents, t):
+    sig = pygit2.Signature('tester', 'tester@example.com', t, 0)
+    return self.git_repo.create_commit(
+        None, sig, sig, msg, self.tree, parents)
+
+  def _skewed_history(self):
+    # A merge of two lines where the root commit is from the future, a walk in
+    # commit time order alone outputs it before b1 and b2
+    c0 = self._commit('c0', [], 5000)
+    a1 = self._commit('a1', [c0], 2000)
+    b1 = self._commit('b1', [c0], 1200)
+    b2 = self._commit('b2', [b1], 1500)
+    return self._commit('merge', [a1, b2], 3000)
+
+  def _assert_topological(self, commits):
+    seen = set()
+    for ci in commits:
+      self.assertFalse(any(p in seen for p in ci.parent_ids))
+      seen.add(ci.id)
+
+  def test_stream_walker(self):
+    target = self._skewed_history()
+    commits = list(core.stream_walker(self.git_repo, target))
+    self._assert_topological(commits)
+    self.assertItemsEqual(
+        [ci.id for ci in core.walker(self.git_repo, target, False)],
+        [ci.id for ci in commits])
+
+  def test_stream_walker_lookahead(self):
+    target = self._skewed_history()
+    commits = list(core.stream_walker(self.git_repo, target, lookahead=3))
+    self._assert_topological(commits)
+    self.assertEqual('c0', commits[-1].message)
+
+  def test_stream_walker_since_levels_only(self):
+    # In generation number order the old a commits come before b1, which
+    # would make us stop too early if we relied on commit times being ordered
+    c0 = self._commit('c0', [], 1000)
+    a = c0
+    for i in range(6):
+      a = self._commit('a' + str(i), [a], 1100 + i)
+    b1 = self._commit('b1', [c0], 9000)
+    m = self._commit('m', [a, b1], 9500)
+    self.git_repo.create_reference('refs/heads/skewed', m)
+    git.config('commitGraph.generationVersion', '1')
+    self.repo.write_commit_graph()
+    graph = self.repo.commit_graph
+    self.assertFalse(graph.corrected_dates)
+    walk = core.stream_walker(self.git_repo, m, graph=graph, since=5000)
+    self.assertEqual(['m', 'b1'], [ci.message for ci in walk])
+
+  def test_stream_walker_is_incremental(self):
+    target = None
+    for i in range(200):
+      target = self._commit(str(i), [target] if target else [], 1000 + i)
+
+    git_repo = CountingRepo(self.git_repo)
+    walk = core.stream_walker(git_repo, target, lookahead=5)
+    commits = list(itertools.islice(walk, 10))
+    self.assertEqual(['199', '190'], [commits[0].message, commits[-1].message])
+    self.assertTrue(git_repo.reads <= 10 + 5 + 2, git_repo.reads)
+
+  def test_stream_walker_first_parent_since_stops_early(self):
+    target = None
+    for i in range(200):
+      target = self._commit(str(i), [target] if target else [], 1000 + i)
+    git_repo = CountingRepo(self.git_repo)
+    walk = core.stream_walker(
+        git_repo, target, first_parent=True, since=1190)
+    self.assertEqual(10, len(list(walk)))
+    self.assertTrue(
+        git_repo.reads <= 10 + core.HISTORY_SLOP + 1, git_repo.reads)
+
+  def test_ahead_behind_many_without_graph(self):
+    target = None
+    for i in range(200):
+      target = self._commit(str(i), [target] if target else [], 1000 + i)
+    a = self._commit('a', [target], 2000)
+    b = self._commit('b', [target], 2001)
+    b2 = self._commit('b2', [b], 1500)  # skewed
+    pairs = [(a, b2), (b2, a), (b, b2), (a, target), (a, a)]
+    bits = dict((oid, 1 << i) for i, oid in enumerate([a, b, b2, target]))
+    # A single walk that stops soon after the merge base
+    git_repo = CountingRepo(self.git_repo)
+    self.assertEqual(
+        [self.git_repo.ahead_behind(*pair) for pair in pairs],
+        core._date_ahead_behind_many(git_repo, bits, pairs))
+    self.assertTrue(
+        git_repo.reads <= 5 + core.HISTORY_SLOP + 1, git_repo.reads)
+
+  def test_stream_walker_resumes_from_frontier(self):
+    target = None
+    for i in range(200):
+      target = self._commit(str(i), [target] if target else [], 1000 + i)
+    walk = core.stream_walker(self.git_repo, target, first_parent=True)
+    list(itertools.islice(walk, 150))
+    cursor = core.HistoryCursor.parse(str(walk.cursor))
+    self.assertEqual(target, cursor.tip)
+
+    # The commits before the cursor are not read again
+    git_repo = CountingRepo(self.git_repo)
+    walk = core.stream_walker(
+        git_repo, target, first_parent=True, after=cursor)
+    self.assertEqual('49', next(walk).message)
+    self.assertTrue(git_repo.reads <= 2, git_repo.reads)
+
+    # If the branch moved the walk goes up to the cursor's commit instead
+    new = self._commit('new', [target], 2000)
+    walk = core.stream_walker(
+        self.git_repo, new, first_parent=True, after=cursor)
+    self.assertEqual('49', next(walk).message)
+    walk = core.stream_walker(
+        self.git_repo, new, first_parent=True,
+        after=core.HistoryCursor(new, cursor.frontier, target))
+    self.assertEqual('199', next(walk).message)
+
+
+class TestCommitGraph(TestHistory):
+
+  def setUp(self):
+    super(TestCommitGraph, self).setUp()
+    # Two lines that are merged and then diverge again:
+    #   c0 - a1 - a2 ------ m - a3
+    #          \          /
+    #           b1 - b2 -+- b3
+    self.c0 = self._commit('c0', [], 1000)
+    self.a1 = self._commit('a1', [self.c0], 2000)
+    self.a2 = self._commit('a2', [self.a1], 3000)
+    self.b1 = self._commit('b1', [self.a1], 9000)  # skewed
+    self.b2 = self._commit('b2', [self.b1], 2500)
+    self.m = self._commit('m', [self.a2, self.b2], 4000)
+    self.a3 = self._commit('a3', [self.m], 5000)
+    self.b3 = self._commit('b3', [self.b2], 6000)
+    self.git_repo.create_reference('refs/heads/master', self.a3)
+    self.git_repo.create_reference('refs/heads/other', self.b3)
+    self.repo.write_commit_graph()
+
+  def test_commit_graph(self):
+    graph = self.repo.commit_graph
+    self.assertEqual(8, len(graph))
+    m = graph.position(self.m)
+    self.assertEqual(
+        [self.a2, self.b2], [graph.oid(p) for p in graph.parents(m)])
+    self.assertEqual(4000, graph.commit_time(m))
+    for p in graph.parents(m):
+      self.assertTrue(graph.generation(p) < graph.generation(m))
+    self.assertEqual(None, graph.position(pygit2.Oid(hex='0' * 40)))
+
+  def test_commit_graph_incremental(self):
+    c = self._commit('c', [self.a3], 7000)
+    self.assertFalse(c in self.repo.commit_graph)
+    self.git_repo.lookup_reference('refs/heads/master').set_target(c)
+    self.repo.write_commit_graph()
+    graph = self.repo.commit_graph
+    self.assertEqual(9, len(graph))
+    self.assertEqual(
+        [self.a3], [graph.oid(p) for p in graph.parents(graph.position(c))])
+
+  def test_merge_base(self):
+    new = self._commit('new', [self.b3], 8000)  # not in the graph
+    for id1, id2, expected in [
+        (self.a3, self.b3, self.b2), (self.a3, new, self.b2),
+        (self.a2, self.b1, self.a1), (self.m, self.a2, self.a2),
+        (self.c0, self.c0, self.c0)]:
+      self.assertEqual(expected, self.repo.commits_merge_base(id1, id2))
+      self.assertEqual(expected, self.git_repo.merge_base(id1, id2))
+
+  def test_reachable_ids(self):
+    self.assertEqual(
+        frozenset([self.a3, self.m, self.a2]),
+        self.repo.reachable_ids(self.a3, hide=[self.b3]))
+    self.assertEqual(
+        frozenset([self.b3]), self.repo.reachable_ids(self.b3, hide=[self.a3]))
+    self.assertEqual(8 - 1, len(self.repo.reachable_ids(self.a3)))
+
+  def test_ahead_behind(self):
+    self.assertEqual((3, 1), self.repo.ahead_behind(self.a3, self.b3))
+    self.assertEqual((0, 0), self.repo.ahead_behind(self.a3, self.a3))
+
+  def test_ahead_behind_many(self):
+    new = self._commit('new', [self.a2], 500)  # not in the graph
+    ids = [self.a3, self.b3, self.a1, self.m, new]
+    pairs = list(itertools.permutations(ids, 2)) + [(self.a3, self.a3)]
+    expected = [self.git_repo.ahead_behind(id1, id2) for id1, id2 in pairs]
+    self.assertEqual(expected, self.repo.ahead_behind_many(pairs))
+    shutil.rmtree(os.path.join(self.repo.path, core.COMMIT_GRAPH_CHAIN_DIR))
+    self.assertEqual(None, self.repo.commit_graph)
+    self.assertEqual(expected, self.repo.ahead_behind_many(pairs))
+    self.assertEqual([], self.repo.ahead_behind_many([]))
+
+  def test_divergence(self):
+    self.git_repo.create_reference('refs/heads/b2', self.b2)
+    self.git_repo.create_reference('refs/remotes/origin/other', self.b2)
+    git.config('branch.other.remote', 'origin')
+    git.config('branch.other.merge', 'refs/heads/other')
+    div = self.repo.ref_snapshot().divergence()
+    self.assertEqual(['b2', 'master', 'other'], list(div))
+    self.assertEqual([core.Divergence('master', 0, 3)], div['b2'])
+    self.assertEqual([], div['master'])
+    self.assertEqual(
+        [core.Divergence('origin/other', 1, 0),
+         core.Divergence('master', 1, 3)],
+        div['other'])
+
+  def test_stream_walker(self):
+    new = self._commit('new', [self.a3], 500)  # not in the graph
+    commits = list(core.stream_walker(
+        self.git_repo, new, graph=self.repo.commit_graph))
+    self._assert_topological(commits)
+    self.assertEqual(
+        ['new', 'a3', 'm', 'b2', 'b1', 'a2', 'a1', 'c0'],
+        [ci.message for ci in commits])
+
+
+  def test_stream_walker_cursor(self):
+    graph = self.repo.commit_graph
+    expected = [
+        ci.id for ci in core.stream_walker(self.git_repo, self.a3, graph=graph)]
+    got = []
+    after = None
+    while True:
+      walk = core.stream_walker(
+          self.git_repo, self.a3, graph=graph, after=after)
+      page = [ci.id for ci in itertools.islice(walk, 3)]
+      if not page:
+        break
+      got.extend(page)
+      after = core.HistoryCursor.parse(str(walk.cursor))
+      self.assertTrue(after.frontier is not None)
+    self.assertEqual(expected, got)
+
+  def test_history_after_commit_not_in_branch(self):
+    master = self.repo.lookup_branch('master')
+    self.assertRaisesRegexp(
+        ValueError, 'not in the history', list,
+        master.history(after=core.HistoryCursor(self.b3, None)))
+    # A cursor from another branch isn't resumed from its frontier
+    walk = self.repo.lookup_branch('other').history(stream=True)
+    next(walk)
+    self.assertEqual(self.b3, walk.cursor.last_id)
+    self.assertRaises(
+        ValueError, list, master.history(after=walk.cursor))
+    self.assertEqual(
+        set([self.a2, self.b2, self.b1, self.a1, self.c0]),
+        set(ci.id for ci in master.history(
+            after=core.HistoryCursor(self.m, None))))
+    # b2 is only reachable through the merge's second parent
+    walk = core.stream_walker(
+        self.git_repo, self.a3, first_parent=True,
+        after=core.HistoryCursor(self.b2, None))
+    self.assertRaises(ValueError, list, walk)
+
+  def test_stream_walker_cursor_without_graph(self):
+    expected = [ci.id for ci in core.stream_walker(self.git_repo, self.a3)]
+    walk = core.stream_walker(self.git_repo, self.a3)
+    page = [ci.id for ci in itertools.islice(walk, 3)]
+    self.assertEqual(None, walk.cursor.frontier)
+    walk = core.stream_walker(self.git_repo, self.a3, after=walk.cursor)
+    self.assertEqual(expected, page + [ci.id for ci in walk])
+
+  def test_stream_walker_filters(self):
+    for graph in (None, self.repo.commit_graph):
+      walk = core.stream_walker(self.git_repo, self.a3, graph=graph, since=2600)
+      self.assertItemsEqual(
+          [self.a3, self.m, self.a2, self.b1], [ci.id for ci in walk])
+      walk = core.stream_walker(
+          self.git_repo, self.a3, graph=graph, since=2000, until=3000)
+      self.assertItemsEqual(
+          [self.a1, self.a2, self.b2], [ci.id for ci in walk])
+      walk = core.stream_walker(
+          self.git_repo, self.a3, graph=graph, author='^tester <tester@')
+      self.assertEqual(7, len(list(walk)))
+      walk = core.stream_walker(
+          self.git_repo, self.a3, graph=graph, author='other')
+      self.assertEqual([], list(walk))
+
+  def test_first_parent(self):
+    expected = [self.a3, self.m, self.a2, self.a1, self.c0]
+    self.assertEqual(expected, [
+        ci.id for ci in core.walker(
+            self.git_repo, self.a3, False, first_parent=True)])
+    walk = core.stream_walker(self.git_repo, self.a3, first_parent=True)
+    page = [ci.id for ci in itertools.islice(walk, 2)]
+    self.assertEqual([self.a2], walk.cursor.frontier)
+    walk = core.stream_walker(
+        self.git_repo, self.a3, first_parent=True, after=walk.cursor)
+    self.assertEqual(expected, page + [ci.id for ci in walk])
+
+  def test_commit_filter_stops_early(self):
+    def commits():
+      yield self.git_repo[self.a3]
+      for _ in range(core.HISTORY_SLOP):
+        yield self.git_repo[self.c0]
+      self.fail('The walk should have stopped')
+    self.assertEqual(
+        [self.a3], [ci.id for ci in core.commit_filter(commits(), since=4500)])
+    self.assertRaises(
+        ValueError, core.commit_filter, commits(), author='(')
+
+  def test_history_cursor_parse(self):
+    self.assertRaises(ValueError, core.HistoryCursor.parse, 'foo')
+    cursor = core.HistoryCursor(self.m, [self.a2, self.b2])
+    self.assertEqual(cursor, core.HistoryCursor.parse(str(cursor)))
+
+
+class TestPathHistory(TestCore):
+
+  def setUp(self):
+    super(TestPathHistory, self).setUp()
+    for i in range(10):
+      utils_lib.write_file('f{0}'.format(i % 3), contents=str(i))
+      utils_lib.write_file('dir/f{0}'.format(i % 2), contents=str(i))
+      utils_lib.write_file('dir/sub/f', contents=str(i // 5))
+      utils_lib.write_file('ünicode', contents=str(i // 4))
+      git.add('.')
+      git.commit(m='commit {0}'.format(i))
+    self.curr_b = self.repo.current_branch
+
+  def _messages(self, paths):
+    return [
+        ci.message.strip()
+        for ci in self.curr_b.history(stream=True, paths=paths)]
+
+  def _assert_history(self):
+    self.assertEqual(
+        ['commit 9', 'commit 6', 'commit 3', 'commit 0'], self._messages(['f0']))
+    self.assertEqual(['commit 5', 'commit 0'], self._messages(['dir/sub']))
+    self.assertEqual(10, len(self._messages(['dir'])))
+    self.assertEqual(
+        ['commit 9', 'commit 6', 'commit 5', 'commit 3', 'commit 0'],
+        self._messages(['dir/sub/', 'f0']))
+    self.assertEqual(
+        ['commit 8', 'commit 4', 'commit 0'], self._messages(['ünicode']))
+    self.assertEqual([], self._messages(['nonexistent']))
+
+  def test_history_paths(self):
+    self._assert_history()
+
+  def test_history_paths_with_bloom_filters(self):
+    self.repo.write_commit_graph()
+    graph = self.repo.commit_graph
+    self.assertTrue(graph.bloom_settings)
+    # Filters never have false negatives
+    for ci in self.curr_b.history():
+      pos = graph.position(ci.id)
+      if ci.parent_ids:
+        diff = ci.parents[0].tree.diff_to_tree(ci.tree)
+        changed = [d.new_file.path for d in diff.deltas]
+      else:
+        changed = [e.name for e in ci.tree]
+      for fp in changed:
+        self.assertTrue(graph.maybe_changed(pos, graph.bloom_keys(fp)))
+    self._assert_history()
+
+  def test_murmur3(self):
+    for data, expected in [
+        (b'', 0), (b'Hello world!', 0x627b0c2c),
+        (b'The quick brown fox jumps over the lazy dog', 0x2e4ff723)]:
+      self.assertEqual(expected, core._murmur3(0, bytearray(data), 2))
+
+
+# Unit tests for the cache
+
+class TestCache(TestCore):
+
+  def setUp(self):
+    super(TestCache, self).setUp()
+    self.cache = self.repo.cache('test')
+
+  def test_get_missing(self):
+    self.assertEqual(None, self.cache.get('key'))
+
+  def test_set_get(self):
+    self.cache.set('key', b'data')
+    self.assertEqual(b'data', self.cache.get('key'))
+    self.assertEqual(b'data', self.repo.cache('test').get('key'))
+    self.assertEqual(None, self.repo.cache('other').get('key'))
+
+  def test_overwrite(self):
+    self.cache.max_bytes = 11
+    self.cache.set('k1', b'1111')
+    self.cache.set('k2', b'2222')
+    # Overwriting k2 doesn't make the cache any bigger
+    for _ in range(3):
+      self.cache.set('k2', b'2222')
+    self.assertEqual(b'1111', self.cache.get('k1'))
+    self.assertEqual(8, self.cache._size)
+    self.cache.delete('k2')
+    self.assertEqual(4, self.cache._size)
+    self.assertEqual(
+        [self.cache._entry_fp('k1')],
+        [fp for _, fp, _ in self.cache._entries()])
+
+  def test_evicts_least_recently_used(self):
+    self.cache.max_bytes = 11
+    self.cache.set('k1', b'1111')
+    self.cache.set('k2', b'2222')
+    # Make sure k1 is seen as more recently used than k2
+    past = time.time() - 60
+    os.utime(self.cache._entry_fp('k2'), (past, past))
+    self.cache.get('k1')
+    self.cache.set('k3', b'3333')
+    self.assertEqual(b'1111', self.cache.get('k1'))
+    self.assertEqual(None, self.cache.get('k2'))
+    self.assertEqual(b'3333', self.cache.get('k3'))
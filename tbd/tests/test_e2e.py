@@ -14,7 +14,7 @@ import time
 
 import sys
 if sys.platform != 'win32':
-  from sh import ErrorReturnCode, tbd, git
+  from sh import Command, ErrorReturnCode, tbd, git
 else:
   from pbs import ErrorReturnCode, Command
   tbd = Command('tbd')
@@ -225,6 +225,35 @@ class TestCommit(TestEndToEnd):
     tbd.commit(fp, m='msg')
     self.__assert_commit('dir/f')
 
+  def test_commit_history_diff_workers(self):
+    git.config('tbd.diffWorkers', '2')
+    tbd.commit(self.TRACKED_FP, m='msg')
+    tbd.commit(self.DIR_TRACKED_FP, m='msg')
+    self.__assert_commit(self.TRACKED_FP, self.DIR_TRACKED_FP)
+    # No worker processes are needed for a single commit
+    h = utils.stdout(tbd.history(v=True, l=1))
+    self.assertTrue(self.DIR_TRACKED_FP in h)
+    self.assertFalse(self.TRACKED_FP in h)
+    # Run tbd with a Pool that fails to check that it's not created
+    no_pool = Command(sys.executable).bake(
+        '-c',
+        'import multiprocessing, sys\n'
+        'def no_pool(*args, **kwargs):\n'
+        '  raise AssertionError("a worker pool was created")\n'
+        'multiprocessing.Pool = no_pool\n'
+        'from tbd.cli import tbd\n'
+        'sys.argv[0] = "tbd"\n'
+        'sys.exit(tbd.main())\n')
+    # New commits, so that their diffs are not cached
+    utils.write_file(self.TRACKED_FP, contents='new contents')
+    tbd.commit(self.TRACKED_FP, m='msg')
+    h = utils.stdout(no_pool('history', '-v', '-l', '1'))
+    self.assertTrue('+new contents' in h)
+    utils.write_file(self.TRACKED_FP, contents='newer contents')
+    tbd.commit(self.TRACKED_FP, m='msg')
+    self.assertRaisesRegexp(
+        ErrorReturnCode, 'a worker pool was created', no_pool, 'history', '-v')
+
   def __assert_commit(self, *expected_committed):
     h = utils.stdout(tbd.history(v=True))
     for fp in expected_committed:
@@ -396,6 +425,49 @@ class TestDiffFile(TestEndToEnd):
     if '+contents' not in out:
       self.fail()
 
+  def test_diff_stat(self):
+    utils.write_file(self.TRACKED_FP, contents='contents\n')
+    out = utils.stdout(tbd.diff(stat=True))
+    if not re.search(r't_fp \| +\+1 +-1', out):
+      self.fail('out is ' + out)
+    if '1 file changed, 1 insertion(+), 1 deletion(-)' not in out:
+      self.fail('out is ' + out)
+    if '@@' in out:
+      self.fail('out is ' + out)
+
+  def test_diff_stat_mode_change(self):
+    if sys.platform == 'win32':
+      return
+    os.chmod(self.DIR_TRACKED_FP, 0o755)
+    out = utils.stdout(tbd.diff(self.DIR_TRACKED_FP, stat=True))
+    if not re.search(r'dir/t_fp \| +\+0 +-0', out):
+      self.fail('out is ' + out)
+    if '1 file changed, 0 insertions(+), 0 deletions(-)' not in out:
+      self.fail('out is ' + out)
+
+  def test_diff_range(self):
+    utils.write_file(self.TRACKED_FP, contents='contents\n')
+    tbd.commit(self.TRACKED_FP, m='change')
+    utils.write_file(self.TRACKED_FP, contents='uncommitted\n')
+
+    out = utils.stdout(tbd.diff('HEAD~1..HEAD'))
+    if '+contents' not in out:
+      self.fail('out is ' + out)
+    out = utils.stdout(tbd.diff('HEAD~1..HEAD', self.DIR))
+    if 'No diffs to output' not in out:
+      self.fail('out is ' + out)
+    self.assertEqual('uncommitted\n', utils.read_file(self.TRACKED_FP))
+
+  def test_diff_range_like_path(self):
+    for fp in ('nonexistent..fp', os.path.join('..', 'nonexistent_fp')):
+      try:
+        tbd.diff(fp)
+        self.fail()
+      except ErrorReturnCode as e:
+        err = utils.stderr(e)
+        self.assertIn('nonexistent', err)
+        self.assertNotIn('No commit found', err)
+
   def test_diff_non_ascii(self):
     if sys.platform == 'win32':
       # Skip this test on Windows until we fix Unicode support
@@ -476,6 +548,14 @@ class TestFuse(TestOp):
     self.__assert_history(
         self.__build(self.OTHER, [0, 1]) + self.__build('master'))
 
+  def test_only_some_with_commit_graph(self):
+    tbd.maintenance()
+    self.assertRaises(
+        ErrorReturnCode, tbd.fuse, self.OTHER, o=self.commits['master'][1])
+    tbd.fuse(self.OTHER, '-o', self.commits[self.OTHER][:2])
+    self.__assert_history(
+        self.__build(self.OTHER, [0, 1]) + self.__build('master'))
+
   def test_exclude_errors(self):
     self.assertRaises(ErrorReturnCode, tbd.fuse, self.OTHER, e='non-existent-id')
     self.assertRaises(
@@ -682,6 +762,48 @@ class TestMerge(TestOp):
     self.assertTrue('uncommitted' in contents)
     self.assertTrue('contents 2' in contents)
 
+  def test_history_graph(self):
+    tbd.merge(self.OTHER)
+    out = utils.stdout(tbd.history(graph=True, c=True))
+    lines = out.splitlines()
+    self.assertTrue(lines[0].startswith('* '))
+    self.assertTrue('|\\' in lines)
+    self.assertTrue('|/' in lines)
+    self.assertTrue('| * ' in out)
+    # The initial commit, both branches and the merge
+    self.assertEqual(2 * self.COMMITS_NUMBER + 2, out.count('* '))
+
+    self.assertRaises(
+        ErrorReturnCode, tbd.history, graph=True, json=True)
+    # Filtered out commits would leave lanes open
+    for flag, value in [
+        ('since', 'yesterday'), ('until', 'tomorrow'), ('after', 'HEAD~1')]:
+      self.assertRaises(
+          ErrorReturnCode, tbd.history, graph=True, **{flag: value})
+      utils.stdout(tbd.history(**{flag: value}))
+
+  def test_history_graph_crossing_edges(self):
+    tree = utils.stdout(git('write-tree')).strip()
+    def commit(msg, parents, t):
+      env = dict(os.environ)
+      date = '@{0} +0000'.format(t)
+      env['GIT_AUTHOR_DATE'] = env['GIT_COMMITTER_DATE'] = date
+      args = [a for p in parents for a in ('-p', p)]
+      return utils.stdout(git(
+          'commit-tree', tree, '-m', msg, *args, _env=env)).strip()
+    # When M is drawn the lanes are M, X, P: X's lane moves right (to make
+    # room for Q) while P's lane moves left, crossing it
+    p = commit('P', [], 1000)
+    q = commit('Q', [p], 2000)
+    x = commit('X', [q], 3000)
+    m = commit('M', [p, q], 4000)
+    h = commit('H', [m, x, p], 5000)
+    git.branch('crossing', h)
+    out = utils.stdout(tbd.history(graph=True, c=True, b='crossing'))
+    lines = [l for l in out.splitlines() if '*' not in l]
+    self.assertEqual(
+        ['|\\', '| |\\', '|\\ \\|', '| |/|', '|/| |', '| |/', '|/'], lines)
+
 
 class TestPerformance(TestEndToEnd):
 